@@ -0,0 +1,207 @@
+import json
+import os
+
+import smartpy as sp
+
+contract = sp.io.import_script_from_url("file:contract.py")
+Opus = contract.Opus
+
+
+#########################################################################################################
+# Cost benchmark of the Opus entry points.                                                              #
+#                                                                                                       #
+# The scenario builds a contract with many admins, tokens, loan requests and credit deals, then calls   #
+# every entry point once and measures:                                                                  #
+#   params  – size of the packed call parameters in bytes (the operation size the call adds),           #
+#   storage – change of the storage size in bytes: the size of the whole packed storage before and      #
+#             after the call, with the big maps as maps (see measured_opus), so every written entry     #
+#             of every big map is counted without listing the keys a call touches.                      #
+# The change of each big map (bytes and entries) is shown as well, the ones a call touched are those    #
+# with a change. Both metrics are compared to benchmark.json with a tolerance of TOLERANCE (relative)   #
+# or MIN_TOLERANCE bytes; an entry point without a baseline fails the benchmark.                        #
+#                                                                                                       #
+# The SmartPy test interpreter doesn't compute gas. The "gas" of benchmark.json is the static gas       #
+# estimate of each entry point of the compiled opus build (see profiler.py), build.py checks it after   #
+# the compilation. The gas of a real call is reported by a dry run of the build, e.g. in an octez       #
+# mockup:                                                                                               #
+#   octez-client --mode mockup transfer 0 from <account> to opus --entrypoint <name> --arg <params>     #
+#     --dry-run                                                                                         #
+#                                                                                                       #
+# Run: SmartPy.sh test benchmark.py <output-directory>                                                  #
+# Set BENCHMARK_RECORD=1 to only show the measured values, then copy them to benchmark.json; the gas    #
+# values are recorded with "python3 build.py --record".                                                 #
+#########################################################################################################
+
+# Allowed relative deviation from the baseline.
+TOLERANCE = 0.05
+
+# Allowed absolute deviation from the baseline in bytes.
+MIN_TOLERANCE = 2
+
+# Size of the contract state built before the measurements.
+NADMINS = 20
+NTOKENS = 20
+NUSERS = 20
+LOANS_PER_USER = 10
+DEALS_PER_USER = 5
+
+DAY = 86400
+T0 = sp.timestamp_from_utc(2022, 6, 1, 0, 0, 0)
+LOAN_TIME = 30 * DAY
+LOAN_DEPOSIT = 1_000_000
+# service fee for LOAN_DEPOSIT and LOAN_TIME with the default fee (100 basis points)
+LOAN_FEE = LOAN_DEPOSIT * LOAN_TIME * 100 // (3600 * 24 * 365 * 100 * 100)
+# chain ID the permits are signed for
+CHAIN_ID = sp.chain_id_cst("0x9caecab9")
+
+# The big maps of the Opus storage, their changes are shown for every call.
+BIG_MAPS = ["admins", "tokens", "token_info", "loans", "index", "book", "stats", "maturities", "positions", "nonces"]
+
+BASELINE = json.load(open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark.json")))
+
+
+# Size of a packed value in bytes (without the pack prefix).
+#
+def packed_size(value):
+    return sp.to_int(sp.len(sp.pack(value))) - 1
+
+
+# Opus contract with maps instead of big maps: the entry points are the same, but the whole storage can be packed.
+#
+def measured_opus(creator):
+    big_map = sp.big_map
+    sp.big_map = sp.map
+    try:
+        return Opus(creator)
+    finally:
+        sp.big_map = big_map
+
+
+# Storage size of the contract and the size and number of entries of each big map.
+#
+def storage_size(c):
+    return sp.record(total = packed_size(c.data), **{field : sp.record(size = packed_size(getattr(c.data, field)),
+        entries = sp.to_int(sp.len(getattr(c.data, field)))) for field in BIG_MAPS})
+
+
+# Call an entry point and check its costs against the baseline.
+# @name – benchmark name (key in benchmark.json)
+# @params – call parameters
+# @call – the contract entry point call with params
+# @run – arguments of run()
+#
+def measure(scenario, c, name, params, call, **run):
+    scenario.h2(name)
+    before = scenario.compute(storage_size(c))
+    call.run(**run)
+    after = scenario.compute(storage_size(c))
+    results = sp.record(params = scenario.compute(packed_size(params)), storage = scenario.compute(after.total - before.total))
+    scenario.show(results)
+    scenario.show(sp.record(**{field : sp.record(size = getattr(after, field).size - getattr(before, field).size,
+        entries = getattr(after, field).entries - getattr(before, field).entries) for field in BIG_MAPS}))
+    if os.environ.get("BENCHMARK_RECORD"):
+        return
+    if name not in BASELINE:
+        raise Exception("no baseline of %s in benchmark.json (run with BENCHMARK_RECORD=1 and record it)" % name)
+    for metric in ["params", "storage"]:
+        expected = BASELINE[name][metric]
+        tolerance = max(MIN_TOLERANCE, int(abs(expected) * TOLERANCE))
+        scenario.verify((getattr(results, metric) >= expected - tolerance) & (getattr(results, metric) <= expected + tolerance))
+
+
+@sp.add_test(name = "Opus benchmark")
+def test():
+    creator = sp.test_account("Creator")
+    admins = [sp.test_account("Admin%d" % i) for i in range(NADMINS)]
+    users = [sp.test_account("User%d" % i) for i in range(NUSERS)]
+    tokens = [sp.record(name = "TOKEN%02d" % i, address = sp.test_account("Token%d" % i).address, token_id = sp.none) for i in range(NTOKENS)]
+    scenario = sp.test_scenario()
+    scenario.h1("Opus benchmark")
+    c = measured_opus(creator.address)
+    c.set_initial_balance(sp.tez(1000))
+    scenario += c
+
+
+    scenario.h1("Contract state")
+    scenario.p("%d admins, %d tokens, %d loan requests, %d of them funded" % (NADMINS, NTOKENS, NUSERS * LOANS_PER_USER, NUSERS * DEALS_PER_USER))
+    for admin in admins:
+        c.add_admin(address = admin.address).run(sender = creator)
+    for token in tokens:
+        c.add_token(token).run(sender = creator)
+    # loan requests of user u have IDs u * LOANS_PER_USER + 1 ... (u + 1) * LOANS_PER_USER,
+    # the last one expires in 10 days
+    for u, user in enumerate(users):
+        loans = []
+        for k in range(LOANS_PER_USER):
+            token = tokens[(u * LOANS_PER_USER + k) % NTOKENS]
+            validity = sp.some(T0.add_days(10)) if k == LOANS_PER_USER - 1 else sp.none
+            loans.append(sp.record(amount = 10_000, token = token.name, token_address = token.address, time = LOAN_TIME, reward = 100,
+                deposit = sp.mutez(LOAN_DEPOSIT), validity = validity, prev = sp.none))
+        c.add_loans(loans = loans).run(sender = user, amount = sp.mutez(LOANS_PER_USER * (LOAN_DEPOSIT + LOAN_FEE)), now = T0)
+    # the first loan requests of user u are funded by user u + 1
+    for u, user in enumerate(users):
+        ids = [u * LOANS_PER_USER + k + 1 for k in range(DEALS_PER_USER)]
+        c.make_deals(ids = ids).run(sender = users[(u + 1) % NUSERS], now = T0)
+    scenario.verify(c.data.nloan == NUSERS * LOANS_PER_USER)
+
+
+    scenario.h1("Admin entry points")
+    extra = sp.test_account("Extra")
+    keyHash = sp.key_hash("tz1fwnfJNgiDACshK9avfRfFbMaXrs3ghoJa")
+    token = sp.record(name = "TOKEN_NEW", address = extra.address, token_id = sp.none)
+    time = sp.record(min = 1 * DAY, max = 365 * DAY)
+    measure(scenario, c, "default", sp.unit, c.default(), sender = users[0], amount = sp.tez(1))
+    measure(scenario, c, "withdraw", sp.record(address = creator.address, amount = sp.tez(1)), c.withdraw(address = creator.address, amount = sp.tez(1)),
+        sender = creator)
+    measure(scenario, c, "add_admin", extra.address, c.add_admin(address = extra.address), sender = creator)
+    measure(scenario, c, "remove_admin", extra.address, c.remove_admin(address = extra.address), sender = creator)
+    measure(scenario, c, "pause", True, c.pause(pause = True), sender = creator)
+    c.pause(pause = False).run(sender = creator)
+    measure(scenario, c, "delegate", sp.some(keyHash), c.delegate(baker = sp.some(keyHash)), sender = creator, voting_powers = {keyHash : 0})
+    measure(scenario, c, "add_token", token, c.add_token(token), sender = creator)
+    measure(scenario, c, "remove_token", token.name, c.remove_token(name = token.name), sender = creator)
+    measure(scenario, c, "set_fee", sp.nat(200), c.set_fee(fee = 200), sender = creator)
+    c.set_fee(fee = 100).run(sender = creator)
+    measure(scenario, c, "set_min_deposit", sp.tez(2), c.set_min_deposit(min_deposit = sp.tez(2)), sender = creator)
+    c.set_min_deposit(min_deposit = sp.tez(1)).run(sender = creator)
+    measure(scenario, c, "set_time", time, c.set_time(time), sender = creator)
+    c.set_time(sp.record(min = 7 * DAY, max = 180 * DAY)).run(sender = creator)
+
+
+    scenario.h1("User entry points")
+    n = NUSERS * LOANS_PER_USER
+    loan = sp.record(amount = 10_000, token = tokens[0].name, token_address = tokens[0].address, time = LOAN_TIME, reward = 100,
+        deposit = sp.mutez(LOAN_DEPOSIT), validity = sp.none)
+    hinted = lambda prev: sp.record(amount = 10_000, token = tokens[0].name, token_address = tokens[0].address, time = LOAN_TIME, reward = 100,
+        deposit = sp.mutez(LOAN_DEPOSIT), validity = sp.none, prev = prev)
+    measure(scenario, c, "add_loan", loan, c.add_loan(loan), sender = users[0], amount = sp.mutez(LOAN_DEPOSIT + LOAN_FEE), now = T0)
+    # n + 1 is the last loan request of the token
+    measure(scenario, c, "add_loan_after", hinted(sp.some(sp.nat(n + 1))), c.add_loan_after(hinted(sp.some(sp.nat(n + 1)))),
+        sender = users[0], amount = sp.mutez(LOAN_DEPOSIT + LOAN_FEE), now = T0)
+    measure(scenario, c, "add_loans", [hinted(sp.none), hinted(sp.none)], c.add_loans(loans = [hinted(sp.none), hinted(sp.none)]),
+        sender = users[1], amount = sp.mutez(2 * (LOAN_DEPOSIT + LOAN_FEE)), now = T0)
+    measure(scenario, c, "cancel_loan", sp.nat(n + 1), c.cancel_loan(id = n + 1), sender = users[0], now = T0)
+    # loan requests 6..10 of users[0] are not funded yet, 6 is the first live loan request
+    measure(scenario, c, "make_deal", sp.nat(6), c.make_deal(id = 6), sender = users[1], now = T0)
+    measure(scenario, c, "make_deals", [sp.nat(7), sp.nat(8)], c.make_deals(ids = [7, 8]), sender = users[1], now = T0)
+    measure(scenario, c, "close_deal", sp.nat(6), c.close_deal(id = 6), sender = users[0], now = T0.add_days(1))
+    measure(scenario, c, "close_deals", [sp.nat(7), sp.nat(8)], c.close_deals(ids = [7, 8]), sender = users[0], now = T0.add_days(1))
+    # loan request 10 is expired, credit deal 1 (funded by users[1]) is timed out, users[3] sweeps them as a keeper
+    measure(scenario, c, "sweep", [sp.nat(10), sp.nat(1)], c.sweep(ids = [10, 1]), sender = users[3], now = T0.add_days(40))
+    # the loan requests of token k + 1 have IDs k + 1, k + 21, ... (k + 1 and k + 21 are not funded for k = 5..8),
+    # 9 is the first loan request of TOKEN08 and the first live loan request
+    fill = sp.record(token = tokens[8].name, max_amount = sp.nat(10_000), min_reward_rate = sp.nat(0))
+    measure(scenario, c, "fill_best", fill, c.fill_best(fill), sender = users[1], now = T0.add_days(40))
+
+
+    scenario.h1("Permits")
+    # loan requests 26..30 of users[2] are not funded, users[3] relays the cancellation of 26 signed by users[2]
+    measure(scenario, c, "increment_nonce", sp.nat(1), c.increment_nonce(nonce = 1), sender = users[2])
+    expiry = T0.add_days(41)
+    action = sp.set_type_expr(sp.variant("cancel_loan", sp.nat(26)), contract.TAction)
+    data = sp.pack(sp.pair(sp.pair(CHAIN_ID, c.address), sp.pair(sp.pair(sp.nat(1), expiry), action)))
+    permits = [sp.record(key = users[2].public_key, signature = sp.make_signature(users[2].secret_key, data, message_format = "Raw"),
+        expiry = expiry, action = action)]
+    measure(scenario, c, "relay", permits, c.relay(permits = permits), sender = users[3], now = T0.add_days(40), chain_id = CHAIN_ID)
+    scenario.verify(c.data.nonces[users[2].address] == 2)
+    scenario.verify(c.balance >= c.data.deposits)
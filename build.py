@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import profiler
+
+
+#########################################################################################################
+# Build and verification of the Opus contract.                                                          #
+#                                                                                                       #
+# Compiles every compilation target of contract.py (opus, opus_lazy, opus_compact), runs the scenarios  #
+# of every test file (all their sp.add_test functions) and profiles the builds with profiler.py; the    #
+# comparison of the builds is written to profile.txt, which is kept in the repository so a change of    #
+# the code size or cost shows in the diff. The static gas estimate of every entry point of the opus     #
+# build is checked against the "gas" of benchmark.json (within GAS_TOLERANCE, a missing value fails),   #
+# --record writes the estimates to benchmark.json instead. Any failing step stops the build with a non  #
+# zero status.                                                                                          #
+#                                                                                                       #
+# Run: python3 build.py [--smartpy ~/smartpy-cli/SmartPy.sh] [--out out] [--record]                     #
+#########################################################################################################
+
+TARGETS = ["opus", "opus_lazy", "opus_compact"]
+TEST_FILES = ["contract.py", "differential.py", "benchmark.py"]
+PROFILE = "profile.txt"
+BENCHMARK = "benchmark.json"
+# allowed relative deviation of the gas estimates from benchmark.json
+GAS_TOLERANCE = 0.05
+
+
+def run(command, **kwargs):
+    print("$ " + " ".join(command), flush = True)
+    try:
+        result = subprocess.run(command, **kwargs)
+    except FileNotFoundError:
+        raise SystemExit("not found: " + command[0])
+    if result.returncode != 0:
+        raise SystemExit("failed (status %d): %s" % (result.returncode, " ".join(command)))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Opus build")
+    parser.add_argument("--smartpy", default = os.path.expanduser("~/smartpy-cli/SmartPy.sh"), help = "SmartPy CLI (legacy syntax)")
+    parser.add_argument("--out", default = "out", help = "output directory")
+    parser.add_argument("--record", action = "store_true", help = "write the gas estimates to benchmark.json")
+    args = parser.parse_args()
+    root = os.path.dirname(os.path.abspath(__file__))
+    out = os.path.join(root, args.out)
+    run([args.smartpy, "compile", os.path.join(root, "contract.py"), out])
+    builds = [os.path.join(out, target, "step_000_cont_0_contract.tz") for target in TARGETS]
+    for build in builds:
+        if not os.path.exists(build):
+            raise SystemExit("missing build: " + build)
+    for name in TEST_FILES:
+        run([args.smartpy, "test", os.path.join(root, name), os.path.join(out, "test_" + os.path.splitext(name)[0])])
+    profile = run([sys.executable, os.path.join(root, "profiler.py")] + builds, capture_output = True, text = True).stdout
+    with open(os.path.join(root, PROFILE), "w") as f:
+        f.write(profile)
+    gas = {row[0] : row[3] for row in profiler.profile(profiler.load(builds[0]))["rows"] if not row[0].startswith("(")}
+    path = os.path.join(root, BENCHMARK)
+    baseline = json.load(open(path))
+    if args.record:
+        for (name, value) in gas.items():
+            baseline.setdefault(name, {})["gas"] = value
+        with open(path, "w") as f:
+            json.dump(baseline, f, indent = 2, sort_keys = True)
+            f.write("\n")
+        print("gas estimates written to " + BENCHMARK)
+        return 0
+    errors = check_gas(gas, baseline)
+    if errors:
+        raise SystemExit("\n".join(errors))
+    print("builds compiled, scenarios passed, gas within the baseline, profile written to " + PROFILE)
+    return 0
+
+
+# Compare the gas estimates of the entry points with the baseline. Returns the list of differences.
+# @gas – entry point -> static gas estimate (milligas)
+# @baseline – benchmark.json
+#
+def check_gas(gas, baseline):
+    errors = []
+    for (name, value) in sorted(gas.items()):
+        expected = baseline.get(name, {}).get("gas")
+        if expected is None:
+            errors.append("%s: no gas baseline in %s (record it with --record)" % (name, BENCHMARK))
+        elif abs(value - expected) > expected * GAS_TOLERANCE:
+            errors.append("%s: gas %d, baseline %d" % (name, value, expected))
+    return errors
+
+
+if __name__ == "__main__":
+    sys.exit(main())
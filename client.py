@@ -0,0 +1,840 @@
+import argparse
+import asyncio
+import copy
+import hashlib
+import json
+import math
+import ssl
+import sys
+import time as timer
+import urllib.parse
+
+import micheline
+from errors import CODES as ERROR_CODES, MESSAGES as ERROR_MESSAGES
+from micheline import t
+
+import model
+
+
+#########################################################################################################
+# Asynchronous client of the Opus entry points.                                                         #
+#                                                                                                       #
+# Calls are queued and packed into one operation group per block: the group is simulated once to get   #
+# the gas and storage limits of all the calls, forged, signed and injected, then the client waits for  #
+# its inclusion (the source counter moving past it) and sends the calls queued meanwhile as the next  #
+# group. A source can have only one operation in the mempool, so batching is what makes more calls   #
+# per block possible. A call failing in the simulation is rejected alone and the rest of the group is  #
+# resent. The queue is bounded: call() waits while it's full (backpressure).                          #
+# RPC requests go through a pool of keep-alive HTTP connections. The bytes forged by the node are      #
+# compared with the operation group forged locally before they are signed (see Client.forge).         #
+#                                                                                                       #
+# The source account has to be revealed. Signing is done by a Signer (e.g. RemoteSigner for a signer  #
+# service or a hardware wallet bridge).                                                                 #
+#                                                                                                       #
+# Run "python3 client.py --mock" to fund loan requests through a local mock node (see MockNode).       #
+#########################################################################################################
+
+LOAN_FIELDS = [("token", t("string")), ("token_address", t("address")), ("amount", t("nat")), ("reward", t("nat")),
+    ("deposit", t("mutez")), ("time", t("nat")), ("validity", t("option", t("timestamp")))]
+# add_loan_after and add_loans take the "prev" hint too
+HINTED_LOAN_FIELDS = LOAN_FIELDS + [("prev", t("option", t("nat")))]
+
+# Parameter types of the user entry points (SmartPy layout), a single field record is the annotated field type.
+ENTRY_POINTS = {
+    "add_loan" : micheline.record_type(LOAN_FIELDS),
+    "add_loan_after" : micheline.record_type(HINTED_LOAN_FIELDS),
+    "add_loans" : dict(t("list", micheline.record_type(HINTED_LOAN_FIELDS)), annots = ["%loans"]),
+    "cancel_loan" : dict(t("nat"), annots = ["%id"]),
+    "make_deal" : dict(t("nat"), annots = ["%id"]),
+    "make_deals" : dict(t("list", t("nat")), annots = ["%ids"]),
+    "fill_best" : micheline.record_type([("token", t("string")), ("max_amount", t("nat")), ("min_reward_rate", t("nat"))]),
+    "close_deal" : dict(t("nat"), annots = ["%id"]),
+    "close_deals" : dict(t("list", t("nat")), annots = ["%ids"]),
+}
+# Actions of the signed permits (see relay).
+ACTION_TYPE = micheline.variant_type([("cancel_loan", t("nat")), ("make_deal", t("nat")), ("close_deal", t("nat"))])
+ENTRY_POINTS["relay"] = dict(t("list", micheline.record_type([("key", t("key")), ("signature", t("signature")), ("expiry", t("timestamp")),
+    ("action", ACTION_TYPE)])), annots = ["%permits"])
+ENTRY_POINTS["increment_nonce"] = dict(t("nat"), annots = ["%nonce"])
+# Parameter types of the views the client runs.
+VIEWS = {
+    "get_nonce" : t("address"),
+    "get_book_prev" : micheline.record_type([("token", t("nat")), ("reward", t("nat")), ("amount", t("nat"))]),
+}
+# Type of the signed data of a permit: ((chain ID, contract address), ((nonce, expiry), action)).
+PERMIT_DATA_TYPE = t("pair", t("pair", t("chain_id"), t("address")), t("pair", t("pair", t("nat"), t("timestamp")), ACTION_TYPE))
+# default lifetime of the signed permits in seconds
+PERMIT_LIFETIME = 3600
+
+# base58 prefixes of the signatures returned by the signers
+SIGNATURE_PREFIXES = {
+    "edsig" : bytes([9, 245, 205, 134, 18]),
+    "spsig1" : bytes([13, 115, 101, 19, 63]),
+    "p2sig" : bytes([54, 240, 44, 52]),
+    "sig" : bytes([4, 130, 43]),
+}
+
+# watermark of the signed manager operations, the packed data of the permits starts with its own (0x05)
+OPERATION_WATERMARK = b"\3"
+# base58 prefix of the block hashes (the branch of an operation group)
+BLOCK_HASH_PREFIX = bytes([1, 52])
+# tag of the transactions in a forged operation group
+TRANSACTION_TAG = 108
+# tags of the entry points with a reserved tag in a forged transaction, the others are forged by name
+ENTRY_POINT_TAGS = {"default" : 0, "root" : 1, "do" : 2, "set_delegate" : 3, "remove_delegate" : 4, "deposit" : 5}
+
+# fee = MINIMAL_FEE + gas * NANOTEZ_PER_GAS / 1000 + bytes * NANOTEZ_PER_BYTE / 1000 (the default node filter)
+MINIMAL_FEE = 100
+NANOTEZ_PER_GAS = 100
+NANOTEZ_PER_BYTE = 1000
+
+GAS_MARGIN = 100
+STORAGE_MARGIN = 20
+# bytes of the forged operation group per call, added to the estimated size to cover the fee changes
+SIZE_MARGIN = 10
+# bytes of the signature
+SIGNATURE_SIZE = 64
+
+
+class RPCError(Exception):
+    def __init__(self, status, body):
+        super().__init__("HTTP %d: %s" % (status, body[:500]))
+        self.status = status
+        self.body = body
+
+
+# The error of a call rejected by the contract, message is the contract error (e.g. "OD_ILLEGAL_ARGUMENT:id").
+#
+class CallError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+# The error of an operation group forged by the node differently from the client (see Client.forge).
+#
+class ForgeError(Exception):
+    pass
+
+
+# Encode entry point parameters: a dict of the record fields (or the field value for a single field record).
+#
+def encode_params(entry_point, params):
+    type = ENTRY_POINTS[entry_point]
+    if type["prim"] != "pair" and isinstance(params, dict):
+        params = params[micheline.field(type)]
+    return micheline.encode(type, params)
+
+
+def decode_params(entry_point, value):
+    type = ENTRY_POINTS[entry_point]
+    params = micheline.decode(type, value)
+    return params if type["prim"] == "pair" else {micheline.field(type) : params}
+
+
+
+# Binary form of an operation group of transactions, as signed and injected (without the signature).
+# @branch – block hash
+# @contents – transactions (see Client.contents)
+#
+def forge_operation(branch, contents):
+    return micheline.b58check_decode(branch)[len(BLOCK_HASH_PREFIX):] + b"".join(forge_transaction(content) for content in contents)
+
+
+def forge_transaction(content):
+    if content["kind"] != "transaction":
+        raise ValueError("unsupported operation: " + content["kind"])
+    entry_point = content["parameters"]["entrypoint"]
+    if entry_point in ENTRY_POINT_TAGS:
+        tag = bytes([ENTRY_POINT_TAGS[entry_point]])
+    else:
+        tag = b"\xff" + bytes([len(entry_point)]) + entry_point.encode()
+    return bytes([TRANSACTION_TAG]) + micheline.address_to_bytes(content["source"])[1:] + \
+        b"".join(micheline.forge_nat(int(content[field])) for field in ("fee", "counter", "gas_limit", "storage_limit", "amount")) + \
+        micheline.address_to_bytes(content["destination"]) + b"\xff" + tag + micheline.forge_bytes(micheline.forge(content["parameters"]["value"]))
+
+
+
+#########################################################################################################
+# HTTP                                                                                                  #
+#########################################################################################################
+
+# HTTP/1.1 keep-alive connection.
+#
+class Connection:
+    def __init__(self, reader, writer, host):
+        self.reader = reader
+        self.writer = writer
+        self.host = host
+
+    async def request(self, method, path, body = None):
+        data = b"" if body is None else json.dumps(body).encode()
+        self.writer.write(("%s %s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % (
+            method, path, self.host, len(data))).encode() + data)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = (await self.reader.readline()).decode().strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding") == "chunked":
+            body = b""
+            while True:
+                size = int((await self.reader.readline()).split(b";")[0], 16)
+                chunk = await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                body += chunk[:-2]
+        else:
+            body = await self.reader.readexactly(int(headers.get("content-length", "0")))
+        if status >= 400:
+            raise RPCError(status, body.decode(errors = "replace"))
+        return json.loads(body) if body else None
+
+    def close(self):
+        self.writer.close()
+
+
+# Pool of connections to an RPC node.
+# @url – node URL
+# @size – maximum number of open connections
+#
+class Pool:
+    def __init__(self, url, size = 4):
+        url = urllib.parse.urlsplit(url)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == "https" else 80)
+        self.ssl = ssl.create_default_context() if url.scheme == "https" else None
+        self.prefix = url.path.rstrip("/")
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+
+    async def request(self, method, path, body = None):
+        async with self.slots:
+            connection = self.idle.pop() if self.idle else None
+            if connection is None:
+                (reader, writer) = await asyncio.open_connection(self.host, self.port, ssl = self.ssl)
+                connection = Connection(reader, writer, self.host)
+            try:
+                result = await connection.request(method, self.prefix + path, body)
+            except RPCError:
+                self.idle.append(connection)
+                raise
+            except BaseException:
+                connection.close()
+                raise
+            self.idle.append(connection)
+            return result
+
+    async def get(self, path):
+        return await self.request("GET", path)
+
+    async def post(self, path, body):
+        return await self.request("POST", path, body)
+
+    def close(self):
+        for connection in self.idle:
+            connection.close()
+        self.idle = []
+
+
+
+#########################################################################################################
+# Signers                                                                                               #
+#########################################################################################################
+
+# Signer interface: address of the account, sign(bytes) returning the raw signature (64 bytes) and the public key.
+#
+class Signer:
+    address = None
+
+    async def sign(self, data, watermark = OPERATION_WATERMARK):
+        raise NotImplementedError
+
+    async def public_key(self):
+        raise NotImplementedError
+
+
+# Signer service with the Tezos remote signer protocol (POST /keys/<address>, e.g. tezos-signer or Signatory).
+# @url – signer URL
+# @address – address of the signing key
+#
+class RemoteSigner(Signer):
+    def __init__(self, url, address, pool_size = 2):
+        self.address = address
+        self.pool = Pool(url, pool_size)
+
+    async def sign(self, data, watermark = OPERATION_WATERMARK):
+        signature = (await self.pool.post("/keys/" + self.address, (watermark + data).hex()))["signature"]
+        for prefix, raw in sorted(SIGNATURE_PREFIXES.items(), key = lambda item: -len(item[0])):
+            if signature.startswith(prefix):
+                return micheline.b58check_decode(signature)[len(raw):]
+        raise ValueError("unsupported signature: " + signature)
+
+    async def public_key(self):
+        return (await self.pool.get("/keys/" + self.address))["public_key"]
+
+
+
+#########################################################################################################
+# Client                                                                                                #
+#########################################################################################################
+
+class Call:
+    __slots__ = ("entry_point", "params", "amount", "future", "gas", "storage")
+
+    def __init__(self, entry_point, params, amount, future):
+        self.entry_point = entry_point
+        self.params = params
+        self.amount = amount
+        self.future = future
+        self.gas = 0
+        self.storage = 0
+
+
+# Client of one contract for one source account.
+# @rpc – node URL
+# @contract – Opus contract address
+# @signer – Signer of the source account
+# @pool_size – number of RPC connections
+# @max_batch – maximum number of calls in an operation group
+# @max_pending – maximum number of queued calls, call() waits while the queue is full
+# @poll – seconds between the inclusion checks
+#
+class Client:
+    def __init__(self, rpc, contract, signer, pool_size = 4, max_batch = 50, max_pending = 500, poll = 1.0, timeout = 180):
+        self.pool = Pool(rpc, pool_size)
+        self.contract = contract
+        self.signer = signer
+        self.max_batch = max_batch
+        self.poll = poll
+        self.timeout = timeout
+        self.queue = asyncio.Queue(max_pending)
+        self.counter = None
+        self.constants = None
+        self.chain_id = None
+        self.task = None
+
+    async def start(self):
+        (self.constants, self.chain_id) = await asyncio.gather(self.pool.get("/chains/main/blocks/head/context/constants"),
+            self.pool.get("/chains/main/chain_id"))
+        self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions = True)
+        self.pool.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # Call an entry point. Returns the hash of the operation group once it's included in a block,
+    # raises CallError if the contract rejects the call.
+    # @params – parameters (see encode_params)
+    # @amount – tezos amount in mutez
+    #
+    async def call(self, entry_point, params, amount = 0):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(Call(entry_point, params, amount, future))
+        return await future
+
+    async def add_loan(self, loan, amount):
+        return await self.call("add_loan", loan, amount)
+
+    async def add_loan_after(self, loan, amount):
+        return await self.call("add_loan_after", loan, amount)
+
+    async def make_deal(self, id):
+        return await self.call("make_deal", id)
+
+    async def close_deal(self, id):
+        return await self.call("close_deal", id)
+
+    async def cancel_loan(self, id):
+        return await self.call("cancel_loan", id)
+
+    # Execute permits of other accounts (see permit) as one call, the source pays the fees.
+    #
+    async def relay(self, permits):
+        return await self.call("relay", permits)
+
+    # Sign a permit of an action of another account for relay.
+    # @signer – Signer of the account
+    # @action – (entry point, ID) pair: ("cancel_loan" | "make_deal" | "close_deal", loan request / credit deal ID)
+    # @nonce – nonce of the permit, the account's current one if None (permits of an account are used in the nonce order)
+    # @expiry – time the permit can't be used from (seconds), PERMIT_LIFETIME from now if None
+    #
+    async def permit(self, signer, action, nonce = None, expiry = None):
+        if nonce is None:
+            nonce = await self.get_nonce(signer.address)
+        if expiry is None:
+            expiry = int(timer.time()) + PERMIT_LIFETIME
+        data = micheline.encode(PERMIT_DATA_TYPE, (self.chain_id, self.contract, nonce, expiry, action))
+        packed = await self.pool.post("/chains/main/blocks/head/helpers/scripts/pack_data", {"data" : data, "type" : PERMIT_DATA_TYPE})
+        signature = await signer.sign(bytes.fromhex(packed["packed"]), watermark = b"")
+        return {"key" : await signer.public_key(), "signature" : micheline.b58check_encode(SIGNATURE_PREFIXES["sig"] + signature),
+            "expiry" : expiry, "action" : action}
+
+    # Move the source's permit nonce forward, the permits it signed with lower nonces can't be used anymore.
+    #
+    async def increment_nonce(self, nonce):
+        return await self.call("increment_nonce", nonce)
+
+    # Nonce of the next permit of an account (the get_nonce view).
+    #
+    async def get_nonce(self, address):
+        return int((await self.view("get_nonce", address))["int"])
+
+    # The "prev" hint of add_loan_after (the get_book_prev view), the place of the request is looked for from
+    # the hint, so it stays cheap to add however many loan requests of the token there are. The view fails (RPCError)
+    # if the place is more than MAX_BOOK_WALK loan requests from the start of the list.
+    # @token – token ID
+    #
+    async def get_book_prev(self, token, reward, amount):
+        return int((await self.view("get_book_prev", {"token" : token, "reward" : reward, "amount" : amount}))["int"])
+
+    # Run a view of the contract. Returns the Micheline result.
+    # @params – parameters (see VIEWS)
+    #
+    async def view(self, name, params):
+        result = await self.pool.post("/chains/main/blocks/head/helpers/scripts/run_script_view", {"contract" : self.contract,
+            "view" : name, "input" : micheline.encode(VIEWS[name], params), "chain_id" : self.chain_id, "unparsing_mode" : "Readable"})
+        return result["data"]
+
+    async def run(self):
+        while True:
+            calls = [await self.queue.get()]
+            while len(calls) < self.max_batch and not self.queue.empty():
+                calls.append(self.queue.get_nowait())
+            try:
+                await self.submit(calls)
+            except Exception as e:
+                # the counter is reloaded before the next group
+                self.counter = None
+                for call in calls:
+                    if not call.future.done():
+                        call.future.set_exception(e)
+
+    # Simulate, sign and inject calls as one operation group and wait for its inclusion.
+    # The calls rejected in the simulation fail, the others are simulated again without them.
+    #
+    async def submit(self, calls):
+        while calls:
+            if self.counter is None:
+                self.counter = int(await self.pool.get("/chains/main/blocks/head/context/contracts/%s/counter" % self.signer.address))
+            branch = await self.pool.get("/chains/main/blocks/head/hash")
+            failed = await self.simulate(branch, calls)
+            if failed is None:
+                break
+            (call, message) = failed
+            call.future.set_exception(CallError(message))
+            calls = [c for c in calls if c is not call]
+        if not calls:
+            return
+        contents = self.contents(calls, [0] * len(calls))
+        size = len(await self.forge(branch, contents)) + SIGNATURE_SIZE
+        fees = [MINIMAL_FEE * (i == 0) + math.ceil(call.gas * NANOTEZ_PER_GAS / 1000 + (size / len(calls) + SIZE_MARGIN) * NANOTEZ_PER_BYTE / 1000)
+            for (i, call) in enumerate(calls)]
+        forged = await self.forge(branch, self.contents(calls, fees))
+        signature = await self.signer.sign(forged)
+        hash = await self.pool.post("/injection/operation", (forged + signature).hex())
+        last = self.counter + len(calls)
+        self.counter = last
+        await self.wait(last)
+        for call in calls:
+            call.future.set_result(hash)
+
+    # Run the operation group with the maximum limits and set the consumed gas and storage of the calls.
+    # Returns the first rejected call and its error message, or None.
+    #
+    async def simulate(self, branch, calls):
+        gas = min(int(self.constants["hard_gas_limit_per_operation"]), int(self.constants["hard_gas_limit_per_block"]) // len(calls))
+        storage = int(self.constants["hard_storage_limit_per_operation"])
+        contents = [dict(content, gas_limit = str(gas), storage_limit = str(storage)) for content in self.contents(calls, [0] * len(calls))]
+        result = await self.pool.post("/chains/main/blocks/head/helpers/scripts/run_operation", {
+            "operation" : {"branch" : branch, "contents" : contents, "signature" : micheline.b58check_encode(SIGNATURE_PREFIXES["sig"] + bytes(64))},
+            "chain_id" : self.chain_id})
+        for (call, content) in zip(calls, result["contents"]):
+            metadata = content["metadata"]
+            results = [metadata["operation_result"]] + [internal["result"] for internal in metadata.get("internal_operation_results", [])]
+            if results[0]["status"] == "failed":
+                return (call, rejection(results[0].get("errors", [])))
+            call.gas = math.ceil(sum(int(r.get("consumed_milligas", "0")) for r in results) / 1000) + GAS_MARGIN
+            call.storage = sum(int(r.get("paid_storage_size_diff", "0")) for r in results) + STORAGE_MARGIN
+        return None
+
+    def contents(self, calls, fees):
+        return [{
+            "kind" : "transaction",
+            "source" : self.signer.address,
+            "fee" : str(fee),
+            "counter" : str(self.counter + i + 1),
+            "gas_limit" : str(call.gas),
+            "storage_limit" : str(call.storage),
+            "amount" : str(call.amount),
+            "destination" : self.contract,
+            "parameters" : {"entrypoint" : call.entry_point, "value" : encode_params(call.entry_point, call.params)}
+        } for (i, (call, fee)) in enumerate(zip(calls, fees))]
+
+    # Forge an operation group. The bytes forged by the node are signed only if they are the ones forged locally,
+    # so a node can't get a different operation signed.
+    #
+    async def forge(self, branch, contents):
+        forged = bytes.fromhex(await self.pool.post("/chains/main/blocks/head/helpers/forge/operations", {"branch" : branch, "contents" : contents}))
+        if forged != forge_operation(branch, contents):
+            raise ForgeError("the operation group forged by the node doesn't match the calls: " + forged.hex())
+        return forged
+
+    # Wait until the source counter reaches the given value (the operation group is included).
+    #
+    async def wait(self, counter):
+        deadline = timer.monotonic() + self.timeout
+        while int(await self.pool.get("/chains/main/blocks/head/context/contracts/%s/counter" % self.signer.address)) < counter:
+            if timer.monotonic() > deadline:
+                raise TimeoutError("operation group with counter %d is not included" % counter)
+            await asyncio.sleep(self.poll)
+
+
+# Error message of a rejected contract call (the FAILWITH value, the number of a compact_errors build is
+# mapped back to its message, see errors.py), or the error IDs.
+#
+def rejection(errors):
+    for error in errors:
+        if "with" in error:
+            value = error["with"]
+            if "int" in value:
+                return ERROR_MESSAGES.get(int(value["int"]), value["int"])
+            return value.get("string", json.dumps(value))
+    return ", ".join(error.get("id", "?") for error in errors)
+
+
+
+#########################################################################################################
+# Offline testing.                                                                                      #
+# MockNode is a local HTTP node serving the RPC calls of the client. Operations are applied to the     #
+# reference model (model.py): run_operation simulates a group on a copy of it, injected groups go to  #
+# the mempool (one per source) and a block with the whole mempool is baked every block_time seconds.  #
+# Operations are forged in the binary form (forge_operation) and the node keeps the JSON of the ones   #
+# it forged to apply them when they are injected, the signatures aren't checked. "Packed" data is the  #
+# JSON of the value after the 0x05 byte, the permit signatures are the sha512 of it (MockSigner).      #
+#########################################################################################################
+
+MOCK_CONTRACT = "KT1PWx2mnDueood7fEmfbBDKx1D9BAnnXitn"
+MOCK_CONSTANTS = {"hard_gas_limit_per_operation" : "1040000", "hard_gas_limit_per_block" : "2600000", "hard_storage_limit_per_operation" : "60000"}
+# consumed milligas of a call in the mock node
+MOCK_GAS = 4_000_000
+MOCK_CHAIN_ID = "NetXmockmockmock"
+# public keys of the mock signers are the prefix and the address
+MOCK_KEY_PREFIX = "mockpk:"
+# the node forges the first call of a group with this much more tez if tamper is set
+MOCK_TAMPER_AMOUNT = 1_000_000
+# number of deals closed by relayed permits in mock_check
+RELAYED = 10
+
+
+# tz1 address of a model user.
+#
+def mock_address(user):
+    return micheline.b58check_encode(micheline.ADDRESS_PREFIXES["tz1"] + hashlib.sha256(user.encode()).digest()[:20])
+
+
+class MockSigner(Signer):
+    def __init__(self, address):
+        self.address = address
+
+    async def sign(self, data, watermark = OPERATION_WATERMARK):
+        return hashlib.sha512(watermark + data).digest()
+
+    async def public_key(self):
+        return MOCK_KEY_PREFIX + self.address
+
+
+class MockNode:
+    def __init__(self, block_time = 0.2, now = model.T0):
+        self.model = model.Opus(model.CREATOR, balance = 1000 * 1_000_000)
+        for (name, address) in model.TOKENS:
+            self.model.add_token(name, address, sender = model.CREATOR)
+        self.block_time = block_time
+        self.now = now
+        self.level = 1
+        self.counters = {}
+        self.mempool = {}
+        # level -> number of applied calls
+        self.blocks = {}
+        self.requests = 0
+        self.connections = 0
+        # forged operation (hex) -> operation
+        self.forged = {}
+        self.tamper = False
+        # if compact_errors is True, the calls fail with the numeric error codes (see errors.py)
+        self.compact_errors = False
+
+    async def start(self, port = 0):
+        self.server = await asyncio.start_server(self.serve, "127.0.0.1", port)
+        self.url = "http://127.0.0.1:%d" % self.server.sockets[0].getsockname()[1]
+        self.baker = asyncio.create_task(self.bake())
+        return self.url
+
+    async def stop(self):
+        self.baker.cancel()
+        self.server.close()
+        await asyncio.gather(self.baker, return_exceptions = True)
+
+    async def bake(self):
+        while True:
+            await asyncio.sleep(self.block_time)
+            self.level += 1
+            self.now += 15
+            applied = 0
+            for (source, contents) in self.mempool.items():
+                (_, trial) = self.apply(contents)
+                if trial is not None:
+                    self.model = trial
+                    applied += len(contents)
+                self.counters[source] = int(contents[-1]["counter"])
+            self.mempool = {}
+            self.blocks[self.level] = applied
+
+    # Apply the contents of an operation group to a copy of the model.
+    # Returns the results and the updated copy, or None if the group failed.
+    #
+    def apply(self, contents):
+        trial = copy.deepcopy(self.model)
+        results = []
+        for content in contents:
+            entry_point = content["parameters"]["entrypoint"]
+            params = decode_params(entry_point, content["parameters"]["value"])
+            if entry_point in ("add_loan", "add_loan_after"):
+                params = {"loan" : model.LoanSpec(**params)}
+            elif entry_point == "add_loans":
+                params = {"loans" : [model.LoanSpec(**loan) for loan in params["loans"]]}
+            elif entry_point == "relay":
+                params = {"permits" : self.permits(trial, params["permits"])}
+            if results and results[-1]["status"] != "applied":
+                results.append({"status" : "skipped"})
+                continue
+            try:
+                getattr(trial, entry_point)(sender = content["source"], now = self.now, amount = int(content["amount"]), **params)
+                results.append({"status" : "applied", "consumed_milligas" : str(MOCK_GAS), "paid_storage_size_diff" : "0"})
+            except model.OpusError as e:
+                value = {"int" : str(ERROR_CODES[e.message])} if self.compact_errors else {"string" : e.message}
+                results.append({"status" : "failed", "errors" : [{"kind" : "temporary", "id" : "proto.michelson_v1.script_rejected",
+                    "with" : value}]})
+        if results[-1]["status"] != "applied":
+            results = [dict(result, status = "backtracked") if result["status"] == "applied" else result for result in results]
+            return (results, None)
+        return (results, trial)
+
+    # Model permits (signer, nonce, expiry, action) of relay permits: the nonce is the one the signature is valid for,
+    # or -1 if it isn't valid for the current nonce of the signer.
+    #
+    def permits(self, trial, permits):
+        nonces = dict(trial.nonces)
+        result = []
+        for permit in permits:
+            signer = permit["key"][len(MOCK_KEY_PREFIX):]
+            nonce = nonces.get(signer, 0)
+            data = micheline.encode(PERMIT_DATA_TYPE, (MOCK_CHAIN_ID, MOCK_CONTRACT, nonce, permit["expiry"], permit["action"]))
+            signature = micheline.b58check_decode(permit["signature"])[len(SIGNATURE_PREFIXES["sig"]):]
+            if signature != hashlib.sha512(self.pack(data)).digest():
+                nonce = -1
+            nonces[signer] = nonce + 1
+            result.append((signer, nonce, permit["expiry"], permit["action"]))
+        return result
+
+    def pack(self, data):
+        return b"\5" + json.dumps(data, sort_keys = True).encode()
+
+    async def serve(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                (method, path, _) = line.decode().split(" ")
+                length = 0
+                while True:
+                    header = (await reader.readline()).decode().strip()
+                    if not header:
+                        break
+                    if header.lower().startswith("content-length:"):
+                        length = int(header.split(":")[1])
+                body = json.loads(await reader.readexactly(length)) if length else None
+                self.requests += 1
+                try:
+                    (status, result) = (200, self.handle(method, path, body))
+                except ValueError as e:
+                    (status, result) = (400, [{"kind" : "permanent", "id" : str(e)}])
+                data = json.dumps(result).encode()
+                writer.write(b"HTTP/1.1 %d OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n" % (status, len(data)) + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def handle(self, method, path, body):
+        if path == "/chains/main/chain_id":
+            return MOCK_CHAIN_ID
+        if path == "/chains/main/blocks/head/context/constants":
+            return MOCK_CONSTANTS
+        if path == "/chains/main/blocks/head/hash":
+            return micheline.b58check_encode(BLOCK_HASH_PREFIX + hashlib.sha256(b"%d" % self.level).digest())
+        if path == "/chains/main/blocks/head/header":
+            return {"level" : self.level}
+        if path.startswith("/chains/main/blocks/head/context/contracts/") and path.endswith("/counter"):
+            return str(self.counters.get(path.split("/")[-2], 0))
+        if path == "/chains/main/blocks/head/helpers/scripts/run_operation":
+            contents = body["operation"]["contents"]
+            (results, _) = self.apply(contents)
+            return {"contents" : [dict(content, metadata = {"operation_result" : result}) for (content, result) in zip(contents, results)]}
+        if path == "/chains/main/blocks/head/helpers/scripts/pack_data":
+            return {"packed" : self.pack(body["data"]).hex(), "gas" : "1000"}
+        if path == "/chains/main/blocks/head/helpers/scripts/run_script_view":
+            params = micheline.decode(VIEWS[body["view"]], body["input"])
+            if body["view"] == "get_nonce":
+                return {"data" : {"int" : str(self.model.nonces.get(params, 0))}}
+            try:
+                return {"data" : {"int" : str(self.model.get_book_prev(**params))}}
+            except model.OpusError:
+                raise ValueError("proto.michelson_v1.script_rejected")
+        if path == "/chains/main/blocks/head/helpers/forge/operations":
+            contents = body["contents"]
+            if self.tamper:
+                contents = [dict(contents[0], amount = str(int(contents[0]["amount"]) + MOCK_TAMPER_AMOUNT))] + contents[1:]
+            forged = forge_operation(body["branch"], contents).hex()
+            self.forged[forged] = dict(body, contents = contents)
+            return forged
+        if path == "/injection/operation":
+            operation = self.forged.get(body[:-2 * SIGNATURE_SIZE])
+            if operation is None:
+                raise ValueError("injection.invalid_operation")
+            contents = operation["contents"]
+            source = contents[0]["source"]
+            if source in self.mempool:
+                raise ValueError("prevalidation.operation_conflict")
+            if [int(content["counter"]) for content in contents] != list(range(self.counters.get(source, 0) + 1, self.counters.get(source, 0) + 1 + len(contents))):
+                raise ValueError("contract.counter_in_the_past")
+            self.mempool[source] = contents
+            return "oo" + hashlib.sha256(bytes.fromhex(body)).hexdigest()[:49]
+        raise ValueError("unknown path " + path)
+
+
+# Fund loan requests through a mock node: the borrowers add the requests concurrently, then one creditor
+# funds all of them and relays the permits of the borrowers to close the first ones. Returns the number of errors.
+#
+async def mock_check(loans, borrowers):
+    node = MockNode()
+    url = await node.start()
+    # the last user is the creditor
+    users = [mock_address(user) for user in model.USERS]
+    borrowers = min(borrowers, len(users) - 1)
+    clients = [Client(url, MOCK_CONTRACT, MockSigner(user), poll = 0.02) for user in users[:borrowers]]
+    creditor = Client(url, MOCK_CONTRACT, MockSigner(users[-1]), poll = 0.02)
+    try:
+        for client in clients + [creditor]:
+            await client.start()
+        (name, address) = model.TOKENS[0]
+        deposit = 1_000_000
+        time = 7 * 86400
+        # the requests of the same rate are added at the end of the list, so they don't need a "prev" hint
+        loan = {"token" : name, "token_address" : address, "amount" : 10, "reward" : 1, "deposit" : deposit, "time" : time, "validity" : None}
+        await asyncio.gather(*[clients[i % borrowers].add_loan(loan, deposit + model.service_fee(deposit, time, 100)) for i in range(loans)])
+        errors = 0
+        # a better rate goes to the start of the list, the view doesn't walk further than MAX_BOOK_WALK requests
+        errors += await creditor.get_book_prev(1, 2, 10) != 0
+        if loans > model.MAX_BOOK_WALK:
+            try:
+                await creditor.get_book_prev(1, 1, 10)
+                errors += 1
+            except RPCError:
+                pass
+        else:
+            errors += await creditor.get_book_prev(1, 1, 10) != loans
+        first = node.level
+        start = timer.perf_counter()
+        await asyncio.gather(*[creditor.make_deal(id) for id in range(1, loans + 1)])
+        blocks = node.level - first
+        elapsed = timer.perf_counter() - start
+        try:
+            await creditor.make_deal(1)
+            errors += 1
+        except CallError as e:
+            errors += e.message != model.ILLEGAL_ARGUMENT + ":id"
+        # the numeric error codes are mapped back to the messages
+        node.compact_errors = True
+        try:
+            await creditor.make_deal(1)
+            errors += 1
+        except CallError as e:
+            errors += e.message != model.ILLEGAL_ARGUMENT + ":id"
+        node.compact_errors = False
+        # the borrowers sign the permits, the creditor pays the fees
+        closed = min(loans, RELAYED)
+        nonces = {}
+        permits = []
+        for id in range(1, closed + 1):
+            borrower = node.model.loans[id].borrower
+            nonces[borrower] = nonces.get(borrower, 0) + 1
+            permits.append(await creditor.permit(MockSigner(borrower), ("close_deal", id), nonces[borrower] - 1))
+        await creditor.relay(permits)
+        try:
+            await creditor.relay(permits[:1])
+            errors += 1
+        except CallError as e:
+            errors += e.message != model.ILLEGAL_ARGUMENT + ":signature"
+        errors += sum(await asyncio.gather(*[creditor.get_nonce(borrower) for borrower in nonces])) != closed
+        # a permit signed before the signer moved its nonce forward can't be used
+        stale = await creditor.permit(MockSigner(users[0]), ("cancel_loan", 1))
+        await clients[0].increment_nonce(await clients[0].get_nonce(users[0]) + 2)
+        try:
+            await creditor.relay([stale])
+            errors += 1
+        except CallError as e:
+            errors += e.message != model.ILLEGAL_ARGUMENT + ":signature"
+        # an operation group the node forges with another amount isn't signed, the next group goes through
+        nonce = await creditor.get_nonce(users[-1])
+        node.tamper = True
+        try:
+            await creditor.increment_nonce(nonce + 1)
+            errors += 1
+        except ForgeError:
+            pass
+        node.tamper = False
+        await creditor.increment_nonce(nonce + 1)
+        errors += await creditor.get_nonce(users[-1]) != nonce + 1
+    finally:
+        for client in clients + [creditor]:
+            await client.close()
+        await node.stop()
+    node.model.check()
+    errors += len(node.model.index[model.DEAL]) != loans - closed
+    print("%d deals funded in %d blocks (%.1f per block, %.2fs), %d closed by relayed permits, %d RPC requests over %d connections" % (
+        loans, blocks, loans / max(blocks, 1), elapsed, closed, node.requests, node.connections))
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Opus client test")
+    parser.add_argument("--mock", action = "store_true", help = "fund loan requests through a local mock node")
+    parser.add_argument("--loans", type = int, default = 200)
+    parser.add_argument("--borrowers", type = int, default = 4)
+    args = parser.parse_args()
+    if not args.mock:
+        parser.error("only --mock is supported from the command line, use Client from python")
+    errors = asyncio.run(mock_check(args.loans, args.borrowers))
+    print("errors: %d" % errors)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,153 @@
 import smartpy as sp
 
+errors = sp.io.import_script_from_url("file:errors.py")
 
-# The enum used for the contract related errors.
+
+# The enum used for the contract related errors (the messages are defined in errors.py).
 #
 class Error:
 
     # The contract function is not accessible for the sender.
-    ACCESS_DENIED = "OD_ACCESS_DENIED"
+    ACCESS_DENIED = errors.ACCESS_DENIED
 
     # The corresponding argument value is invalid.
-    ILLEGAL_ARGUMENT = "OD_ILLEGAL_ARGUMENT"
+    ILLEGAL_ARGUMENT = errors.ILLEGAL_ARGUMENT
 
     # The corresponding transaction has incorrect tezos amount.
-    ILLEGAL_TX_AMOUNT = "OD_ILLEGAL_TX_AMOUNT"
+    ILLEGAL_TX_AMOUNT = errors.ILLEGAL_TX_AMOUNT
 
     # The contract is paused.
-    PAUSED = "OD_PAUSED"
+    PAUSED = errors.PAUSED
+
+    # There is no loan request matching the arguments.
+    NO_MATCH = errors.NO_MATCH
+
+
+
+# The numeric codes of the error messages in the builds with compact errors (see Opus compact_errors), the table
+# is shared with the off-chain tools in errors.py.
+#
+ERROR_CODES = errors.CODES
+
+
+
+# The enum used for the loan statuses.
+#
+class Status:
+
+    # The loan request is waiting for a creditor.
+    REQUEST = 0
+
+    # The loan request is funded, i.e. it is a credit deal.
+    DEAL = 1
+
+
+
+# The maximum number of IDs processed by one sweep call.
+#
+MAX_SWEEP = 100
+
+
+
+# The maximum number of loan requests fill_best looks through.
+#
+MAX_FILL = 100
+
+
+
+# The maximum number of loan requests a new loan request is moved past when it's inserted into the list of its token
+# (see book_add).
+#
+MAX_BOOK_WALK = 100
+
+
+
+# The maximum number of items a list page passes to find the place of a removed cursor item (see list_page).
+#
+MAX_LIST_WALK = 100
+
+
+
+# Reward rates are given in reward tokens per RATE_UNIT tokens of the loan amount.
+#
+RATE_UNIT = 1_000_000
+
+
+
+# The length of the buckets of the credit deal maturity histogram in seconds (see the "maturities" big map).
+#
+MATURITY_BUCKET = 86400
+
+
+
+# The type of the per-token totals of live loan requests or credit deals (see the "stats" big map).
+#
+TStats = sp.TRecord(
+    # number of loan requests / credit deals
+    count = sp.TNat,
+    # total amount of tokens
+    amount = sp.TNat,
+    # total reward in tokens
+    reward = sp.TNat,
+    # total deposit
+    deposit = sp.TMutez
+)
+
+
+
+# The type of the items of the FA2 "transfer" entry point parameter (see TZIP-12).
+#
+TFA2Tx = sp.TRecord(to_ = sp.TAddress, token_id = sp.TNat, amount = sp.TNat).layout(("to_", ("token_id", "amount")))
+TFA2Transfer = sp.TRecord(from_ = sp.TAddress, txs = sp.TList(TFA2Tx)).layout(("from_", "txs"))
+
+
+
+# The type of the nodes of the doubly linked lists with sequence numbers (see the "index" big map).
+#
+TNode = sp.TRecord(
+    # previous and next item IDs (0 at the ends)
+    prev = sp.TNat,
+    next = sp.TNat,
+    # sequence number of the item, the items of a list are in the order of their numbers (0 for the head of a list)
+    seq = sp.TNat
+)
+
+
+
+# The type of the list page cursors (see list_loans): the ID and the sequence number of the item to continue from.
+#
+TCursor = sp.TRecord(id = sp.TNat, seq = sp.TNat)
+
+
+
+# The type of the outcome of a closed credit deal (see the "deal_closed" event).
+#
+TOutcome = sp.TVariant(
+    # the borrower returned the tokens and got back the deposit
+    repaid = sp.TUnit,
+    # the deal timed out and the creditor got the deposit
+    liquidated = sp.TUnit
+)
+
+
+
+# The type of the actions of signed permits (see relay).
+#
+TAction = sp.TVariant(
+    # cancel a loan request (see cancel_loan)
+    cancel_loan = sp.TNat,
+    # make a credit deal (see make_deal)
+    make_deal = sp.TNat,
+    # close a credit deal (see close_deal)
+    close_deal = sp.TNat
+)
+
+
+
+# The type of signed permits: the signer's public key, the signature, the time the permit expires at and the action.
+# The signed bytes are the packed pair ((chain ID, contract address), ((signer's nonce, expiry), action)).
+#
+TPermit = sp.TRecord(key = sp.TKey, signature = sp.TSignature, expiry = sp.TTimestamp, action = TAction)
 
 
 
@@ -23,8 +155,15 @@ class Error:
 # The contract is a storage for p2p credit deals and provides service functionality to make such deals. #
 #########################################################################################################
 class Opus(sp.Contract):
-    def __init__(self, creator):
+    def __init__(self, creator, lazy_admin = False, compact_errors = False):
         self.creator = creator
+        # if compact_errors is True, the contract fails with the numeric codes of the errors (see ERROR_CODES)
+        self.compact_errors = compact_errors
+
+        # if lazy_admin is True, all the entry points except the user ones (loan requests and credit deals)
+        # are lazy: their code is kept in a big map and is loaded only when they are called
+        if lazy_admin:
+            self.add_flag("lazy-entry-points")
 
         self.init(
             # indicates that making of credit deals is disabled
@@ -34,11 +173,18 @@ class Opus(sp.Contract):
             # baker address or None
             baker = sp.none,
 
-            # list of admin addresses
-            admins = sp.set([creator]),
+            # admin addresses (a big map, so only the looked up entries are loaded)
+            admins = sp.big_map({creator : sp.unit}, tkey = sp.TAddress, tvalue = sp.TUnit),
 
-            # supported tokens (list of pairs: token name and token address)
-            tokens = sp.big_map(tkey = sp.TString, tvalue = sp.TAddress),
+            # supported tokens (token name -> token ID, token address and FA2 token ID or None for FA1.2 tokens)
+            tokens = sp.big_map(tkey = sp.TString, tvalue = sp.TRecord(id = sp.TNat, address = sp.TAddress, token_id = sp.TOption(sp.TNat))),
+
+            # registry of token IDs ever added (token ID -> token name, token address and FA2 token ID or None),
+            # loan requests and credit deals refer to tokens by ID
+            token_info = sp.big_map(tkey = sp.TNat, tvalue = sp.TRecord(name = sp.TString, address = sp.TAddress, token_id = sp.TOption(sp.TNat))),
+
+            # last token ID
+            ntoken = sp.nat(0),
 
             # time bounds for credit deals
             time = sp.record(min = sp.nat(7 * 86400), max = sp.nat(180 * 86400)),
@@ -52,14 +198,51 @@ class Opus(sp.Contract):
             # last loan request ID
             nloan = sp.nat(0),
 
-            # last credit deal ID
-            ndeal = sp.nat(0),
-
-            # map of loan requests (key is loan request ID)
-            loans = sp.big_map(),
-
-            # map of credit deals (key is credit deal ID)
-            deals = sp.big_map(),
+            # map of loan requests and credit deals (key is loan request ID),
+            # a funded loan request becomes a credit deal under the same ID
+            loans = sp.big_map(tkey = sp.TNat, tvalue = sp.TRecord(
+                status = sp.TNat,
+                ts = sp.TTimestamp,
+                borrower = sp.TAddress,
+                creditor = sp.TOption(sp.TAddress),
+                validity = sp.TOption(sp.TTimestamp),
+                exp = sp.TOption(sp.TTimestamp),
+                amount = sp.TNat,
+                token = sp.TNat,
+                time = sp.TNat,
+                reward = sp.TNat,
+                deposit = sp.TMutez,
+                fee = sp.TMutez
+            )),
+
+            # last sequence number of the items added to the lists (see TNode)
+            nseq = sp.nat(0),
+
+            # live loan requests and credit deals as two doubly linked lists in the order they were added,
+            # the key is the pair of the loan status and the loan request ID (ID 0 is the head of a list,
+            # it exists while the list is not empty)
+            index = sp.big_map(tkey = sp.TPair(sp.TNat, sp.TNat), tvalue = TNode),
+
+            # live loan requests of each token as doubly linked lists ordered by the reward rate (reward / amount),
+            # the best first and the equal rates in the order they were added; the key is the pair of the token ID
+            # and the loan request ID (ID 0 is the head of a list, it exists while the list is not empty)
+            book = sp.big_map(tkey = sp.TPair(sp.TNat, sp.TNat), tvalue = sp.TRecord(prev = sp.TNat, next = sp.TNat)),
+
+            # totals of live loan requests and credit deals of each token, the key is the pair of the token ID and
+            # the loan status (an entry exists while its count is not 0)
+            stats = sp.big_map(tkey = sp.TPair(sp.TNat, sp.TNat), tvalue = TStats),
+
+            # number and token amount of live credit deals by expiration, the key is the pair of the token ID and
+            # the expiration bucket (seconds since 1970-01-01 UTC // MATURITY_BUCKET, an entry exists while its count is not 0)
+            maturities = sp.big_map(tkey = sp.TPair(sp.TNat, sp.TNat), tvalue = sp.TRecord(count = sp.TNat, amount = sp.TNat)),
+
+            # live loan requests and credit deals of accounts (borrowers and creditors) as doubly linked lists in the order
+            # they were added, the key is the pair of the account address and the pair of the loan status and the loan
+            # request ID (ID 0 is the head of a list, it exists while the list is not empty)
+            positions = sp.big_map(tkey = sp.TPair(sp.TAddress, sp.TPair(sp.TNat, sp.TNat)), tvalue = TNode),
+
+            # number of permits used by each account, the nonce of its next permit (see relay)
+            nonces = sp.big_map(tkey = sp.TAddress, tvalue = sp.TNat),
 
             # amount of locked collateral
             deposits = sp.mutez(0)
@@ -68,7 +251,7 @@ class Opus(sp.Contract):
 
     # Support tezos transfer to the contract address
     #
-    @sp.entry_point
+    @sp.entry_point(lazify = False)
     def default(self):
         pass
 
@@ -81,9 +264,9 @@ class Opus(sp.Contract):
     def withdraw(self, params):
         sp.set_type(params.address, sp.TAddress)
         sp.set_type(params.amount, sp.TMutez)
-        sp.verify(self.data.admins.contains(sp.sender), message = Error.ACCESS_DENIED)
-        sp.verify(params.amount > sp.mutez(0), message = Error.ILLEGAL_ARGUMENT + ":amount")
-        sp.verify((sp.balance - self.data.deposits) >= params.amount, message = Error.ILLEGAL_ARGUMENT + ":amount")
+        sp.verify(self.data.admins.contains(sp.sender), message = self.error(Error.ACCESS_DENIED))
+        sp.verify(params.amount > sp.mutez(0), message = self.error(Error.ILLEGAL_ARGUMENT + ":amount"))
+        sp.verify((sp.balance - self.data.deposits) >= params.amount, message = self.error(Error.ILLEGAL_ARGUMENT + ":amount"))
         sp.send(params.address, params.amount)
 
 
@@ -93,10 +276,10 @@ class Opus(sp.Contract):
     @sp.entry_point
     def add_admin(self, params):
         sp.set_type(params.address, sp.TAddress)
-        sp.verify(sp.amount == sp.mutez(0), message = Error.ILLEGAL_TX_AMOUNT)
-        sp.verify(self.data.admins.contains(sp.sender), message = Error.ACCESS_DENIED)
-        sp.verify(~self.data.admins.contains(params.address), message = Error.ILLEGAL_ARGUMENT + ":address")
-        self.data.admins.add(params.address)
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        sp.verify(self.data.admins.contains(sp.sender), message = self.error(Error.ACCESS_DENIED))
+        sp.verify(~self.data.admins.contains(params.address), message = self.error(Error.ILLEGAL_ARGUMENT + ":address"))
+        self.data.admins[params.address] = sp.unit
 
 
     # (Admins only) Remove an admin address from the list of admin addresses.
@@ -105,11 +288,11 @@ class Opus(sp.Contract):
     @sp.entry_point
     def remove_admin(self, params):
         sp.set_type(params.address, sp.TAddress)
-        sp.verify(sp.amount == sp.mutez(0), message = Error.ILLEGAL_TX_AMOUNT)
-        sp.verify(self.data.admins.contains(sp.sender), message = Error.ACCESS_DENIED)
-        sp.verify(self.creator != params.address, message = Error.ILLEGAL_ARGUMENT + ":address")
-        sp.verify(self.data.admins.contains(params.address), message = Error.ILLEGAL_ARGUMENT + ":address")
-        self.data.admins.remove(params.address)
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        sp.verify(self.data.admins.contains(sp.sender), message = self.error(Error.ACCESS_DENIED))
+        sp.verify(self.creator != params.address, message = self.error(Error.ILLEGAL_ARGUMENT + ":address"))
+        sp.verify(self.data.admins.contains(params.address), message = self.error(Error.ILLEGAL_ARGUMENT + ":address"))
+        del self.data.admins[params.address]
 
 
     # (Admins only) Disable/enable making of new loan requests and new deals.
@@ -118,9 +301,9 @@ class Opus(sp.Contract):
     @sp.entry_point
     def pause(self, params):
         sp.set_type(params.pause, sp.TBool)
-        sp.verify(sp.amount == sp.mutez(0), message = Error.ILLEGAL_TX_AMOUNT)
-        sp.verify(self.data.admins.contains(sp.sender), message = Error.ACCESS_DENIED)
-        sp.verify(self.data.pause != params.pause, message = Error.ILLEGAL_ARGUMENT + ":pause")
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        sp.verify(self.data.admins.contains(sp.sender), message = self.error(Error.ACCESS_DENIED))
+        sp.verify(self.data.pause != params.pause, message = self.error(Error.ILLEGAL_ARGUMENT + ":pause"))
         self.data.pause = params.pause
 
 
@@ -130,35 +313,43 @@ class Opus(sp.Contract):
     @sp.entry_point
     def delegate(self, params):
         sp.set_type(params.baker, sp.TOption(sp.TKeyHash))
-        sp.verify(sp.amount == sp.mutez(0), message = Error.ILLEGAL_TX_AMOUNT)
-        sp.verify(self.data.admins.contains(sp.sender), message = Error.ACCESS_DENIED)
-        sp.verify(self.data.baker != params.baker, message = Error.ILLEGAL_ARGUMENT + ":baker")
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        sp.verify(self.data.admins.contains(sp.sender), message = self.error(Error.ACCESS_DENIED))
+        sp.verify(self.data.baker != params.baker, message = self.error(Error.ILLEGAL_ARGUMENT + ":baker"))
         self.data.baker = params.baker
         sp.set_delegate(params.baker)
 
 
     # (Admins only) Add supported token.
+    # A new token ID is registered unless the token is already supported with the same address and FA2 token ID.
     # @params.name – token name
     # @params.address – token address
+    # @params.token_id – FA2 token ID or None for an FA1.2 token
     #
     @sp.entry_point
     def add_token(self, params):
         sp.set_type(params.name, sp.TString)
         sp.set_type(params.address, sp.TAddress)
-        sp.verify(sp.amount == sp.mutez(0), message = Error.ILLEGAL_TX_AMOUNT)
-        sp.verify(self.data.admins.contains(sp.sender), message = Error.ACCESS_DENIED)
-        self.data.tokens[params.name] = params.address
+        sp.set_type(params.token_id, sp.TOption(sp.TNat))
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        sp.verify(self.data.admins.contains(sp.sender), message = self.error(Error.ACCESS_DENIED))
+        token = sp.local("token", self.data.tokens.get(params.name, sp.record(id = 0, address = params.address, token_id = params.token_id)))
+        sp.if (token.value.id == 0) | (token.value.address != params.address) | (token.value.token_id != params.token_id):
+            self.data.ntoken += 1
+            self.data.token_info[self.data.ntoken] = sp.record(name = params.name, address = params.address, token_id = params.token_id)
+            self.data.tokens[params.name] = sp.record(id = self.data.ntoken, address = params.address, token_id = params.token_id)
 
 
     # (Admins only) Remove supported token.
+    # Existing loan requests and credit deals with the token are not affected.
     # @params.name – token name
     #
     @sp.entry_point
     def remove_token(self, params):
         sp.set_type(params.name, sp.TString)
-        sp.verify(sp.amount == sp.mutez(0), message = Error.ILLEGAL_TX_AMOUNT)
-        sp.verify(self.data.admins.contains(sp.sender), message = Error.ACCESS_DENIED)
-        sp.verify(self.data.tokens.contains(params.name), message = Error.ILLEGAL_ARGUMENT + ":name")
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        sp.verify(self.data.admins.contains(sp.sender), message = self.error(Error.ACCESS_DENIED))
+        sp.verify(self.data.tokens.contains(params.name), message = self.error(Error.ILLEGAL_ARGUMENT + ":name"))
         del self.data.tokens[params.name]
 
 
@@ -168,10 +359,10 @@ class Opus(sp.Contract):
     @sp.entry_point
     def set_fee(self, params):
         sp.set_type(params.fee, sp.TNat)
-        sp.verify(sp.amount == sp.mutez(0), message = Error.ILLEGAL_TX_AMOUNT)
-        sp.verify(self.data.admins.contains(sp.sender), message = Error.ACCESS_DENIED)
-        sp.verify(self.data.fee != params.fee, message = Error.ILLEGAL_ARGUMENT + ":fee")
-        sp.verify(params.fee < 10000, message = Error.ILLEGAL_ARGUMENT + ":fee")
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        sp.verify(self.data.admins.contains(sp.sender), message = self.error(Error.ACCESS_DENIED))
+        sp.verify(self.data.fee != params.fee, message = self.error(Error.ILLEGAL_ARGUMENT + ":fee"))
+        sp.verify(params.fee < 10000, message = self.error(Error.ILLEGAL_ARGUMENT + ":fee"))
         self.data.fee = params.fee
 
 
@@ -181,9 +372,9 @@ class Opus(sp.Contract):
     @sp.entry_point
     def set_min_deposit(self, params):
         sp.set_type(params.min_deposit, sp.TMutez)
-        sp.verify(sp.amount == sp.mutez(0), message = Error.ILLEGAL_TX_AMOUNT)
-        sp.verify(self.data.admins.contains(sp.sender), message = Error.ACCESS_DENIED)
-        sp.verify(self.data.min_deposit != params.min_deposit, message = Error.ILLEGAL_ARGUMENT + ":min_deposit")
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        sp.verify(self.data.admins.contains(sp.sender), message = self.error(Error.ACCESS_DENIED))
+        sp.verify(self.data.min_deposit != params.min_deposit, message = self.error(Error.ILLEGAL_ARGUMENT + ":min_deposit"))
         self.data.min_deposit = params.min_deposit
 
 
@@ -194,10 +385,10 @@ class Opus(sp.Contract):
     @sp.entry_point
     def set_time(self, params):
         sp.set_type(params, sp.TRecord(min = sp.TNat, max = sp.TNat))
-        sp.verify(sp.amount == sp.mutez(0), message = Error.ILLEGAL_TX_AMOUNT)
-        sp.verify(self.data.admins.contains(sp.sender), message = Error.ACCESS_DENIED)
-        sp.verify(self.data.time != params, message = Error.ILLEGAL_ARGUMENT + ":min,max")
-        sp.verify((params.min > 0) & (params.min <= params.max), message = Error.ILLEGAL_ARGUMENT + ":min")
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        sp.verify(self.data.admins.contains(sp.sender), message = self.error(Error.ACCESS_DENIED))
+        sp.verify(self.data.time != params, message = self.error(Error.ILLEGAL_ARGUMENT + ":min,max"))
+        sp.verify((params.min > 0) & (params.min <= params.max), message = self.error(Error.ILLEGAL_ARGUMENT + ":min"))
         self.data.time = params
 
 
@@ -210,9 +401,392 @@ class Opus(sp.Contract):
     # @params.deposit – deposit amount, the sender has to send the same amount of tezos
     # @params.time – credit deal duration in seconds
     # @params.validity – loan request expire date or None
+    # The place of the request in the list of its token is looked for from the end of the list, see add_loan_after.
     #
-    @sp.entry_point
+    @sp.entry_point(lazify = False)
     def add_loan(self, params):
+        sp.verify(~self.data.pause, message = self.error(Error.PAUSED))
+        loan = sp.record(token = params.token, token_address = params.token_address, amount = params.amount, reward = params.reward,
+            deposit = params.deposit, time = params.time, validity = params.validity, prev = sp.none)
+        sp.verify(sp.amount == self.create_loan(loan), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+
+
+    # Create a new loan request at a known place of the list of its token.
+    # Same as add_loan, the record has one more field:
+    # @params.prev – ID of a loan request of the same token with a reward rate not lower than this one (see get_book_prev),
+    #                0 for the start of the list, or None to look for the place from the end of the list
+    #
+    @sp.entry_point(lazify = False)
+    def add_loan_after(self, params):
+        sp.verify(~self.data.pause, message = self.error(Error.PAUSED))
+        sp.verify(sp.amount == self.create_loan(params), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+
+
+    # Create several loan requests at once, the whole batch is rejected if any of the requests is invalid.
+    # The corresponding transaction amount has to include deposits and service fees of all the requests.
+    # @params.loans – list of loan requests (see add_loan_after)
+    #
+    @sp.entry_point(lazify = False)
+    def add_loans(self, params):
+        sp.verify(~self.data.pause, message = self.error(Error.PAUSED))
+        total = sp.local("total", sp.mutez(0))
+        sp.for loan in params.loans:
+            total.value += self.create_loan(loan)
+        sp.verify(sp.amount == total.value, message = self.error(Error.ILLEGAL_TX_AMOUNT))
+
+
+    # Cancel sender's loan request, deposit and fee of the loan are returned to the sender.
+    # @params.id – loan request ID
+    #
+    @sp.entry_point(lazify = False)
+    def cancel_loan(self, params):
+        sp.set_type(params.id, sp.TNat)
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        self.revoke_loan(params.id, sp.sender)
+
+
+    # Make a credit deal, the sender has to approve the corresponding token transfer early.
+    # @params.id – loan request ID
+    #
+    @sp.entry_point(lazify = False)
+    def make_deal(self, params):
+        sp.verify(~self.data.pause, message = self.error(Error.PAUSED))
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        transfers = self.new_transfers()
+        self.create_deal(params.id, sp.sender, transfers)
+        self.send_transfers(transfers)
+
+
+    # Make several credit deals at once, the whole batch is rejected if any of the deals can't be made.
+    # FA2 token transfers are sent as one batch per token contract.
+    # @params.ids – list of loan request IDs
+    #
+    @sp.entry_point(lazify = False)
+    def make_deals(self, params):
+        sp.verify(~self.data.pause, message = self.error(Error.PAUSED))
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        transfers = self.new_transfers()
+        sp.for id in params.ids:
+            self.create_deal(id, sp.sender, transfers)
+        self.send_transfers(transfers)
+
+
+    # Make a credit deal with the loan request of a token with the best reward rate (reward / amount) among
+    # the requests the sender can fund: the amount is not greater than max_amount, the request is not expired
+    # and it's not sender's. At most MAX_FILL requests are looked through.
+    # @params.token – token name
+    # @params.max_amount – maximum amount of tokens to lend
+    # @params.min_reward_rate – minimum reward rate in reward tokens per RATE_UNIT tokens
+    #
+    @sp.entry_point(lazify = False)
+    def fill_best(self, params):
+        sp.set_type(params.token, sp.TString)
+        sp.set_type(params.max_amount, sp.TNat)
+        sp.set_type(params.min_reward_rate, sp.TNat)
+        sp.verify(~self.data.pause, message = self.error(Error.PAUSED))
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        token = sp.local("token", self.data.tokens.get(params.token, message = self.error(Error.ILLEGAL_ARGUMENT + ":token")))
+        best = sp.local("best", sp.nat(0))
+        cursor = sp.local("cursor", self.data.book.get(sp.pair(token.value.id, 0), sp.record(prev = 0, next = 0)).next)
+        count = sp.local("count", sp.nat(0))
+        sp.while (cursor.value != 0) & (count.value < MAX_FILL):
+            loan = sp.local("loan", self.data.loans[cursor.value])
+            sp.if loan.value.reward * RATE_UNIT < params.min_reward_rate * loan.value.amount:
+                # the rest of the list has lower rates
+                cursor.value = 0
+            sp.else:
+                sp.if (loan.value.amount <= params.max_amount) & (loan.value.borrower != sp.sender) & \
+                        ((loan.value.validity == sp.none) | (loan.value.validity > sp.some(sp.now))):
+                    best.value = cursor.value
+                    cursor.value = 0
+                sp.else:
+                    cursor.value = self.data.book[sp.pair(token.value.id, cursor.value)].next
+                    count.value += 1
+        sp.verify(best.value != 0, message = self.error(Error.NO_MATCH))
+        transfers = self.new_transfers()
+        self.create_deal(best.value, sp.sender, transfers)
+        self.send_transfers(transfers)
+
+
+    # Close a deal by borrower or creditor/admins.
+    # If a deal is closed by borrower, the tokens are sent to the creditor and the borrower gets back the deposit;
+    # if a deal timed out and it's closed by the creditor or admins, the creditor gets the deposit.
+    # @params.id – credit deal ID (the ID of the funded loan request)
+    #
+    @sp.entry_point(lazify = False)
+    def close_deal(self, params):
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        transfers = self.new_transfers()
+        self.settle_deal(params.id, sp.sender, transfers)
+        self.send_transfers(transfers)
+
+
+    # Close several deals at once, the whole batch is rejected if any of the deals can't be closed.
+    # FA2 token transfers are sent as one batch per token contract.
+    # @params.ids – list of credit deal IDs
+    #
+    @sp.entry_point(lazify = False)
+    def close_deals(self, params):
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        transfers = self.new_transfers()
+        sp.for id in params.ids:
+            self.settle_deal(id, sp.sender, transfers)
+        self.send_transfers(transfers)
+
+
+    # Execute actions signed by other accounts (permits), e.g. for users who have no tezos to pay transaction fees.
+    # Each permit has to be signed with the signer's current nonce (see get_nonce) and used before its expiry,
+    # its action is executed as if the signer sent it (see cancel_loan, make_deal, close_deal). The whole batch is rejected if any of the permits
+    # is invalid or any of the actions can't be executed. FA2 token transfers are sent as one batch per token contract.
+    # @params.permits – list of permits (see TPermit)
+    #
+    @sp.entry_point(lazify = False)
+    def relay(self, params):
+        sp.set_type(params.permits, sp.TList(TPermit))
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        transfers = self.new_transfers()
+        sp.for permit in params.permits:
+            signer = sp.local("signer", sp.to_address(sp.implicit_account(sp.hash_key(permit.key))))
+            nonce = sp.local("nonce", self.data.nonces.get(signer.value, 0))
+            data = sp.pack(sp.pair(sp.pair(sp.chain_id, sp.self_address), sp.pair(sp.pair(nonce.value, permit.expiry), permit.action)))
+            sp.verify(sp.check_signature(permit.key, permit.signature, data), message = self.error(Error.ILLEGAL_ARGUMENT + ":signature"))
+            sp.verify(sp.now < permit.expiry, message = self.error(Error.ILLEGAL_ARGUMENT + ":expiry"))
+            self.data.nonces[signer.value] = nonce.value + 1
+            with permit.action.match_cases() as arg:
+                with arg.match("cancel_loan") as id:
+                    self.revoke_loan(id, signer.value)
+                with arg.match("make_deal") as id:
+                    sp.verify(~self.data.pause, message = self.error(Error.PAUSED))
+                    self.create_deal(id, signer.value, transfers)
+                with arg.match("close_deal") as id:
+                    self.settle_deal(id, signer.value, transfers)
+        self.send_transfers(transfers)
+
+
+    # Move sender's permit nonce forward, the permits the sender signed with lower nonces can't be used anymore.
+    # @params.nonce – new nonce, greater than the current one (see get_nonce)
+    #
+    @sp.entry_point(lazify = False)
+    def increment_nonce(self, params):
+        sp.set_type(params.nonce, sp.TNat)
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        sp.verify(params.nonce > self.data.nonces.get(sp.sender, 0), message = self.error(Error.ILLEGAL_ARGUMENT + ":nonce"))
+        self.data.nonces[sp.sender] = params.nonce
+
+
+    # (Keepers) Clean up expired loan requests and timed out credit deals, anyone can call it.
+    # Expired loan requests are cancelled (deposit and fee are returned to the borrower, see cancel_loan),
+    # timed out credit deals are closed in favour of the creditor (see close_deal), other IDs are skipped.
+    # The tezos goes only to the borrowers and creditors and a timed out credit deal can be closed by its creditor
+    # anyway, so the sender decides nothing but when the clean-up happens. Tezos is sent once per receiver.
+    # @params.ids – list of loan request / credit deal IDs (at most MAX_SWEEP)
+    #
+    @sp.entry_point
+    def sweep(self, params):
+        sp.set_type(params.ids, sp.TList(sp.TNat))
+        sp.verify(sp.amount == sp.mutez(0), message = self.error(Error.ILLEGAL_TX_AMOUNT))
+        sp.verify(sp.len(params.ids) <= MAX_SWEEP, message = self.error(Error.ILLEGAL_ARGUMENT + ":ids"))
+        payouts = sp.local("payouts", sp.map(tkey = sp.TAddress, tvalue = sp.TMutez))
+        sp.for id in params.ids:
+            sp.if self.data.loans.contains(id):
+                item = sp.local("item", self.data.loans[id])
+                sp.if item.value.status == Status.REQUEST:
+                    sp.if (item.value.validity != sp.none) & (item.value.validity <= sp.some(sp.now)):
+                        self.add_payout(payouts, item.value.borrower, item.value.deposit + item.value.fee)
+                        self.data.deposits -= (item.value.deposit + item.value.fee)
+                        self.drop_loan(id, item.value)
+                sp.else:
+                    sp.if item.value.exp < sp.some(sp.now):
+                        creditor = sp.local("creditor", item.value.creditor.open_some())
+                        self.add_payout(payouts, creditor.value, item.value.deposit)
+                        self.data.deposits -= item.value.deposit
+                        self.emit_deal_closed(id, item.value, creditor.value, repaid = False)
+                        self.drop_deal(id, item.value, creditor.value)
+        sp.for payout in payouts.value.items():
+            sp.send(payout.key, payout.value)
+
+
+    # (View) Service fee for a loan request, the same as add_loan charges.
+    # @params.deposit – deposit amount
+    # @params.time – credit deal duration in seconds
+    #
+    @sp.onchain_view()
+    def quote_fee(self, params):
+        sp.set_type(params.deposit, sp.TMutez)
+        sp.set_type(params.time, sp.TNat)
+        sp.result(self.service_fee(params.deposit, params.time))
+
+
+    # (View) Loan request by ID.
+    # @id – loan request ID
+    #
+    @sp.onchain_view()
+    def get_loan(self, id):
+        sp.set_type(id, sp.TNat)
+        loan = sp.local("loan", self.data.loans.get(id, message = self.error(Error.ILLEGAL_ARGUMENT + ":id")))
+        sp.verify(loan.value.status == Status.REQUEST, message = self.error(Error.ILLEGAL_ARGUMENT + ":id"))
+        sp.result(loan.value)
+
+
+    # (View) Credit deal by ID.
+    # @id – credit deal ID
+    #
+    @sp.onchain_view()
+    def get_deal(self, id):
+        sp.set_type(id, sp.TNat)
+        deal = sp.local("deal", self.data.loans.get(id, message = self.error(Error.ILLEGAL_ARGUMENT + ":id")))
+        sp.verify(deal.value.status == Status.DEAL, message = self.error(Error.ILLEGAL_ARGUMENT + ":id"))
+        sp.result(deal.value)
+
+
+    # (View) Service parameters: fee, minimum deposit, time bounds and pause flag.
+    #
+    @sp.onchain_view()
+    def get_params(self):
+        sp.result(sp.record(fee = self.data.fee, min_deposit = self.data.min_deposit, time = self.data.time, pause = self.data.pause))
+
+
+    # (View) Whether a credit deal is timed out, i.e. the creditor or admins can close it.
+    # @deal_id – credit deal ID
+    #
+    @sp.onchain_view()
+    def is_expired(self, deal_id):
+        sp.set_type(deal_id, sp.TNat)
+        deal = sp.local("deal", self.data.loans.get(deal_id, message = self.error(Error.ILLEGAL_ARGUMENT + ":id")))
+        sp.verify(deal.value.status == Status.DEAL, message = self.error(Error.ILLEGAL_ARGUMENT + ":id"))
+        sp.result(deal.value.exp.open_some() < sp.now)
+
+
+    # (View) Page of live loan requests or credit deals of an account (as borrower or creditor) in the order they were added.
+    # Returns the loan requests or credit deals and the cursor to continue from (see list_loans).
+    # @params.address – account address
+    # @params.status – Status.REQUEST for the loan requests, Status.DEAL for the credit deals
+    # @params.cursor – cursor returned with the previous page or ID 0 to start from the first one
+    # @params.limit – maximum number of loan requests or credit deals to return
+    #
+    @sp.onchain_view()
+    def get_positions(self, params):
+        sp.set_type(params.address, sp.TAddress)
+        sp.set_type(params.status, sp.TNat)
+        sp.result(self.list_page(self.data.positions, lambda id: sp.pair(params.address, sp.pair(params.status, id)), params))
+
+
+    # (View) Nonce of the next permit of an account (see relay).
+    # @address – account address
+    #
+    @sp.onchain_view()
+    def get_nonce(self, address):
+        sp.set_type(address, sp.TAddress)
+        sp.result(self.data.nonces.get(address, 0))
+
+
+    # (View) Page of live loan requests in the order they were added.
+    # Returns the loan requests and the cursor to continue from (ID 0 if there are no more loan requests).
+    # A cursor stays valid when its loan request is removed, the next page starts at the first one added after it
+    # (the view fails if more than MAX_LIST_WALK loan requests were added after it, start again from ID 0 then).
+    # @params.cursor – cursor returned with the previous page or ID 0 to start from the first loan request
+    # @params.limit – maximum number of loan requests to return
+    #
+    @sp.onchain_view()
+    def list_loans(self, params):
+        sp.result(self.list_page(self.data.index, lambda id: sp.pair(Status.REQUEST, id), params))
+
+
+    # (View) Page of live credit deals in the order they were made.
+    # Returns the credit deals and the cursor to continue from (ID 0 if there are no more credit deals).
+    # A cursor stays valid when its credit deal is closed, the next page starts at the first one made after it
+    # (the view fails if more than MAX_LIST_WALK credit deals were made after it, start again from ID 0 then).
+    # @params.cursor – cursor returned with the previous page or ID 0 to start from the first credit deal
+    # @params.limit – maximum number of credit deals to return
+    #
+    @sp.onchain_view()
+    def list_deals(self, params):
+        sp.result(self.list_page(self.data.index, lambda id: sp.pair(Status.DEAL, id), params))
+
+
+    # (View) Place of a new loan request in the list of live loan requests of a token by reward rate.
+    # Returns the ID of the loan request to pass as add_loan_after "prev" (0 if the new one would be the first one).
+    # At most MAX_BOOK_WALK loan requests are passed, the view fails if the place is further from the start of the list.
+    # @params.token – token ID
+    # @params.reward – reward of the new loan request
+    # @params.amount – amount of the new loan request
+    #
+    @sp.onchain_view()
+    def get_book_prev(self, params):
+        sp.set_type(params.token, sp.TNat)
+        sp.set_type(params.reward, sp.TNat)
+        sp.set_type(params.amount, sp.TNat)
+        book_prev = sp.local("book_prev", sp.nat(0))
+        cursor = sp.local("cursor", self.data.book.get(sp.pair(params.token, 0), sp.record(prev = 0, next = 0)).next)
+        steps = sp.local("steps", sp.nat(0))
+        sp.while cursor.value != 0:
+            item = sp.local("item", self.data.loans[cursor.value])
+            sp.if params.reward * item.value.amount > item.value.reward * params.amount:
+                cursor.value = 0
+            sp.else:
+                book_prev.value = cursor.value
+                cursor.value = self.data.book[sp.pair(params.token, cursor.value)].next
+                steps.value += 1
+                sp.verify(steps.value <= MAX_BOOK_WALK, message = self.error(Error.ILLEGAL_ARGUMENT + ":prev"))
+        sp.result(book_prev.value)
+
+
+    # (View) Totals of live loan requests and credit deals of a token.
+    # @token – token ID
+    #
+    @sp.onchain_view()
+    def get_stats(self, token):
+        sp.set_type(token, sp.TNat)
+        empty = sp.record(count = 0, amount = 0, reward = 0, deposit = sp.mutez(0))
+        sp.result(sp.record(
+            requests = self.data.stats.get(sp.pair(token, Status.REQUEST), empty),
+            deals = self.data.stats.get(sp.pair(token, Status.DEAL), empty)
+        ))
+
+
+    # (View) Maturity histogram of live credit deals of a token.
+    # Returns the number and the token amount of credit deals for each of the buckets from_bucket ... from_bucket + count - 1,
+    # a bucket is MATURITY_BUCKET seconds long and bucket n starts at n * MATURITY_BUCKET seconds since 1970-01-01 UTC.
+    # @params.token – token ID
+    # @params.from_bucket – first bucket
+    # @params.count – number of buckets
+    #
+    @sp.onchain_view()
+    def get_maturities(self, params):
+        sp.set_type(params.token, sp.TNat)
+        sp.set_type(params.from_bucket, sp.TNat)
+        sp.set_type(params.count, sp.TNat)
+        items = sp.local("items", sp.list([]))
+        bucket = sp.local("bucket", params.from_bucket + params.count)
+        sp.while bucket.value > params.from_bucket:
+            bucket.value = sp.as_nat(bucket.value - 1)
+            item = sp.local("item", self.data.maturities.get(sp.pair(params.token, bucket.value), sp.record(count = 0, amount = 0)))
+            items.value.push(sp.record(bucket = bucket.value, count = item.value.count, amount = item.value.amount))
+        sp.result(items.value)
+
+
+    # Help function to get the value the contract fails with for an error message.
+    # @message – error message (see Error)
+    #
+    def error(self, message):
+        if self.compact_errors:
+            return sp.nat(ERROR_CODES[message])
+        return message
+
+
+    # Help function to calculate service fee.
+    # @deposit – deposit amount
+    # @time – credit deal duration in seconds
+    #
+    def service_fee(self, deposit, time):
+        return sp.utils.nat_to_mutez(sp.utils.mutez_to_nat(deposit) * time * self.data.fee // (3600 * 24 * 365 * 100 * 100))
+
+
+    # Help function to create a loan request.
+    # Returns the tezos amount (deposit and service fee) the sender has to send for the request.
+    # @params – loan request parameters (see add_loan_after)
+    #
+    def create_loan(self, params):
         sp.set_type(params.token, sp.TString)
         sp.set_type(params.token_address, sp.TAddress)
         sp.set_type(params.amount, sp.TNat)
@@ -220,23 +794,24 @@ class Opus(sp.Contract):
         sp.set_type(params.deposit, sp.TMutez)
         sp.set_type(params.time, sp.TNat)
         sp.set_type(params.validity, sp.TOption(sp.TTimestamp))
-        sp.verify(~self.data.pause, message = Error.PAUSED)
-        sp.verify(self.data.tokens.contains(params.token), message = Error.ILLEGAL_ARGUMENT + ":token")
-        sp.verify(self.data.tokens[params.token] == params.token_address, message = Error.ILLEGAL_ARGUMENT + ":token_address")
-        sp.verify(params.amount > 0, message = Error.ILLEGAL_ARGUMENT + ":amount")
-        sp.verify(params.deposit >= self.data.min_deposit, message = Error.ILLEGAL_ARGUMENT + ":deposit")
-        sp.verify((params.time >= self.data.time.min) & (params.time <= self.data.time.max), message = Error.ILLEGAL_ARGUMENT + ":time")
-        sp.verify((params.validity == sp.none) | (params.validity > sp.some(sp.now)), message = Error.ILLEGAL_ARGUMENT + ":validity")
+        sp.set_type(params.prev, sp.TOption(sp.TNat))
+        token = sp.local("token", self.data.tokens.get(params.token, message = self.error(Error.ILLEGAL_ARGUMENT + ":token")))
+        sp.verify(token.value.address == params.token_address, message = self.error(Error.ILLEGAL_ARGUMENT + ":token_address"))
+        sp.verify(params.amount > 0, message = self.error(Error.ILLEGAL_ARGUMENT + ":amount"))
+        sp.verify(params.deposit >= self.data.min_deposit, message = self.error(Error.ILLEGAL_ARGUMENT + ":deposit"))
+        sp.verify((params.time >= self.data.time.min) & (params.time <= self.data.time.max), message = self.error(Error.ILLEGAL_ARGUMENT + ":time"))
+        sp.verify((params.validity == sp.none) | (params.validity > sp.some(sp.now)), message = self.error(Error.ILLEGAL_ARGUMENT + ":validity"))
         # Service fee calculation
-        f = sp.local("f", sp.utils.nat_to_mutez(sp.utils.mutez_to_nat(params.deposit) * params.time * self.data.fee // (3600 * 24 * 365 * 100 * 100)))
-        sp.verify(sp.amount == (params.deposit + f.value), message = Error.ILLEGAL_TX_AMOUNT)
+        f = sp.local("f", self.service_fee(params.deposit, params.time))
         loan = sp.record(
+            status = Status.REQUEST,
             ts = sp.now,
             borrower = sp.sender,
+            creditor = sp.none,
             validity = params.validity,
+            exp = sp.none,
             amount = params.amount,
-            token = params.token,
-            token_address = self.data.tokens[params.token],
+            token = token.value.id,
             time = params.time,
             reward = params.reward,
             deposit = params.deposit,
@@ -244,90 +819,435 @@ class Opus(sp.Contract):
         )
         self.data.nloan += 1
         self.data.loans[self.data.nloan] = loan
-        self.data.deposits += sp.amount
+        self.index_add(Status.REQUEST, self.data.nloan)
+        self.book_add(token.value.id, self.data.nloan, params.reward, params.amount, params.prev)
+        self.stats_add(Status.REQUEST, loan)
+        self.position_add(sp.sender, Status.REQUEST, self.data.nloan)
+        self.data.deposits += params.deposit + f.value
+        sp.emit(sp.record(
+            id = self.data.nloan,
+            borrower = sp.sender,
+            token = token.value.id,
+            amount = params.amount,
+            reward = params.reward,
+            deposit = params.deposit,
+            fee = f.value,
+            time = params.time,
+            validity = params.validity
+        ), tag = "loan_added")
+        return params.deposit + f.value
 
 
-    # Cancel sender's loan request, deposit and fee of the loan are returned to the sender.
-    # @params.id – loan request ID
+    # Help function to cancel a loan request, deposit and fee of the loan are returned to the borrower.
+    # @id – loan request ID
+    # @sender – borrower or admin address (the sender of the call or the signer of a permit)
     #
-    @sp.entry_point
-    def cancel_loan(self, params):
-        sp.set_type(params.id, sp.TNat)
-        sp.verify(sp.amount == sp.mutez(0), message = Error.ILLEGAL_TX_AMOUNT)
-        sp.verify(self.data.loans.contains(params.id), message = Error.ILLEGAL_ARGUMENT + ":id")
-        loan = sp.local("loan", self.data.loans[params.id])
-        sp.verify((sp.sender == loan.value.borrower) | self.data.admins.contains(sp.sender), Error.ACCESS_DENIED)
+    def revoke_loan(self, id, sender):
+        sp.set_type(id, sp.TNat)
+        loan = sp.local("loan", self.data.loans.get(id, message = self.error(Error.ILLEGAL_ARGUMENT + ":id")))
+        sp.verify(loan.value.status == Status.REQUEST, message = self.error(Error.ILLEGAL_ARGUMENT + ":id"))
+        sp.verify((sender == loan.value.borrower) | self.data.admins.contains(sender), self.error(Error.ACCESS_DENIED))
         sp.if loan.value.deposit > sp.mutez(0):
             sp.send(loan.value.borrower, loan.value.deposit + loan.value.fee)
             self.data.deposits -= (loan.value.deposit + loan.value.fee)
-        del self.data.loans[params.id]
+        self.drop_loan(id, loan.value)
 
 
-    # Make a credit deal, the sender has to approve the corresponding token transfer early.
-    # @params.id – loan request ID
+    # Help function to make a credit deal, the sender has to approve the corresponding token transfer early.
+    # The loan request is turned into the credit deal in place, under the same ID.
+    # @id – loan request ID
+    # @sender – creditor address (the sender of the call or the signer of a permit)
+    # @transfers – local map of FA2 token transfers (see new_transfers)
     #
-    @sp.entry_point
-    def make_deal(self, params):
-        sp.set_type(params.id, sp.TNat)
-        sp.verify(~self.data.pause, message = Error.PAUSED)
-        sp.verify(sp.amount == sp.mutez(0), message = Error.ILLEGAL_TX_AMOUNT)
-        sp.verify(self.data.loans.contains(params.id), message = Error.ILLEGAL_ARGUMENT + ":id")
-        loan = sp.local("loan", self.data.loans[params.id])
-        sp.verify(loan.value.borrower != sp.sender, Error.ILLEGAL_ARGUMENT + ":sender")
-        sp.verify((loan.value.validity == sp.none) | (loan.value.validity > sp.some(sp.now)), message = Error.ILLEGAL_ARGUMENT + ":now")
-        deal = sp.record(
-            ts = sp.now,
+    def create_deal(self, id, sender, transfers):
+        sp.set_type(id, sp.TNat)
+        loan = sp.local("loan", self.data.loans.get(id, message = self.error(Error.ILLEGAL_ARGUMENT + ":id")))
+        sp.verify(loan.value.status == Status.REQUEST, message = self.error(Error.ILLEGAL_ARGUMENT + ":id"))
+        sp.verify(loan.value.borrower != sender, self.error(Error.ILLEGAL_ARGUMENT + ":sender"))
+        sp.verify((loan.value.validity == sp.none) | (loan.value.validity > sp.some(sp.now)), message = self.error(Error.ILLEGAL_ARGUMENT + ":now"))
+        self.transfer_tokens(transfers, f=sender, t=loan.value.borrower, v=loan.value.amount, token=self.data.token_info[loan.value.token])
+        self.data.deposits -= loan.value.fee
+        loan.value.status = Status.DEAL
+        loan.value.creditor = sp.some(sender)
+        loan.value.exp = sp.some(sp.now.add_seconds(sp.to_int(loan.value.time)))
+        self.data.loans[id] = loan.value
+        self.index_remove(Status.REQUEST, id)
+        self.index_add(Status.DEAL, id)
+        self.book_remove(loan.value.token, id)
+        self.stats_remove(Status.REQUEST, loan.value)
+        self.stats_add(Status.DEAL, loan.value)
+        self.maturity_add(loan.value)
+        self.position_remove(loan.value.borrower, Status.REQUEST, id)
+        self.position_add(loan.value.borrower, Status.DEAL, id)
+        self.position_add(sender, Status.DEAL, id)
+        sp.emit(sp.record(
+            id = id,
             borrower = loan.value.borrower,
-            creditor = sp.sender,
-            amount = loan.value.amount,
+            creditor = sender,
             token = loan.value.token,
-            token_address = loan.value.token_address,
-            exp = sp.now.add_seconds(sp.to_int(loan.value.time)),
+            amount = loan.value.amount,
             reward = loan.value.reward,
             deposit = loan.value.deposit,
-        )
-        self.transfer_tokens(f=sp.sender, t=loan.value.borrower, v=loan.value.amount, token_address=loan.value.token_address)
-        self.data.ndeal += 1
-        self.data.deals[self.data.ndeal] = deal
-        self.data.deposits -= loan.value.fee
-        del self.data.loans[params.id]
+            fee = loan.value.fee,
+            exp = loan.value.exp.open_some()
+        ), tag = "deal_made")
 
 
-    # Close a deal by borrower or creditor/admins.
-    # If a deal is closed by borrower, the tokens are sent to the creditor and the borrower gets back the deposit;
-    # if a deal timed out and it's closed by the creditor or admins, the creditor gets the deposit.
-    # @params.id – credit deal ID
+    # Help function to close a deal by borrower or creditor/admins (see close_deal).
+    # @id – credit deal ID
+    # @sender – address closing the deal (the sender of the call or the signer of a permit)
+    # @transfers – local map of FA2 token transfers (see new_transfers)
     #
-    @sp.entry_point
-    def close_deal(self, params):
-        sp.set_type(params.id, sp.TNat)
-        sp.verify(sp.amount == sp.mutez(0), message = Error.ILLEGAL_TX_AMOUNT)
-        sp.verify(self.data.deals.contains(params.id), message = Error.ILLEGAL_ARGUMENT + ":id")
-        deal = sp.local("deal", self.data.deals[params.id])
-        sp.verify((sp.sender == deal.value.borrower) | (sp.sender == deal.value.creditor) | self.data.admins.contains(sp.sender), Error.ACCESS_DENIED)
-        sp.if sp.sender == deal.value.borrower:
-            self.transfer_tokens(f=deal.value.borrower, t=deal.value.creditor, v=(deal.value.amount+deal.value.reward), token_address=deal.value.token_address)
+    def settle_deal(self, id, sender, transfers):
+        sp.set_type(id, sp.TNat)
+        deal = sp.local("deal", self.data.loans.get(id, message = self.error(Error.ILLEGAL_ARGUMENT + ":id")))
+        sp.verify(deal.value.status == Status.DEAL, message = self.error(Error.ILLEGAL_ARGUMENT + ":id"))
+        creditor = sp.local("creditor", deal.value.creditor.open_some())
+        sp.verify((sender == deal.value.borrower) | (sender == creditor.value) | self.data.admins.contains(sender), self.error(Error.ACCESS_DENIED))
+        sp.if sender == deal.value.borrower:
+            self.transfer_tokens(transfers, f=deal.value.borrower, t=creditor.value, v=(deal.value.amount+deal.value.reward), token=self.data.token_info[deal.value.token])
             sp.if deal.value.deposit > sp.mutez(0):
                 sp.send(deal.value.borrower, deal.value.deposit)
                 self.data.deposits -= deal.value.deposit
+            self.emit_deal_closed(id, deal.value, creditor.value, repaid = True)
         sp.else:
-            sp.verify(deal.value.exp < sp.now, message = Error.ACCESS_DENIED)
+            sp.verify(deal.value.exp.open_some() < sp.now, message = self.error(Error.ACCESS_DENIED))
             sp.if deal.value.deposit > sp.mutez(0):
-                sp.send(deal.value.creditor, deal.value.deposit)
+                sp.send(creditor.value, deal.value.deposit)
                 self.data.deposits -= deal.value.deposit
-        del self.data.deals[params.id]
+            self.emit_deal_closed(id, deal.value, creditor.value, repaid = False)
+        self.drop_deal(id, deal.value, creditor.value)
+
+
+    # Help function to delete a cancelled loan request.
+    # @id – loan request ID
+    # @loan – loan request
+    #
+    def drop_loan(self, id, loan):
+        self.index_remove(Status.REQUEST, id)
+        self.book_remove(loan.token, id)
+        self.stats_remove(Status.REQUEST, loan)
+        self.position_remove(loan.borrower, Status.REQUEST, id)
+        del self.data.loans[id]
+        sp.emit(sp.record(id = id, borrower = loan.borrower, token = loan.token, refund = loan.deposit + loan.fee), tag = "loan_cancelled")
+
+
+    # Help function to delete a closed credit deal.
+    # @id – credit deal ID
+    # @deal – credit deal
+    # @creditor – creditor address
+    #
+    def drop_deal(self, id, deal, creditor):
+        self.index_remove(Status.DEAL, id)
+        self.stats_remove(Status.DEAL, deal)
+        self.maturity_remove(deal)
+        self.position_remove(deal.borrower, Status.DEAL, id)
+        self.position_remove(creditor, Status.DEAL, id)
+        del self.data.loans[id]
+
+
+    # Help function to add a tezos amount to the payouts of a receiver.
+    # @payouts – local map of payouts (receiver address -> tezos amount)
+    # @address – receiver address
+    # @amount – tezos amount
+    #
+    def add_payout(self, payouts, address, amount):
+        sp.if amount > sp.mutez(0):
+            payouts.value[address] = payouts.value.get(address, sp.mutez(0)) + amount
+
+
+    # Help function to emit the "deal_closed" event.
+    # @id – credit deal ID
+    # @deal – credit deal
+    # @creditor – creditor address
+    # @repaid – True if the deal is repaid by the borrower, False if it is liquidated
+    #
+    def emit_deal_closed(self, id, deal, creditor, repaid):
+        sp.emit(sp.record(
+            id = id,
+            borrower = deal.borrower,
+            creditor = creditor,
+            token = deal.token,
+            # amount of tokens returned to the creditor
+            repayment = deal.amount + deal.reward if repaid else sp.nat(0),
+            deposit = deal.deposit,
+            # service fee of the deal (paid when it was made)
+            fee = deal.fee,
+            # the deposit receiver
+            receiver = deal.borrower if repaid else creditor,
+            outcome = sp.set_type_expr(sp.variant("repaid" if repaid else "liquidated", sp.unit), TOutcome)
+        ), tag = "deal_closed")
+
+
+    # Help function to append a loan request ID to the end of the list of live loan requests or credit deals.
+    # @status – loan status of the list
+    # @id – loan request ID
+    #
+    def index_add(self, status, id):
+        self.list_add(self.data.index, lambda id: sp.pair(status, id), id)
+
+
+    # Help function to remove a loan request ID from the list of live loan requests or credit deals.
+    # @status – loan status of the list
+    # @id – loan request ID
+    #
+    def index_remove(self, status, id):
+        self.list_remove(self.data.index, lambda id: sp.pair(status, id), id)
+
+
+    # Help function to append an item to the end of a doubly linked list with sequence numbers (see TNode).
+    # The head of the list is added with the first item.
+    # @nodes – big map of the list nodes
+    # @key – function of an item ID to its key in the big map (the head of the list is the item 0)
+    # @id – item ID
+    #
+    def list_add(self, nodes, key, id):
+        sp.if ~nodes.contains(key(0)):
+            nodes[key(0)] = sp.record(prev = 0, next = 0, seq = 0)
+        self.data.nseq += 1
+        nodes[key(id)] = sp.record(prev = nodes[key(0)].prev, next = 0, seq = self.data.nseq)
+        nodes[key(nodes[key(0)].prev)].next = id
+        nodes[key(0)].prev = id
+
+
+    # Help function to remove an item from a doubly linked list with sequence numbers (see TNode).
+    # The head of the list is deleted with the last item.
+    # @nodes – big map of the list nodes
+    # @key – function of an item ID to its key in the big map (the head of the list is the item 0)
+    # @id – item ID
+    #
+    def list_remove(self, nodes, key, id):
+        nodes[key(nodes[key(id)].prev)].next = nodes[key(id)].next
+        nodes[key(nodes[key(id)].next)].prev = nodes[key(id)].prev
+        del nodes[key(id)]
+        sp.if nodes[key(0)].next == 0:
+            del nodes[key(0)]
+
+
+    # Help function to read a page of a list of loan requests or credit deals with sequence numbers (see TNode).
+    # If the cursor item was removed, the page starts at the first item added after it: the items after it are
+    # passed backwards from the end of the list, at most MAX_LIST_WALK of them, the cursor of a live item is followed
+    # at once.
+    # @nodes – big map of the list nodes
+    # @key – function of an item ID to its key in the big map (the head of the list is the item 0)
+    # @params.cursor – cursor of the item to start from or ID 0 to start from the first one
+    # @params.limit – maximum number of items to return
+    #
+    def list_page(self, nodes, key, params):
+        sp.set_type(params.cursor, TCursor)
+        sp.set_type(params.limit, sp.TNat)
+        item = sp.local("item", sp.nat(0))
+        sp.if nodes.contains(key(0)):
+            sp.if params.cursor.id == 0:
+                item.value = nodes[key(0)].next
+            sp.else:
+                sp.if nodes.contains(key(params.cursor.id)):
+                    sp.if nodes[key(params.cursor.id)].seq == params.cursor.seq:
+                        item.value = params.cursor.id
+                sp.if item.value == 0:
+                    last = sp.local("last", nodes[key(0)].prev)
+                    steps = sp.local("steps", sp.nat(0))
+                    sp.while (last.value != 0) & (nodes[key(last.value)].seq > params.cursor.seq):
+                        item.value = last.value
+                        last.value = nodes[key(last.value)].prev
+                        steps.value += 1
+                        sp.verify(steps.value <= MAX_LIST_WALK, message = self.error(Error.ILLEGAL_ARGUMENT + ":cursor"))
+        items = sp.local("items", sp.list([]))
+        count = sp.local("count", sp.nat(0))
+        sp.while (item.value != 0) & (count.value < params.limit):
+            items.value.push(sp.record(id = item.value, loan = self.data.loans[item.value]))
+            item.value = nodes[key(item.value)].next
+            count.value += 1
+        seq = nodes.get(key(item.value), sp.record(prev = 0, next = 0, seq = 0)).seq
+        return sp.record(items = items.value.rev(), next = sp.record(id = item.value, seq = seq))
+
+
+    # Help function to insert a loan request ID into the list of live loan requests of a token by its reward rate.
+    # The place is looked for forwards from the prev hint or backwards from the end of the list, at most MAX_BOOK_WALK
+    # loan requests are passed, so the cost doesn't grow with the list.
+    # @token – token ID
+    # @id – loan request ID
+    # @reward – reward of the loan request
+    # @amount – amount of the loan request
+    # @prev – ID of a loan request with a reward rate not lower than this one, 0 for the start of the list, or None
+    #
+    def book_add(self, token, id, reward, amount, prev):
+        sp.if ~self.data.book.contains(sp.pair(token, 0)):
+            self.data.book[sp.pair(token, 0)] = sp.record(prev = 0, next = 0)
+        book_prev = sp.local("book_prev", sp.nat(0))
+        book_next = sp.local("book_next", sp.nat(0))
+        steps = sp.local("steps", sp.nat(0))
+        searching = sp.local("searching", True)
+        # rates are compared by cross multiplication: reward / amount > item.reward / item.amount
+        sp.if prev.is_some():
+            book_prev.value = prev.open_some()
+            sp.verify(self.data.book.contains(sp.pair(token, book_prev.value)), message = self.error(Error.ILLEGAL_ARGUMENT + ":prev"))
+            sp.if book_prev.value != 0:
+                hint = sp.local("hint", self.data.loans[book_prev.value])
+                sp.verify(reward * hint.value.amount <= hint.value.reward * amount, message = self.error(Error.ILLEGAL_ARGUMENT + ":prev"))
+            book_next.value = self.data.book[sp.pair(token, book_prev.value)].next
+            searching.value = book_next.value != 0
+            sp.while searching.value:
+                next_item = sp.local("next_item", self.data.loans[book_next.value])
+                sp.if reward * next_item.value.amount > next_item.value.reward * amount:
+                    searching.value = False
+                sp.else:
+                    book_prev.value = book_next.value
+                    book_next.value = self.data.book[sp.pair(token, book_next.value)].next
+                    searching.value = book_next.value != 0
+                    steps.value += 1
+                    sp.verify(steps.value <= MAX_BOOK_WALK, message = self.error(Error.ILLEGAL_ARGUMENT + ":prev"))
+        sp.else:
+            book_prev.value = self.data.book[sp.pair(token, 0)].prev
+            searching.value = book_prev.value != 0
+            sp.while searching.value:
+                prev_item = sp.local("prev_item", self.data.loans[book_prev.value])
+                sp.if reward * prev_item.value.amount > prev_item.value.reward * amount:
+                    book_next.value = book_prev.value
+                    book_prev.value = self.data.book[sp.pair(token, book_prev.value)].prev
+                    searching.value = book_prev.value != 0
+                    steps.value += 1
+                    sp.verify(steps.value <= MAX_BOOK_WALK, message = self.error(Error.ILLEGAL_ARGUMENT + ":prev"))
+                sp.else:
+                    searching.value = False
+        self.data.book[sp.pair(token, id)] = sp.record(prev = book_prev.value, next = book_next.value)
+        self.data.book[sp.pair(token, book_prev.value)].next = id
+        self.data.book[sp.pair(token, book_next.value)].prev = id
+
+
+    # Help function to remove a loan request ID from the list of live loan requests of a token.
+    # The head of the list is deleted with the last loan request.
+    # @token – token ID
+    # @id – loan request ID
+    #
+    def book_remove(self, token, id):
+        book_node = sp.local("book_node", self.data.book[sp.pair(token, id)])
+        self.data.book[sp.pair(token, book_node.value.prev)].next = book_node.value.next
+        self.data.book[sp.pair(token, book_node.value.next)].prev = book_node.value.prev
+        del self.data.book[sp.pair(token, id)]
+        sp.if self.data.book[sp.pair(token, 0)].next == 0:
+            del self.data.book[sp.pair(token, 0)]
+
+
+    # Help function to add a loan request or a credit deal to the totals of its token.
+    # @status – loan status of the totals
+    # @loan – loan request or credit deal
+    #
+    def stats_add(self, status, loan):
+        key = sp.pair(loan.token, status)
+        sp.if ~self.data.stats.contains(key):
+            self.data.stats[key] = sp.record(count = 0, amount = 0, reward = 0, deposit = sp.mutez(0))
+        self.data.stats[key].count += 1
+        self.data.stats[key].amount += loan.amount
+        self.data.stats[key].reward += loan.reward
+        self.data.stats[key].deposit += loan.deposit
+
+
+    # Help function to subtract a loan request or a credit deal from the totals of its token.
+    # The entry is deleted with the last loan request or credit deal.
+    # @status – loan status of the totals
+    # @loan – loan request or credit deal
+    #
+    def stats_remove(self, status, loan):
+        key = sp.pair(loan.token, status)
+        stats_item = sp.local("stats_item", self.data.stats[key])
+        sp.if stats_item.value.count == 1:
+            del self.data.stats[key]
+        sp.else:
+            self.data.stats[key] = sp.record(
+                count = sp.as_nat(stats_item.value.count - 1),
+                amount = sp.as_nat(stats_item.value.amount - loan.amount),
+                reward = sp.as_nat(stats_item.value.reward - loan.reward),
+                deposit = stats_item.value.deposit - loan.deposit
+            )
+
+
+    # Help function to add a credit deal to the maturity histogram of its token.
+    # @deal – credit deal
+    #
+    def maturity_add(self, deal):
+        key = sp.pair(deal.token, self.maturity_bucket(deal))
+        sp.if ~self.data.maturities.contains(key):
+            self.data.maturities[key] = sp.record(count = 0, amount = 0)
+        self.data.maturities[key].count += 1
+        self.data.maturities[key].amount += deal.amount
+
+
+    # Help function to remove a credit deal from the maturity histogram of its token.
+    # The entry is deleted with the last credit deal of the bucket.
+    # @deal – credit deal
+    #
+    def maturity_remove(self, deal):
+        key = sp.pair(deal.token, self.maturity_bucket(deal))
+        maturity = sp.local("maturity", self.data.maturities[key])
+        sp.if maturity.value.count == 1:
+            del self.data.maturities[key]
+        sp.else:
+            self.data.maturities[key] = sp.record(count = sp.as_nat(maturity.value.count - 1), amount = sp.as_nat(maturity.value.amount - deal.amount))
+
+
+    # Help function to calculate the maturity histogram bucket of a credit deal.
+    # @deal – credit deal
+    #
+    def maturity_bucket(self, deal):
+        return sp.as_nat(deal.exp.open_some() - sp.timestamp(0)) // MATURITY_BUCKET
+
+
+    # Help function to append a loan request ID to the end of the loan requests or credit deals of an account.
+    # @address – account address
+    # @status – Status.REQUEST to add to the loan requests, Status.DEAL to add to the credit deals
+    # @id – loan request ID
+    #
+    def position_add(self, address, status, id):
+        self.list_add(self.data.positions, lambda id: sp.pair(address, sp.pair(status, id)), id)
+
+
+    # Help function to remove a loan request ID from the loan requests or credit deals of an account.
+    # @address – account address
+    # @status – Status.REQUEST to remove from the loan requests, Status.DEAL to remove from the credit deals
+    # @id – loan request ID
+    #
+    def position_remove(self, address, status, id):
+        self.list_remove(self.data.positions, lambda id: sp.pair(address, sp.pair(status, id)), id)
 
 
     # Help function to transfer tokens.
+    # FA1.2 tokens are transferred at once, FA2 token transfers are added to the local map of transfers
+    # and sent by send_transfers.
+    # @transfers – local map of FA2 token transfers (see new_transfers)
     # @f – source address
     # @t – destination address
     # @v – amount of tokens
-    # @token_address – token smart-contract address
+    # @token – token record (see token_info)
+    #
+    def transfer_tokens(self, transfers, f, t, v, token):
+        sp.if token.token_id.is_some():
+            sp.if ~transfers.value.contains(token.address):
+                transfers.value[token.address] = {}
+            tx = sp.record(to_ = t, token_id = token.token_id.open_some(), amount = v)
+            transfers.value[token.address][f] = sp.cons(tx, transfers.value[token.address].get(f, sp.list([])))
+        sp.else:
+            param_type = sp.TRecord(from_ = sp.TAddress, to_ = sp.TAddress, value = sp.TNat).layout(("from_ as from", ("to_ as to", "value")))
+            param_values = sp.record(from_ = f, to_ = t, value = v)
+            sp.transfer(param_values, sp.mutez(0), sp.contract(param_type, token.address, entry_point="transfer").open_some())
+
+
+    # Help function to create the local map of FA2 token transfers:
+    # token contract address -> source address -> list of transfers (see TFA2Tx).
     #
-    def transfer_tokens(self, f, t, v, token_address):
-        param_type = sp.TRecord(from_ = sp.TAddress, to_ = sp.TAddress, value = sp.TNat).layout(("from_ as from", ("to_ as to", "value")))
-        param_values = sp.record(from_ = f, to_ = t, value = v)
-        sp.transfer(param_values, sp.mutez(0), sp.contract(param_type, token_address, entry_point="transfer").open_some())
+    def new_transfers(self):
+        return sp.local("transfers", sp.map(tkey = sp.TAddress, tvalue = sp.TMap(sp.TAddress, sp.TList(TFA2Tx))))
+
+
+    # Help function to send the collected FA2 token transfers, one "transfer" call per token contract.
+    # @transfers – local map of FA2 token transfers (see new_transfers)
+    #
+    def send_transfers(self, transfers):
+        sp.for batch in transfers.value.items():
+            items = sp.local("items", sp.list([], t = TFA2Transfer))
+            sp.for item in batch.value.items():
+                items.value.push(sp.record(from_ = item.key, txs = item.value))
+            sp.transfer(items.value, sp.mutez(0), sp.contract(sp.TList(TFA2Transfer), batch.key, entry_point = "transfer").open_some())
 
 
 
@@ -356,11 +1276,14 @@ def test():
     c1.add_admin(address=admin.address).run(sender = creator)
     c1.add_admin(address=admin.address).run(sender = creator, valid = False)
     c1.add_admin(address=userA.address).run(sender = admin)
+    scenario.verify(c1.data.admins.contains(userA.address))
     scenario.h2("remove_admin()")
     c1.remove_admin(address=userA.address).run(sender = admin, amount=sp.mutez(1), valid = False)
     c1.remove_admin(address=admin.address).run(sender = userB, valid = False)
     c1.remove_admin(address=creator).run(sender = admin, valid = False)
     c1.remove_admin(address=userA.address).run(sender = admin)
+    scenario.verify(~c1.data.admins.contains(userA.address))
+    scenario.verify(c1.data.admins.contains(creator))
     c1.remove_admin(address=userA.address).run(sender = admin, valid = False)
 
 
@@ -377,21 +1300,26 @@ def test():
 
 
     scenario.h1("Tokens")
-    tokenBTC = sp.record(name="sBTC", address=sp.address("tz1oBTCoMEtsXm3QxA7FmMU2Qh7xzsuGXVbc"))
-    tokenETH = sp.record(name="sETH", address=sp.address("tz1oETHo1otsXm3QxA7FmMU2Qh7xzsuGXVbc"))
-    tokenXPR = sp.record(name="sXRP", address=sp.address("tz1oXRPoMEtsXm3QxA7FmMU2Qh7xzsuGXVbc"))
+    tokenBTC = sp.record(name="sBTC", address=sp.address("tz1oBTCoMEtsXm3QxA7FmMU2Qh7xzsuGXVbc"), token_id=sp.none)
+    tokenETH = sp.record(name="sETH", address=sp.address("tz1oETHo1otsXm3QxA7FmMU2Qh7xzsuGXVbc"), token_id=sp.none)
+    tokenXPR = sp.record(name="sXRP", address=sp.address("tz1oXRPoMEtsXm3QxA7FmMU2Qh7xzsuGXVbc"), token_id=sp.none)
     scenario.h2("add_token()")
     c1.add_token(tokenBTC).run(sender = creator, amount=sp.mutez(1), valid = False)
     c1.add_token(tokenBTC).run(sender = creator)
     c1.add_token(tokenETH).run(sender = userA, valid = False)
-    c1.add_token(name=tokenETH.name, address=sp.address("tz1oETHo2otsXm3QxA7FmMU2Qh7xzsuGXVbc")).run(sender = creator)
+    c1.add_token(name=tokenETH.name, address=sp.address("tz1oETHo2otsXm3QxA7FmMU2Qh7xzsuGXVbc"), token_id=sp.none).run(sender = creator)
     c1.add_token(tokenETH).run(sender = admin)
     c1.add_token(tokenXPR).run(sender = admin)
+    c1.add_token(tokenXPR).run(sender = admin)
+    scenario.verify(c1.data.ntoken == 4)
+    scenario.verify(c1.data.tokens[tokenETH.name].id == 3)
+    scenario.verify(c1.data.token_info[2].address == sp.address("tz1oETHo2otsXm3QxA7FmMU2Qh7xzsuGXVbc"))
     scenario.h2("remove_token()")
     c1.remove_token(name="sBTC").run(sender = creator, amount=sp.mutez(1), valid = False)
     c1.remove_token(name="sBTC").run(sender = userA, valid = False)
     c1.remove_token(name="yyyy").run(sender = creator, valid = False)
     c1.remove_token(name="sXRP").run(sender = creator)
+    scenario.verify(c1.data.token_info.contains(4))
 
 
     scenario.h1("Fee")
@@ -470,12 +1398,32 @@ def test():
     c1.add_loan(amount=20_000, token=tokenBTC.name, token_address=tokenETH.address, time=14*DAY, reward=200, deposit=sp.mutez(200_000_000),
         validity=sp.none
         ).run(sender=userB, amount=sp.mutez(200_000_000 + 76712), now=sp.timestamp_from_utc(2022, 5, 2, 0, 0, 0), valid=False)
+    scenario.h2("Views")
+    scenario.verify(c1.quote_fee(sp.record(deposit=sp.mutez(1_500_000_00), time=7*DAY)) == sp.mutez(28767))
+    scenario.verify(c1.quote_fee(sp.record(deposit=sp.mutez(200_000_000), time=14*DAY)) == sp.mutez(76712))
+    scenario.verify(c1.get_params().fee == 100)
+    scenario.verify(c1.get_params().time.max == 366*DAY)
+    scenario.verify(c1.get_loan(2).borrower == userB.address)
+    scenario.verify(c1.get_loan(2).fee == sp.mutez(76712))
     scenario.h2("cancel_loan()")
     c1.cancel_loan(id=1).run(sender = userA, amount=sp.mutez(1), valid = False)
     c1.cancel_loan(id=123).run(sender = userA, valid = False)
     c1.cancel_loan(id=3).run(sender = userB, valid = False)
     c1.cancel_loan(id=1).run(sender = userA)
     c1.cancel_loan(id=3).run(sender = admin)
+    first = sp.record(id=0, seq=0)
+    scenario.verify(sp.len(c1.list_loans(sp.record(cursor=first, limit=10)).items) == 3)
+    page = scenario.compute(c1.list_loans(sp.record(cursor=first, limit=2)))
+    scenario.verify(page.next.id == 5)
+    scenario.verify(c1.list_loans(sp.record(cursor=page.next, limit=2)).next.id == 0)
+    scenario.verify(sp.len(c1.list_loans(sp.record(cursor=page.next, limit=10)).items) == 1)
+    # the page of limit i of an account's list continues from its item i, so the IDs are checked in order
+    def positions(user, status, ids):
+        for (i, id) in enumerate(ids + [0]):
+            scenario.verify(c1.get_positions(sp.record(address=user.address, status=status, cursor=first, limit=i)).next.id == id)
+    positions(userA, Status.REQUEST, [4, 5])
+    positions(userB, Status.REQUEST, [2])
+    positions(userC, Status.REQUEST, [])
 
 
     scenario.h1("Deals")
@@ -485,15 +1433,253 @@ def test():
     c1.make_deal(id=4).run(sender=userB, now=sp.timestamp_from_utc(2022, 5, 15, 0, 0, 0), valid = False)
     c1.make_deal(id=4).run(sender=userB, now=sp.timestamp_from_utc(2022, 5, 10, 0, 0, 0), amount=sp.mutez(1), valid = False)
     c1.make_deal(id=4).run(sender=userB, now=sp.timestamp_from_utc(2022, 5, 10, 0, 0, 0))
+    c1.make_deal(id=4).run(sender=userC, now=sp.timestamp_from_utc(2022, 5, 10, 0, 0, 0), valid = False)
     c1.make_deal(id=5).run(sender=userB, now=sp.timestamp_from_utc(2022, 5, 1, 0, 0, 0))
+    scenario.verify(c1.data.loans[4].status == Status.DEAL)
+    scenario.verify(c1.data.loans[4].creditor == sp.some(userB.address))
+    scenario.verify(c1.data.loans[4].exp == sp.some(sp.timestamp_from_utc(2022, 5, 17, 0, 0, 0)))
+    scenario.verify(c1.get_deal(4).creditor == sp.some(userB.address))
+    scenario.verify(sp.len(c1.list_loans(sp.record(cursor=first, limit=10)).items) == 1)
+    scenario.verify(sp.len(c1.list_deals(sp.record(cursor=first, limit=10)).items) == 2)
+    positions(userA, Status.REQUEST, [])
+    positions(userA, Status.DEAL, [4, 5])
+    positions(userB, Status.DEAL, [4, 5])
+    positions(userB, Status.REQUEST, [2])
+    scenario.verify(~c1.data.positions.contains(sp.pair(userA.address, sp.pair(Status.REQUEST, 0))))
+    c1.cancel_loan(id=4).run(sender = userA, valid = False)
     scenario.h2("close_deal()")
     c1.close_deal(id=0).run(sender=userA, now=sp.timestamp_from_utc(2022, 5, 11, 0, 0, 0), valid = False)
-    c1.close_deal(id=1).run(sender=userC, now=sp.timestamp_from_utc(2022, 5, 11, 0, 0, 0), valid = False)
-    c1.close_deal(id=1).run(sender=userB, now=sp.timestamp_from_utc(2022, 5, 11, 0, 0, 0), valid = False)
-    c1.close_deal(id=1).run(sender=admin, now=sp.timestamp_from_utc(2022, 5, 11, 0, 0, 0), valid = False)
-    c1.close_deal(id=1).run(sender=userA, now=sp.timestamp_from_utc(2022, 5, 14, 0, 0, 0), amount=sp.mutez(1), valid = False)
-    c1.close_deal(id=1).run(sender=userA, now=sp.timestamp_from_utc(2022, 5, 14, 0, 0, 0))
-    c1.close_deal(id=2).run(sender=userB, now=sp.timestamp_from_utc(2022, 5, 9, 0, 0, 0))
+    c1.close_deal(id=2).run(sender=userB, now=sp.timestamp_from_utc(2022, 5, 11, 0, 0, 0), valid = False)
+    c1.close_deal(id=4).run(sender=userC, now=sp.timestamp_from_utc(2022, 5, 11, 0, 0, 0), valid = False)
+    c1.close_deal(id=4).run(sender=userB, now=sp.timestamp_from_utc(2022, 5, 11, 0, 0, 0), valid = False)
+    c1.close_deal(id=4).run(sender=admin, now=sp.timestamp_from_utc(2022, 5, 11, 0, 0, 0), valid = False)
+    c1.close_deal(id=4).run(sender=userA, now=sp.timestamp_from_utc(2022, 5, 14, 0, 0, 0), amount=sp.mutez(1), valid = False)
+    c1.close_deal(id=4).run(sender=userA, now=sp.timestamp_from_utc(2022, 5, 14, 0, 0, 0))
+    c1.close_deal(id=5).run(sender=userB, now=sp.timestamp_from_utc(2022, 5, 9, 0, 0, 0))
+    scenario.verify(~c1.data.loans.contains(4) & ~c1.data.loans.contains(5))
+    scenario.verify(sp.len(c1.list_deals(sp.record(cursor=first, limit=10)).items) == 0)
+    scenario.verify(~c1.data.positions.contains(sp.pair(userA.address, sp.pair(Status.DEAL, 0))))
+    positions(userB, Status.DEAL, [])
+
+
+    scenario.h1("Batches")
+    scenario.h2("add_loans()")
+    loanA = sp.record(amount=10_000, token=tokenETH.name, token_address=tokenETH.address, time=7*DAY, reward=100, deposit=sp.mutez(1_000_000),
+        validity=sp.none, prev=sp.none)
+    loanB = sp.record(amount=20_000, token=tokenETH.name, token_address=tokenETH.address, time=7*DAY, reward=300, deposit=sp.mutez(1_500_000_00),
+        validity=sp.some(sp.timestamp_from_utc(2022, 6, 1, 0, 0, 0)), prev=sp.none)
+    loanX = sp.record(amount=20_000, token=tokenBTC.name, token_address=tokenETH.address, time=7*DAY, reward=300, deposit=sp.mutez(1_000_000),
+        validity=sp.none, prev=sp.none)
+    c1.add_loans(loans=[loanA, loanB]).run(sender=userA, amount=sp.mutez(1_000_000 + 191), now=sp.timestamp_from_utc(2022, 5, 20, 0, 0, 0), valid = False)
+    c1.add_loans(loans=[loanA, loanX]).run(sender=userA, amount=sp.mutez(2_000_000 + 382), now=sp.timestamp_from_utc(2022, 5, 20, 0, 0, 0), valid = False)
+    c1.add_loans(loans=[loanA, loanB]).run(sender=userA, amount=sp.mutez(1_000_000 + 191 + 1_500_000_00 + 28767), now=sp.timestamp_from_utc(2022, 5, 20, 0, 0, 0))
+    scenario.verify(c1.data.nloan == 7)
+    scenario.h2("make_deals()")
+    c1.make_deals(ids=[6, 7]).run(sender=userC, now=sp.timestamp_from_utc(2022, 5, 21, 0, 0, 0), amount=sp.mutez(1), valid = False)
+    c1.make_deals(ids=[6, 7]).run(sender=userA, now=sp.timestamp_from_utc(2022, 5, 21, 0, 0, 0), valid = False)
+    c1.make_deals(ids=[6, 2, 123]).run(sender=userC, now=sp.timestamp_from_utc(2022, 5, 21, 0, 0, 0), valid = False)
+    scenario.verify(c1.data.loans[6].status == Status.REQUEST)
+    c1.make_deals(ids=[6, 7]).run(sender=userC, now=sp.timestamp_from_utc(2022, 5, 21, 0, 0, 0))
+    scenario.verify((c1.data.loans[6].status == Status.DEAL) & (c1.data.loans[7].status == Status.DEAL))
+    scenario.h2("close_deals()")
+    c1.close_deals(ids=[6, 7]).run(sender=userB, now=sp.timestamp_from_utc(2022, 5, 22, 0, 0, 0), valid = False)
+    c1.close_deals(ids=[6, 7]).run(sender=userC, now=sp.timestamp_from_utc(2022, 5, 22, 0, 0, 0), valid = False)
+    c1.close_deals(ids=[6, 7]).run(sender=userA, now=sp.timestamp_from_utc(2022, 5, 22, 0, 0, 0), amount=sp.mutez(1), valid = False)
+    c1.close_deals(ids=[6, 2]).run(sender=userA, now=sp.timestamp_from_utc(2022, 5, 22, 0, 0, 0), valid = False)
+    c1.close_deals(ids=[6, 7]).run(sender=userA, now=sp.timestamp_from_utc(2022, 5, 22, 0, 0, 0))
+    scenario.verify(~c1.data.loans.contains(6) & ~c1.data.loans.contains(7))
+
+
+    scenario.h1("Sweep")
+    scenario.h2("sweep()")
+    loanC = sp.record(amount=10_000, token=tokenETH.name, token_address=tokenETH.address, time=7*DAY, reward=100, deposit=sp.mutez(1_000_000),
+        validity=sp.some(sp.timestamp_from_utc(2022, 5, 25, 0, 0, 0)), prev=sp.none)
+    c1.add_loans(loans=[loanC, loanA]).run(sender=userA, amount=sp.mutez(2_000_000 + 382), now=sp.timestamp_from_utc(2022, 5, 22, 0, 0, 0))
+    c1.make_deal(id=9).run(sender=userC, now=sp.timestamp_from_utc(2022, 5, 22, 0, 0, 0))
+    c1.sweep(ids=[8, 9, 2, 123]).run(sender=admin, now=sp.timestamp_from_utc(2022, 5, 30, 0, 0, 0), amount=sp.mutez(1), valid = False)
+    c1.sweep(ids=list(range(MAX_SWEEP + 1))).run(sender=admin, now=sp.timestamp_from_utc(2022, 5, 30, 0, 0, 0), valid = False)
+    c1.sweep(ids=[8, 9, 2, 123]).run(sender=admin, now=sp.timestamp_from_utc(2022, 5, 24, 0, 0, 0))
+    scenario.verify(c1.data.loans.contains(8) & c1.data.loans.contains(9))
+    # any account can sweep, the tezos goes to the borrower of 8 and the creditor of 9
+    c1.sweep(ids=[8, 9, 2, 123]).run(sender=userB, now=sp.timestamp_from_utc(2022, 5, 30, 0, 0, 0))
+    scenario.verify(~c1.data.loans.contains(8) & ~c1.data.loans.contains(9) & c1.data.loans.contains(2))
+    scenario.verify(c1.data.deposits == sp.mutez(200_000_000 + 76712))
+
+
+    scenario.h1("Best offer")
+    scenario.h2("fill_best()")
+    ethId = 3
+    loanD = sp.record(amount=10_000, token=tokenETH.name, token_address=tokenETH.address, time=7*DAY, reward=100, deposit=sp.mutez(1_000_000),
+        validity=sp.none, prev=sp.none)
+    loanE = sp.record(amount=10_000, token=tokenETH.name, token_address=tokenETH.address, time=7*DAY, reward=300, deposit=sp.mutez(1_000_000),
+        validity=sp.none, prev=sp.none)
+    loanF = sp.record(amount=20_000, token=tokenETH.name, token_address=tokenETH.address, time=7*DAY, reward=600, deposit=sp.mutez(1_000_000),
+        validity=sp.some(sp.timestamp_from_utc(2022, 6, 2, 0, 0, 0)), prev=sp.none)
+    loanG = sp.record(amount=5_000, token=tokenETH.name, token_address=tokenETH.address, time=7*DAY, reward=500, deposit=sp.mutez(1_000_000),
+        validity=sp.none, prev=sp.none)
+    c1.add_loans(loans=[loanD, loanE, loanF]).run(sender=userA, amount=sp.mutez(3 * (1_000_000 + 191)), now=sp.timestamp_from_utc(2022, 6, 1, 0, 0, 0))
+    c1.add_loan_after(loanG).run(sender=userB, amount=sp.mutez(1_000_000 + 191), now=sp.timestamp_from_utc(2022, 6, 1, 0, 0, 0))
+    # the list of ETH loan requests is 13 (10%), 11 (3%), 12 (3%, added after 11), 10 (1%)
+    scenario.verify(c1.data.book[sp.pair(ethId, 0)].next == 13)
+    scenario.verify(c1.data.book[sp.pair(ethId, 13)].next == 11)
+    scenario.verify(c1.data.book[sp.pair(ethId, 11)].next == 12)
+    scenario.verify(c1.data.book[sp.pair(ethId, 12)].next == 10)
+    scenario.verify(c1.data.book[sp.pair(ethId, 0)].prev == 10)
+    c1.fill_best(token="abcd", max_amount=100_000, min_reward_rate=0).run(sender=userC, now=sp.timestamp_from_utc(2022, 6, 1, 0, 0, 0), valid = False)
+    c1.fill_best(token=tokenETH.name, max_amount=100_000, min_reward_rate=0).run(sender=userC, now=sp.timestamp_from_utc(2022, 6, 1, 0, 0, 0),
+        amount=sp.mutez(1), valid = False)
+    # 13 is sender's, 11 has a lower rate than 5%
+    c1.fill_best(token=tokenETH.name, max_amount=10_000, min_reward_rate=50_000).run(sender=userB, now=sp.timestamp_from_utc(2022, 6, 1, 0, 0, 0),
+        valid = False)
+    # 13 is sender's, 11 is the next best
+    c1.fill_best(token=tokenETH.name, max_amount=10_000, min_reward_rate=20_000).run(sender=userB, now=sp.timestamp_from_utc(2022, 6, 1, 0, 0, 0))
+    scenario.verify(c1.data.loans[11].creditor == sp.some(userB.address))
+    # 13 has the best rate, but its amount is too big
+    c1.fill_best(token=tokenETH.name, max_amount=4_000, min_reward_rate=0).run(sender=userC, now=sp.timestamp_from_utc(2022, 6, 1, 0, 0, 0),
+        valid = False)
+    c1.fill_best(token=tokenETH.name, max_amount=50_000, min_reward_rate=0).run(sender=userC, now=sp.timestamp_from_utc(2022, 6, 3, 0, 0, 0))
+    scenario.verify(c1.data.loans[13].creditor == sp.some(userC.address))
+    # 12 is expired
+    c1.fill_best(token=tokenETH.name, max_amount=50_000, min_reward_rate=0).run(sender=userC, now=sp.timestamp_from_utc(2022, 6, 3, 0, 0, 0))
+    scenario.verify(c1.data.loans[10].creditor == sp.some(userC.address))
+    scenario.verify(c1.data.loans[12].status == Status.REQUEST)
+    scenario.verify(c1.data.book[sp.pair(ethId, 0)].next == 12)
+    c1.cancel_loan(id=12).run(sender = userA)
+    scenario.verify(~c1.data.book.contains(sp.pair(ethId, 0)))
+    c1.fill_best(token=tokenETH.name, max_amount=50_000, min_reward_rate=0).run(sender=userC, now=sp.timestamp_from_utc(2022, 6, 3, 0, 0, 0),
+        valid = False)
+    c1.close_deals(ids=[10, 11, 13]).run(sender=userA, now=sp.timestamp_from_utc(2022, 6, 20, 0, 0, 0), valid = False)
+    c1.close_deals(ids=[10, 11]).run(sender=userA, now=sp.timestamp_from_utc(2022, 6, 5, 0, 0, 0))
+    c1.close_deal(id=13).run(sender=userB, now=sp.timestamp_from_utc(2022, 6, 5, 0, 0, 0))
+    scenario.verify(c1.data.deposits == sp.mutez(200_000_000 + 76712))
+
+
+    scenario.h1("Statistics")
+    scenario.h2("get_stats()")
+    tokenUSD = sp.record(name="sUSD", address=sp.test_account("USD").address, token_id=sp.none)
+    usdId = 5
+    c1.add_token(tokenUSD).run(sender = admin)
+    loanH = sp.record(amount=10_000, token=tokenUSD.name, token_address=tokenUSD.address, time=7*DAY, reward=100, deposit=sp.mutez(1_000_000),
+        validity=sp.none, prev=sp.none)
+    loanI = sp.record(amount=20_000, token=tokenUSD.name, token_address=tokenUSD.address, time=14*DAY, reward=300, deposit=sp.mutez(2_000_000),
+        validity=sp.none, prev=sp.none)
+    c1.add_loans(loans=[loanH, loanI, loanH]).run(sender=userA, amount=sp.mutez(4_000_000 + 191 + 767 + 191), now=sp.timestamp_from_utc(2022, 7, 1, 0, 0, 0))
+    scenario.verify(c1.data.stats[sp.pair(usdId, Status.REQUEST)] == sp.record(count=3, amount=40_000, reward=500, deposit=sp.mutez(4_000_000)))
+    scenario.verify(~c1.data.stats.contains(sp.pair(usdId, Status.DEAL)))
+    c1.cancel_loan(id=16).run(sender = userA)
+    c1.make_deals(ids=[14, 15]).run(sender=userB, now=sp.timestamp_from_utc(2022, 7, 1, 0, 0, 0))
+    scenario.verify(~c1.data.stats.contains(sp.pair(usdId, Status.REQUEST)))
+    scenario.verify(c1.get_stats(usdId).requests.count == 0)
+    scenario.verify(c1.get_stats(usdId).deals == sp.record(count=2, amount=30_000, reward=400, deposit=sp.mutez(3_000_000)))
+    scenario.h2("get_maturities()")
+    # the deals expire on 2022-07-08 (day 19181) and 2022-07-15 (day 19188)
+    scenario.verify(c1.data.maturities[sp.pair(usdId, 19181)] == sp.record(count=1, amount=10_000))
+    scenario.verify(c1.data.maturities[sp.pair(usdId, 19188)] == sp.record(count=1, amount=20_000))
+    scenario.verify(sp.len(c1.get_maturities(token=usdId, from_bucket=19180, count=10)) == 10)
+    scenario.verify_equal(c1.get_maturities(token=usdId, from_bucket=19181, count=1), [sp.record(bucket=19181, count=1, amount=10_000)])
+    c1.close_deal(id=14).run(sender=userA, now=sp.timestamp_from_utc(2022, 7, 2, 0, 0, 0))
+    scenario.verify(~c1.data.maturities.contains(sp.pair(usdId, 19181)))
+    scenario.verify(c1.data.stats[sp.pair(usdId, Status.DEAL)] == sp.record(count=1, amount=20_000, reward=300, deposit=sp.mutez(2_000_000)))
+    c1.close_deal(id=15).run(sender=userB, now=sp.timestamp_from_utc(2022, 7, 16, 0, 0, 0))
+    scenario.verify(~c1.data.maturities.contains(sp.pair(usdId, 19188)))
+    scenario.verify(~c1.data.stats.contains(sp.pair(usdId, Status.DEAL)))
+    scenario.verify(c1.data.deposits == sp.mutez(200_000_000 + 76712))
+
+
+    scenario.h1("FA2 tokens")
+    scenario.h2("add_token()")
+    fa2 = sp.test_account("FA2").address
+    tokenUSDT = sp.record(name="sUSDT", address=fa2, token_id=sp.some(0))
+    tokenEURT = sp.record(name="sEURT", address=fa2, token_id=sp.some(1))
+    c1.add_token(tokenUSDT).run(sender = admin)
+    c1.add_token(tokenEURT).run(sender = admin)
+    c1.add_token(tokenEURT).run(sender = admin)
+    scenario.verify(c1.data.ntoken == 7)
+    scenario.verify(c1.data.token_info[7] == sp.record(name="sEURT", address=fa2, token_id=sp.some(1)))
+    # the same contract with another FA2 token ID is another token
+    c1.add_token(name=tokenEURT.name, address=fa2, token_id=sp.some(2)).run(sender = admin)
+    c1.add_token(tokenEURT).run(sender = admin)
+    scenario.verify(c1.data.ntoken == 9)
+    scenario.verify(c1.data.tokens[tokenEURT.name].id == 9)
+    scenario.h2("make_deals()")
+    # the three token transfers are sent as one FA2 transfer call
+    loanJ = sp.record(amount=10_000, token=tokenUSDT.name, token_address=fa2, time=7*DAY, reward=100, deposit=sp.mutez(1_000_000),
+        validity=sp.none, prev=sp.none)
+    loanK = sp.record(amount=20_000, token=tokenEURT.name, token_address=fa2, time=7*DAY, reward=200, deposit=sp.mutez(1_000_000),
+        validity=sp.none, prev=sp.none)
+    c1.add_loans(loans=[loanJ, loanK]).run(sender=userA, amount=sp.mutez(2 * (1_000_000 + 191)), now=sp.timestamp_from_utc(2022, 8, 1, 0, 0, 0))
+    c1.add_loan_after(loanJ).run(sender=userB, amount=sp.mutez(1_000_000 + 191), now=sp.timestamp_from_utc(2022, 8, 1, 0, 0, 0))
+    c1.make_deals(ids=[17, 18, 19]).run(sender=userC, now=sp.timestamp_from_utc(2022, 8, 1, 0, 0, 0))
+    scenario.verify(c1.data.loans[19].creditor == sp.some(userC.address))
+    scenario.h2("close_deals()")
+    c1.close_deals(ids=[17, 18, 19]).run(sender=userA, now=sp.timestamp_from_utc(2022, 8, 2, 0, 0, 0), valid = False)
+    c1.close_deals(ids=[17, 18]).run(sender=userA, now=sp.timestamp_from_utc(2022, 8, 2, 0, 0, 0))
+    c1.close_deal(id=19).run(sender=userB, now=sp.timestamp_from_utc(2022, 8, 2, 0, 0, 0))
+    scenario.verify(~c1.data.loans.contains(19))
+    scenario.verify(c1.data.deposits == sp.mutez(200_000_000 + 76712))
+
+
+    scenario.h1("Relay")
+    scenario.h2("relay()")
+    chain = sp.chain_id_cst("0x9caecab9")
+    def permit(account, nonce, action, expiry=sp.timestamp_from_utc(2022, 10, 1, 0, 0, 0)):
+        action = sp.set_type_expr(action, TAction)
+        data = sp.pack(sp.pair(sp.pair(chain, c1.address), sp.pair(sp.pair(sp.nat(nonce), expiry), action)))
+        return sp.record(key=account.public_key, signature=sp.make_signature(account.secret_key, data, message_format="Raw"), expiry=expiry,
+            action=action)
+    loanL = sp.record(amount=10_000, token=tokenETH.name, token_address=tokenETH.address, time=7*DAY, reward=100, deposit=sp.mutez(1_000_000),
+        validity=sp.none, prev=sp.none)
+    c1.add_loans(loans=[loanL, loanL]).run(sender=userA, amount=sp.mutez(2 * (1_000_000 + 191)), now=sp.timestamp_from_utc(2022, 9, 1, 0, 0, 0))
+    c1.add_loan_after(loanL).run(sender=userB, amount=sp.mutez(1_000_000 + 191), now=sp.timestamp_from_utc(2022, 9, 1, 0, 0, 0))
+    dealC = permit(userC, 0, sp.variant("make_deal", 20))
+    c1.relay(permits=[dealC, permit(userC, 1, sp.variant("make_deal", 22))]).run(sender=admin, chain_id=chain,
+        now=sp.timestamp_from_utc(2022, 9, 1, 0, 0, 0), amount=sp.mutez(1), valid = False)
+    # replayed nonce
+    c1.relay(permits=[dealC, permit(userC, 0, sp.variant("make_deal", 22))]).run(sender=admin, chain_id=chain,
+        now=sp.timestamp_from_utc(2022, 9, 1, 0, 0, 0), valid = False)
+    # signed by another account
+    c1.relay(permits=[sp.record(key=userB.public_key, signature=dealC.signature, expiry=dealC.expiry, action=dealC.action)]).run(sender=admin, chain_id=chain,
+        now=sp.timestamp_from_utc(2022, 9, 1, 0, 0, 0), valid = False)
+    # signed for another chain
+    c1.relay(permits=[dealC]).run(sender=admin, chain_id=sp.chain_id_cst("0x7a06a770"), now=sp.timestamp_from_utc(2022, 9, 1, 0, 0, 0),
+        valid = False)
+    # expired, or with another expiry than the signed one
+    c1.relay(permits=[dealC]).run(sender=admin, chain_id=chain, now=sp.timestamp_from_utc(2022, 10, 1, 0, 0, 0),
+        valid = False, exception = Error.ILLEGAL_ARGUMENT + ":expiry")
+    c1.relay(permits=[sp.record(key=dealC.key, signature=dealC.signature, expiry=sp.timestamp_from_utc(2022, 11, 1, 0, 0, 0), action=dealC.action)]
+        ).run(sender=admin, chain_id=chain, now=sp.timestamp_from_utc(2022, 10, 1, 0, 0, 0),
+        valid = False, exception = Error.ILLEGAL_ARGUMENT + ":signature")
+    # the borrower can't fund its own loan request
+    c1.relay(permits=[permit(userA, 0, sp.variant("make_deal", 20))]).run(sender=admin, chain_id=chain,
+        now=sp.timestamp_from_utc(2022, 9, 1, 0, 0, 0), valid = False)
+    c1.relay(permits=[dealC, permit(userC, 1, sp.variant("make_deal", 22))]).run(sender=admin, chain_id=chain,
+        now=sp.timestamp_from_utc(2022, 9, 1, 0, 0, 0))
+    scenario.verify(c1.data.loans[20].creditor == sp.some(userC.address))
+    scenario.verify(c1.data.loans[22].creditor == sp.some(userC.address))
+    scenario.verify(c1.get_nonce(userC.address) == 2)
+    scenario.verify(c1.get_nonce(userA.address) == 0)
+    # the permits are used
+    c1.relay(permits=[dealC]).run(sender=admin, chain_id=chain, now=sp.timestamp_from_utc(2022, 9, 1, 0, 0, 0), valid = False)
+    c1.relay(permits=[permit(userA, 0, sp.variant("close_deal", 20)), permit(userB, 0, sp.variant("close_deal", 22)),
+        permit(userA, 1, sp.variant("cancel_loan", 21))]).run(sender=userC, chain_id=chain, now=sp.timestamp_from_utc(2022, 9, 2, 0, 0, 0))
+    scenario.verify(~c1.data.loans.contains(20) & ~c1.data.loans.contains(21) & ~c1.data.loans.contains(22))
+    scenario.verify(c1.get_nonce(userA.address) == 2)
+    scenario.verify(c1.get_nonce(userB.address) == 1)
+    scenario.verify(c1.data.deposits == sp.mutez(200_000_000 + 76712))
+    scenario.h2("increment_nonce()")
+    # userB drops the permits signed with nonces 1 and 2
+    cancelB = permit(userB, 1, sp.variant("cancel_loan", 23))
+    c1.add_loan_after(loanL).run(sender=userB, amount=sp.mutez(1_000_000 + 191), now=sp.timestamp_from_utc(2022, 9, 3, 0, 0, 0))
+    c1.increment_nonce(nonce=3).run(sender=userB, amount=sp.mutez(1), valid = False)
+    c1.increment_nonce(nonce=1).run(sender=userB, valid = False, exception = Error.ILLEGAL_ARGUMENT + ":nonce")
+    c1.increment_nonce(nonce=3).run(sender=userB)
+    scenario.verify(c1.get_nonce(userB.address) == 3)
+    c1.relay(permits=[cancelB]).run(sender=userC, chain_id=chain, now=sp.timestamp_from_utc(2022, 9, 3, 0, 0, 0),
+        valid = False, exception = Error.ILLEGAL_ARGUMENT + ":signature")
+    c1.relay(permits=[permit(userB, 3, sp.variant("cancel_loan", 23))]).run(sender=userC, chain_id=chain,
+        now=sp.timestamp_from_utc(2022, 9, 3, 0, 0, 0))
+    scenario.verify(~c1.data.loans.contains(23))
+    scenario.verify(c1.data.deposits == sp.mutez(200_000_000 + 76712))
 
 
     scenario.h1("Pause")
@@ -508,6 +1694,9 @@ def test():
         ).run(sender=userA, amount=sp.mutez(1_000_000 + 191), now=sp.timestamp_from_utc(2022, 5, 1, 0, 0, 0), valid = False)
     # Making deal is not possible
     c1.make_deal(id=2).run(sender=userC, valid = False)
+    c1.make_deals(ids=[2]).run(sender=userC, valid = False)
+    c1.fill_best(token=tokenBTC.name, max_amount=100_000, min_reward_rate=0).run(sender=userC, valid = False)
+    c1.relay(permits=[permit(userC, 2, sp.variant("make_deal", 2))]).run(sender=admin, chain_id=chain, valid = False)
 
 
     scenario.h1("Withdraw")
@@ -519,4 +1708,148 @@ def test():
     scenario.verify(c1.balance >= c1.data.deposits)
 
 
+@sp.add_test(name = "Opus loan request list")
+def test_book():
+    creator = sp.address("tz1fE6hEiRFa9ZHJeZrccNKsGW7jdxfe9vcv")
+    DAY = 86400
+    userA = sp.test_account("UserA")
+    token = sp.record(name="sETH", address=sp.address("tz1oETHo1otsXm3QxA7FmMU2Qh7xzsuGXVbc"), token_id=sp.none)
+    now = sp.timestamp_from_utc(2022, 5, 1, 0, 0, 0)
+    scenario = sp.test_scenario()
+    scenario.h1("Opus: bounded insertion into the list of loan requests")
+    scenario.p("A new loan request passes at most MAX_BOOK_WALK others, however long the list of its token is.")
+    c = Opus(creator)
+    scenario += c
+    c.add_token(token).run(sender = creator)
+    plain = lambda reward: sp.record(amount=10_000, token=token.name, token_address=token.address, time=7*DAY, reward=reward,
+        deposit=sp.mutez(1_000_000), validity=sp.none)
+    loan = lambda reward, prev: sp.record(amount=10_000, token=token.name, token_address=token.address, time=7*DAY, reward=reward,
+        deposit=sp.mutez(1_000_000), validity=sp.none, prev=prev)
+    head = sp.pair(1, 0)
+    n = MAX_BOOK_WALK + 1
+
+    scenario.h2("Insertion at the end")
+    # the loan requests of the same rate are added at the end without passing any other one
+    c.add_loans(loans=[loan(100, sp.none)] * n).run(sender=userA, amount=sp.mutez(n * (1_000_000 + 191)), now=now)
+    scenario.verify((c.data.book[head].next == 1) & (c.data.book[head].prev == n))
+    # a lower rate is added at the end at once
+    c.add_loan(plain(50)).run(sender=userA, amount=sp.mutez(1_000_000 + 191), now=now)
+    scenario.verify((c.data.book[head].prev == n + 1) & (c.data.book[sp.pair(1, n + 1)].prev == n))
+    # the same rate passes only the lower one
+    c.add_loan(plain(100)).run(sender=userA, amount=sp.mutez(1_000_000 + 191), now=now)
+    scenario.verify((c.data.book[sp.pair(1, n)].next == n + 2) & (c.data.book[sp.pair(1, n + 2)].next == n + 1))
+
+    scenario.h2("Insertion with a hint")
+    # a better rate would pass all of them from the end
+    c.add_loan(plain(200)).run(sender=userA, amount=sp.mutez(1_000_000 + 191), now=now,
+        valid = False, exception = Error.ILLEGAL_ARGUMENT + ":prev")
+    scenario.verify(c.get_book_prev(sp.record(token=1, reward=200, amount=10_000)) == 0)
+    # hints of a lower rate or not in the list are rejected
+    c.add_loan_after(loan(200, sp.some(n + 1))).run(sender=userA, amount=sp.mutez(1_000_000 + 191), now=now,
+        valid = False, exception = Error.ILLEGAL_ARGUMENT + ":prev")
+    c.add_loan_after(loan(200, sp.some(1000))).run(sender=userA, amount=sp.mutez(1_000_000 + 191), now=now,
+        valid = False, exception = Error.ILLEGAL_ARGUMENT + ":prev")
+    c.add_loan_after(loan(200, sp.some(0))).run(sender=userA, amount=sp.mutez(1_000_000 + 191), now=now)
+    scenario.verify((c.data.book[head].next == n + 3) & (c.data.book[sp.pair(1, n + 3)].next == 1))
+    # a hint too far from the place is rejected, one next to it is accepted
+    c.add_loan_after(loan(100, sp.some(n + 3))).run(sender=userA, amount=sp.mutez(1_000_000 + 191), now=now,
+        valid = False, exception = Error.ILLEGAL_ARGUMENT + ":prev")
+    # (get_book_prev doesn't pass more than MAX_BOOK_WALK loan requests either, it fails for the rate 100)
+    scenario.verify(c.get_book_prev(sp.record(token=1, reward=150, amount=10_000)) == n + 3)
+    c.add_loan_after(loan(100, sp.some(n + 2))).run(sender=userA, amount=sp.mutez(1_000_000 + 191), now=now)
+    scenario.verify((c.data.book[sp.pair(1, n + 2)].next == n + 4) & (c.data.book[sp.pair(1, n + 4)].next == n + 1))
+    scenario.verify(c.data.deposits == sp.mutez((n + 4) * (1_000_000 + 191)))
+
+
+@sp.add_test(name = "Opus list pages")
+def test_pages():
+    creator = sp.address("tz1fE6hEiRFa9ZHJeZrccNKsGW7jdxfe9vcv")
+    DAY = 86400
+    userA = sp.test_account("UserA")
+    userB = sp.test_account("UserB")
+    token = sp.record(name="sETH", address=sp.address("tz1oETHo1otsXm3QxA7FmMU2Qh7xzsuGXVbc"), token_id=sp.none)
+    now = sp.timestamp_from_utc(2022, 5, 1, 0, 0, 0)
+    scenario = sp.test_scenario()
+    scenario.h1("Opus: list pages")
+    scenario.p("A page cursor stays valid when its item is removed before the next page is read.")
+    c = Opus(creator)
+    scenario += c
+    c.add_token(token).run(sender = creator)
+    loan = sp.record(amount=10_000, token=token.name, token_address=token.address, time=7*DAY, reward=100,
+        deposit=sp.mutez(1_000_000), validity=sp.none, prev=sp.none)
+    c.add_loans(loans=[loan] * 6).run(sender=userA, amount=sp.mutez(6 * (1_000_000 + 191)), now=now)
+    first = sp.record(id=0, seq=0)
+
+    scenario.h2("Live cursor")
+    page = scenario.compute(c.list_loans(sp.record(cursor=first, limit=2)))
+    scenario.verify((sp.len(page.items) == 2) & (page.next.id == 3))
+    page = scenario.compute(c.list_loans(sp.record(cursor=page.next, limit=2)))
+    scenario.verify((sp.len(page.items) == 2) & (page.next.id == 5))
+
+    scenario.h2("Removed cursor")
+    # the next page starts at the first loan request added after the cancelled one
+    c.cancel_loan(id=5).run(sender=userA)
+    scenario.verify(c.list_loans(sp.record(cursor=page.next, limit=0)).next.id == 6)
+    scenario.verify(sp.len(c.list_loans(sp.record(cursor=page.next, limit=10)).items) == 1)
+    # the loan request of a cursor leaves the list when it is funded
+    c.make_deal(id=6).run(sender=userB, now=now)
+    scenario.verify(c.list_loans(sp.record(cursor=page.next, limit=10)).next.id == 0)
+    scenario.verify(sp.len(c.list_loans(sp.record(cursor=page.next, limit=10)).items) == 0)
+    # the cursor of a stale page of credit deals
+    c.make_deal(id=1).run(sender=userB, now=now)
+    deals = scenario.compute(c.list_deals(sp.record(cursor=first, limit=1)))
+    scenario.verify((sp.len(deals.items) == 1) & (deals.next.id == 1))
+    c.close_deal(id=1).run(sender=userA, now=now)
+    scenario.verify(sp.len(c.list_deals(sp.record(cursor=deals.next, limit=10)).items) == 0)
+    c.close_deal(id=6).run(sender=userA, now=now)
+    scenario.verify(~c.data.index.contains(sp.pair(Status.DEAL, 0)))
+    scenario.verify(c.list_deals(sp.record(cursor=deals.next, limit=10)).next == first)
+
+
+@sp.add_test(name = "Opus lazy admin entry points")
+def test_lazy_admin():
+    creator = sp.address("tz1fE6hEiRFa9ZHJeZrccNKsGW7jdxfe9vcv")
+    DAY = 86400
+    userA = sp.test_account("UserA")
+    userB = sp.test_account("UserB")
+    token = sp.record(name="sETH", address=sp.address("tz1oETHo1otsXm3QxA7FmMU2Qh7xzsuGXVbc"), token_id=sp.none)
+    scenario = sp.test_scenario()
+    scenario.h1("Opus: eager vs lazy admin entry points")
+    # the origination size and the gas of each call of the two builds are compared by profiler.py (profile.txt, see build.py)
+    scenario.p("The same calls are made on both contracts, they have to behave the same.")
+    for title, c in [("Eager admin entry points", Opus(creator)), ("Lazy admin entry points", Opus(creator, lazy_admin = True))]:
+        scenario.h2(title)
+        scenario += c
+        c.add_token(token).run(sender = creator)
+        c.set_fee(fee=200).run(sender = userA, valid = False)
+        c.set_fee(fee=200).run(sender = creator)
+        c.set_fee(fee=100).run(sender = creator)
+        c.add_loan(amount=10_000, token=token.name, token_address=token.address, time=7*DAY, reward=100, deposit=sp.mutez(1_000_000),
+            validity=sp.none
+            ).run(sender=userA, amount=sp.mutez(1_000_000 + 191), now=sp.timestamp_from_utc(2022, 5, 1, 0, 0, 0))
+        c.make_deal(id=1).run(sender=userB, now=sp.timestamp_from_utc(2022, 5, 2, 0, 0, 0))
+        c.close_deal(id=1).run(sender=userA, now=sp.timestamp_from_utc(2022, 5, 3, 0, 0, 0))
+        scenario.verify(c.data.deposits == sp.mutez(0))
+
+
+@sp.add_test(name = "Opus compact errors")
+def test_compact_errors():
+    creator = sp.address("tz1fE6hEiRFa9ZHJeZrccNKsGW7jdxfe9vcv")
+    userA = sp.test_account("UserA")
+    token = sp.record(name="sETH", address=sp.address("tz1oETHo1otsXm3QxA7FmMU2Qh7xzsuGXVbc"), token_id=sp.none)
+    scenario = sp.test_scenario()
+    scenario.h1("Opus: string vs numeric error codes")
+    scenario.p("The same failing calls are made on both contracts to compare their code size and errors.")
+    for title, c, error in [("Error messages", Opus(creator), lambda message: message),
+                            ("Error codes", Opus(creator, compact_errors = True), lambda message: sp.nat(ERROR_CODES[message]))]:
+        scenario.h2(title)
+        scenario += c
+        c.add_token(token).run(sender = creator)
+        c.set_fee(fee=200).run(sender = userA, valid = False, exception = error(Error.ACCESS_DENIED))
+        c.set_fee(fee=200).run(sender = creator, amount = sp.mutez(1), valid = False, exception = error(Error.ILLEGAL_TX_AMOUNT))
+        c.make_deal(id=1).run(sender = userA, valid = False, exception = error(Error.ILLEGAL_ARGUMENT + ":id"))
+
+
 sp.add_compilation_target("opus", Opus("tz1fE6hEiRFa9ZHJeZrccNKsGW7jdxfe9vcv"))
+sp.add_compilation_target("opus_lazy", Opus("tz1fE6hEiRFa9ZHJeZrccNKsGW7jdxfe9vcv", lazy_admin = True))
+sp.add_compilation_target("opus_compact", Opus("tz1fE6hEiRFa9ZHJeZrccNKsGW7jdxfe9vcv", compact_errors = True))
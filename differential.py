@@ -0,0 +1,280 @@
+import os
+
+import smartpy as sp
+
+contract = sp.io.import_script_from_url("file:contract.py")
+Opus = contract.Opus
+model = sp.io.import_script_from_url("file:model.py")
+
+
+#########################################################################################################
+# Differential test of the Opus contract against the reference model (model.py).                        #
+#                                                                                                       #
+# A random trace is applied to the model, then replayed through the contract: every call has to       #
+# succeed or fail with the same error message as in the model, and the storage has to match the       #
+# model state every CHECK_EVERY calls and at the end.                                                   #
+# The operations the contract emits are compared with the model operations too: the token contracts     #
+# are TokenLog mocks which record every transfer they receive (the batches of the FA2 calls included),  #
+# and the contract balance is checked after every call for the tezos sent. The receivers of the tezos   #
+# and the events are not visible in the test interpreter, the indexer checks the events (indexer.py).   #
+#                                                                                                       #
+# Run: SmartPy.sh test differential.py <output-directory>                                               #
+# Set DIFFERENTIAL_CALLS and DIFFERENTIAL_SEED to change the length and the seed of the trace.          #
+#########################################################################################################
+
+CALLS = int(os.environ.get("DIFFERENTIAL_CALLS", "300"))
+SEED = int(os.environ.get("DIFFERENTIAL_SEED", "0"))
+CHECK_EVERY = 50
+INITIAL_BALANCE = 1000 * 1_000_000
+CHAIN_ID = sp.chain_id_cst("0x9caecab9")
+
+# A transfer recorded by TokenLog: the number of the transfer call, source, destination, token ID (0 for FA1.2) and amount.
+TRow = sp.TRecord(call = sp.TNat, from_ = sp.TAddress, to_ = sp.TAddress, token_id = sp.TNat, amount = sp.TNat)
+# Parameter of the FA1.2 transfer entry point.
+TFA12Transfer = sp.TRecord(from_ = sp.TAddress, to_ = sp.TAddress, value = sp.TNat).layout(("from_ as from", ("to_ as to", "value")))
+
+
+# Contract call parameters of a trace call.
+# @addresses – model address -> SmartPy address
+# @opus – contract address, the permits of relay calls are signed for it
+#
+def call_params(entry_point, params, addresses, opus):
+    if entry_point in ("add_loan", "add_loan_after"):
+        loan = params["loan"]
+        fields = dict(
+            token = loan["token"],
+            token_address = addresses[loan["token_address"]],
+            amount = sp.nat(loan["amount"]),
+            reward = sp.nat(loan["reward"]),
+            deposit = sp.mutez(loan["deposit"]),
+            time = sp.nat(loan["time"]),
+            validity = sp.none if loan["validity"] is None else sp.some(sp.timestamp(loan["validity"]))
+        )
+        # the add_loan parameter has no prev hint
+        if entry_point == "add_loan_after":
+            fields["prev"] = sp.none if loan["prev"] is None else sp.some(sp.nat(loan["prev"]))
+        return sp.record(**fields)
+    if entry_point == "add_token":
+        token_id = params.get("token_id")
+        return sp.record(name = params["name"], address = addresses[params["address"]],
+            token_id = sp.none if token_id is None else sp.some(sp.nat(token_id)))
+    if entry_point in ("make_deals", "close_deals", "sweep"):
+        return sp.record(ids = sp.list([sp.nat(id) for id in params["ids"]], t = sp.TNat))
+    if entry_point in ("make_deal", "close_deal", "cancel_loan"):
+        return sp.record(id = sp.nat(params["id"]))
+    if entry_point == "fill_best":
+        return sp.record(token = params["token"], max_amount = sp.nat(params["max_amount"]), min_reward_rate = sp.nat(params["min_reward_rate"]))
+    if entry_point == "relay":
+        return sp.record(permits = sp.list([permit(signer, nonce, expiry, action, opus) for (signer, nonce, expiry, action) in params["permits"]]))
+    if entry_point == "increment_nonce":
+        return sp.record(nonce = sp.nat(params["nonce"]))
+    if entry_point == "set_fee":
+        return sp.record(fee = sp.nat(params["fee"]))
+    raise ValueError(entry_point)
+
+
+# Permit of a model permit, signed with the test account key of the signer for CHAIN_ID.
+#
+def permit(signer, nonce, expiry, action, opus):
+    account = sp.test_account(signer)
+    action = sp.set_type_expr(sp.variant(action[0], sp.nat(action[1])), contract.TAction)
+    data = sp.pack(sp.pair(sp.pair(CHAIN_ID, opus), sp.pair(sp.pair(sp.nat(nonce), sp.timestamp(expiry)), action)))
+    return sp.record(key = account.public_key, signature = sp.make_signature(account.secret_key, data, message_format = "Raw"),
+        expiry = sp.timestamp(expiry), action = action)
+
+
+# Token contract mock recording the transfers of the "transfer" calls it receives, FA1.2 or FA2 (fa2 = True).
+#
+class TokenLog(sp.Contract):
+    def __init__(self, fa2):
+        self.fa2 = fa2
+        self.init(ncall = sp.nat(0), nrow = sp.nat(0), rows = sp.big_map(tkey = sp.TNat, tvalue = TRow))
+
+    @sp.entry_point
+    def transfer(self, params):
+        if self.fa2:
+            sp.set_type(params, sp.TList(contract.TFA2Transfer))
+            sp.for transfer in params:
+                sp.for tx in transfer.txs:
+                    self.add_row(transfer.from_, tx.to_, tx.token_id, tx.amount)
+        else:
+            sp.set_type(params, TFA12Transfer)
+            self.add_row(params.from_, params.to_, 0, params.value)
+        self.data.ncall += 1
+
+    def add_row(self, f, t, token_id, amount):
+        self.data.rows[self.data.nrow] = sp.record(call = self.data.ncall, from_ = f, to_ = t, token_id = token_id, amount = amount)
+        self.data.nrow += 1
+
+
+# Append the token transfers of model operations to the expected TokenLog rows.
+# @logs – token address -> (number of transfer calls, list of (call, from, to, token ID, amount) rows)
+# @operations – model operations of a successful call (see model.Opus)
+#
+def log_operations(logs, operations):
+    for operation in operations:
+        if operation[0] == "send":
+            continue
+        (ncall, rows) = logs.setdefault(operation[1], [0, []])
+        if operation[0] == "transfer":
+            (_, _, f, t, amount) = operation
+            rows.append((ncall, f, t, 0, amount))
+        else:
+            for (f, txs) in operation[2]:
+                rows += [(ncall, f, t, token_id, amount) for (t, token_id, amount) in txs]
+        logs[operation[1]][0] += 1
+
+
+# Check the transfers recorded by the token contract mocks against the expected rows (see log_operations).
+# @tokens – token address -> TokenLog
+# @checked – token address -> number of rows checked so far, the rows are checked once
+#
+def check_operations(scenario, tokens, logs, checked, addresses):
+    for address, token in tokens.items():
+        (ncall, rows) = logs.get(address, [0, []])
+        scenario.verify((token.data.ncall == ncall) & (token.data.nrow == len(rows)))
+        for i in range(checked.get(address, 0), len(rows)):
+            (call, f, t, token_id, amount) = rows[i]
+            scenario.verify(token.data.rows[i] == sp.record(call = call, from_ = addresses[f], to_ = addresses[t], token_id = token_id, amount = amount))
+        checked[address] = len(rows)
+
+
+# Check the contract storage against the model state: all the fields of the live loan requests and credit deals,
+# every node of the linked lists (index, book and positions) and the entries of the other big maps.
+#
+def check_state(scenario, c, m, addresses):
+    scenario.verify(c.data.nloan == m.nloan)
+    scenario.verify(c.data.nseq == m.nseq)
+    scenario.verify(c.data.ntoken == m.ntoken)
+    scenario.verify(c.data.fee == m.fee)
+    scenario.verify(c.data.deposits == sp.mutez(m.deposits))
+    scenario.verify(c.balance == sp.mutez(m.balance))
+    option = lambda value, f: sp.none if value is None else sp.some(f(value))
+    for id in range(1, m.nloan + 1):
+        loan = m.loans.get(id)
+        if loan is None:
+            scenario.verify(~c.data.loans.contains(id))
+            scenario.verify(~c.data.index.contains(sp.pair(model.REQUEST, id)) & ~c.data.index.contains(sp.pair(model.DEAL, id)))
+            continue
+        scenario.verify(c.data.loans[id] == sp.record(
+            status = loan.status,
+            ts = sp.timestamp(loan.ts),
+            borrower = addresses[loan.borrower],
+            creditor = option(loan.creditor, lambda creditor: addresses[creditor]),
+            validity = option(loan.validity, sp.timestamp),
+            exp = option(loan.exp, sp.timestamp),
+            amount = loan.amount,
+            token = loan.token,
+            time = loan.time,
+            reward = loan.reward,
+            deposit = sp.mutez(loan.deposit),
+            fee = sp.mutez(loan.fee)
+        ))
+    for status in (model.REQUEST, model.DEAL):
+        check_list(scenario, c.data.index, lambda id: sp.pair(status, id), m.index[status])
+    for address, position in m.positions.items():
+        for (status, nodes) in zip((model.REQUEST, model.DEAL), position):
+            check_list(scenario, c.data.positions, lambda id: sp.pair(addresses[address], sp.pair(status, id)), nodes)
+    for token in range(1, m.ntoken + 1):
+        check_list(scenario, c.data.book, lambda id: sp.pair(token, id), [id for (_, id) in m.book.get(token, [])])
+        for status in (model.REQUEST, model.DEAL):
+            totals = m.stats.get((token, status))
+            if totals is None:
+                scenario.verify(~c.data.stats.contains(sp.pair(token, status)))
+            else:
+                (count, amount, reward, deposit) = totals
+                scenario.verify(c.data.stats[sp.pair(token, status)] == sp.record(count = count, amount = amount, reward = reward, deposit = sp.mutez(deposit)))
+    for (token, bucket), (count, amount) in m.maturities.items():
+        scenario.verify(c.data.maturities[sp.pair(token, bucket)] == sp.record(count = count, amount = amount))
+    for id, (name, address, token_id) in m.token_info.items():
+        scenario.verify(c.data.token_info[id] == sp.record(name = name, address = addresses[address], token_id = option(token_id, sp.nat)))
+        if name in m.tokens:
+            scenario.verify(c.data.tokens[name] == sp.record(id = id, address = addresses[address], token_id = option(token_id, sp.nat)))
+        else:
+            scenario.verify(~c.data.tokens.contains(name))
+    for address, nonce in m.nonces.items():
+        scenario.verify(c.data.nonces[addresses[address]] == nonce)
+
+
+# Check a doubly linked list of the contract storage node by node against the IDs of a model list.
+# The nodes with sequence numbers (index and positions) are checked against the id -> seq dicts of the model.
+# @nodes – big map of the list nodes
+# @key – function of an item ID to its key in the big map (the head of the list is the item 0)
+# @ids – IDs of the list in order (an id -> seq dict for the lists with sequence numbers)
+#
+def check_list(scenario, nodes, key, ids):
+    items = list(ids)
+    if not items:
+        scenario.verify(~nodes.contains(key(0)))
+        return
+    items = [0] + items + [0]
+    for i in range(1, len(items) - 1):
+        scenario.verify(nodes[key(items[i])].prev == items[i - 1])
+        scenario.verify(nodes[key(items[i])].next == items[i + 1])
+        if isinstance(ids, dict):
+            scenario.verify(nodes[key(items[i])].seq == ids[items[i]])
+    scenario.verify((nodes[key(0)].next == items[1]) & (nodes[key(0)].prev == items[-2]))
+
+
+@sp.add_test(name = "Opus differential")
+def test():
+    trace = model.random_trace(CALLS, SEED)
+    m = model.Opus(model.CREATOR, balance = INITIAL_BALANCE)
+    outcomes = model.run(m, trace)
+    addresses = {name : sp.test_account(name).address for name in [model.CREATOR] + model.USERS}
+    scenario = sp.test_scenario()
+    scenario.h1("Opus differential test (%d calls, seed %d)" % (CALLS, SEED))
+    fa2 = {address for (_, address, _) in model.FA2_TOKENS}
+    tokens = {address : TokenLog(address in fa2) for address in sorted({token[1] for token in model.TOKENS + model.FA2_TOKENS})}
+    for address, token in tokens.items():
+        scenario += token
+        addresses[address] = token.address
+    c = Opus(addresses[model.CREATOR])
+    c.set_initial_balance(sp.mutez(INITIAL_BALANCE))
+    scenario += c
+
+    # replay the trace on a fresh model as well to check the state and the operations at the checkpoints
+    replay = model.Opus(model.CREATOR, balance = INITIAL_BALANCE)
+    logs = {}
+    checked = {}
+    for i, (call, outcome) in enumerate(zip(trace, outcomes)):
+        (entry_point, params, sender, now, amount) = call
+        run = dict(sender = addresses[sender], now = sp.timestamp(now), amount = sp.mutez(amount), chain_id = CHAIN_ID)
+        operations = len(replay.operations)
+        model.run(replay, [call])
+        if outcome is None:
+            getattr(c, entry_point)(call_params(entry_point, params, addresses, c.address)).run(**run)
+            log_operations(logs, replay.operations[operations:])
+            # the tezos sent by the call
+            scenario.verify(c.balance == sp.mutez(replay.balance))
+        else:
+            getattr(c, entry_point)(call_params(entry_point, params, addresses, c.address)).run(valid = False, exception = outcome, **run)
+        if (i + 1) % CHECK_EVERY == 0:
+            scenario.h2("State after %d calls" % (i + 1))
+            check_state(scenario, c, replay, addresses)
+            check_operations(scenario, tokens, logs, checked, addresses)
+
+    scenario.h2("Final state")
+    m.check()
+    check_state(scenario, c, m, addresses)
+    check_operations(scenario, tokens, logs, checked, addresses)
+
+
+# Quotes of model.service_fee (and quote.py, which is checked against it) have to match the quote_fee view,
+# which uses the same helper as add_loan. This is the only check of quote.py against the contract itself, the
+# deposits and times cover the edges of the formula: 0, the rounding boundaries, 2**53 + 1 (beyond the float
+# mantissa) and products far beyond 64 bits.
+@sp.add_test(name = "Opus fee quotes")
+def test_quotes():
+    scenario = sp.test_scenario()
+    scenario.h1("Opus fee quotes")
+    c = Opus(sp.test_account(model.CREATOR).address)
+    scenario += c
+    for fee in [1, 100, 9999]:
+        if fee != 100:
+            c.set_fee(fee = fee).run(sender = sp.test_account(model.CREATOR))
+        scenario.h2("fee %d" % fee)
+        for deposit in [0, 1, 999_999, 1_000_000, 150_000_000, 2**53 + 1, 9 * 10**15]:
+            for time in [1, 7 * 86400, 180 * 86400, 315360000]:
+                expected = model.service_fee(deposit, time, fee)
+                scenario.verify(c.quote_fee(sp.record(deposit = sp.mutez(deposit), time = sp.nat(time))) == sp.mutez(expected))
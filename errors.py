@@ -0,0 +1,58 @@
+#########################################################################################################
+# Error messages of the Opus contract and their numeric codes, shared by the contract (contract.py)     #
+# and the off-chain tools (model.py, client.py).                                                        #
+#                                                                                                       #
+# The builds with compact errors (see Opus compact_errors) fail with the code of a message instead of   #
+# the message: pushing a nat code takes 6-7 bytes of the code instead of 18-42 bytes for a message in   #
+# every failing branch. The off-chain tools map the codes back to the messages with MESSAGES. A code    #
+# is never reused for another message.                                                                  #
+#########################################################################################################
+
+# The contract function is not accessible for the sender.
+ACCESS_DENIED = "OD_ACCESS_DENIED"
+
+# The corresponding argument value is invalid.
+ILLEGAL_ARGUMENT = "OD_ILLEGAL_ARGUMENT"
+
+# The corresponding transaction has incorrect tezos amount.
+ILLEGAL_TX_AMOUNT = "OD_ILLEGAL_TX_AMOUNT"
+
+# The contract is paused.
+PAUSED = "OD_PAUSED"
+
+# There is no loan request matching the arguments.
+NO_MATCH = "OD_NO_MATCH"
+
+# error message -> numeric code
+CODES = {
+    ACCESS_DENIED : 1,
+    ILLEGAL_TX_AMOUNT : 2,
+    PAUSED : 3,
+    NO_MATCH : 4,
+    ILLEGAL_ARGUMENT + ":address" : 10,
+    ILLEGAL_ARGUMENT + ":amount" : 11,
+    ILLEGAL_ARGUMENT + ":baker" : 12,
+    ILLEGAL_ARGUMENT + ":deposit" : 13,
+    ILLEGAL_ARGUMENT + ":fee" : 14,
+    ILLEGAL_ARGUMENT + ":id" : 16,
+    ILLEGAL_ARGUMENT + ":ids" : 17,
+    ILLEGAL_ARGUMENT + ":min" : 18,
+    ILLEGAL_ARGUMENT + ":min,max" : 19,
+    ILLEGAL_ARGUMENT + ":min_deposit" : 20,
+    ILLEGAL_ARGUMENT + ":name" : 21,
+    ILLEGAL_ARGUMENT + ":now" : 22,
+    ILLEGAL_ARGUMENT + ":pause" : 23,
+    ILLEGAL_ARGUMENT + ":sender" : 24,
+    ILLEGAL_ARGUMENT + ":signature" : 25,
+    ILLEGAL_ARGUMENT + ":time" : 26,
+    ILLEGAL_ARGUMENT + ":token" : 27,
+    ILLEGAL_ARGUMENT + ":token_address" : 28,
+    ILLEGAL_ARGUMENT + ":validity" : 29,
+    ILLEGAL_ARGUMENT + ":prev" : 30,
+    ILLEGAL_ARGUMENT + ":expiry" : 31,
+    ILLEGAL_ARGUMENT + ":nonce" : 32,
+    ILLEGAL_ARGUMENT + ":cursor" : 33
+}
+
+# numeric code -> error message
+MESSAGES = {code : message for (message, code) in CODES.items()}
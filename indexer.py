@@ -0,0 +1,502 @@
+import argparse
+import json
+import sqlite3
+import sys
+import time as timer
+import urllib.request
+
+import micheline
+from micheline import t
+
+import model
+
+
+#########################################################################################################
+# Streaming indexer of the Opus contract into a local SQLite database.                                  #
+#                                                                                                       #
+# Blocks are read one by one from a Tezos RPC node. Live loan requests and credit deals are maintained  #
+# from the contract events (loan_added, loan_cancelled, deal_made, deal_closed) and the token registry  #
+# from the big map diffs of "token_info"; the service fees of closed credit deals are summed per token  #
+# from the deal_closed events (see Store.fee_revenue). A block and the checkpoint (its level and hash)  #
+# are stored in one database transaction, so the indexer resumes after a restart from the last stored   #
+# block. Blocks are read "confirmations" levels behind the head, so they are final and no               #
+# reorganisation has to be handled; a predecessor hash which doesn't match the checkpoint stops the     #
+# indexer.                                                                                              #
+#                                                                                                       #
+# Run: python3 indexer.py --rpc URL --contract KT1... --start LEVEL --db opus.db [--follow]             #
+#      python3 indexer.py --mock [calls]   (offline test against the reference model, see MockRPC)      #
+#      python3 indexer.py --check fixtures/indexer_blocks.json fixtures/indexer_state.json              #
+#########################################################################################################
+
+REQUEST = model.REQUEST
+DEAL = model.DEAL
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoint (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    level INTEGER NOT NULL,
+    hash TEXT,
+    token_big_map INTEGER
+);
+CREATE TABLE IF NOT EXISTS tokens (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    address TEXT NOT NULL,
+    token_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS loans (
+    id INTEGER PRIMARY KEY,
+    status INTEGER NOT NULL,
+    borrower TEXT NOT NULL,
+    creditor TEXT,
+    token INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    reward INTEGER NOT NULL,
+    deposit INTEGER NOT NULL,
+    fee INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    validity INTEGER,
+    exp INTEGER,
+    level INTEGER NOT NULL,
+    ts INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS revenue (
+    token INTEGER PRIMARY KEY,
+    deals INTEGER NOT NULL,
+    fee INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS loans_token ON loans (status, token, id);
+CREATE INDEX IF NOT EXISTS loans_exp ON loans (status, exp);
+CREATE INDEX IF NOT EXISTS loans_borrower ON loans (borrower);
+CREATE INDEX IF NOT EXISTS loans_creditor ON loans (creditor);
+"""
+
+# SQLite integers are 64 bit, larger token amounts are stored as text.
+MAX_INTEGER = 2**63 - 1
+
+
+class IndexerError(Exception):
+    pass
+
+
+# Tezos RPC node client.
+# @url – node URL, e.g. https://mainnet.api.tez.ie
+# @record – optional list, the fetched blocks are appended to it (see --record)
+#
+class RPC:
+    def __init__(self, url, record = None, timeout = 30):
+        self.url = url.rstrip("/")
+        self.record = record
+        self.timeout = timeout
+
+    def get(self, path):
+        with urllib.request.urlopen(self.url + path, timeout = self.timeout) as response:
+            return json.load(response)
+
+    def head_level(self):
+        return self.get("/chains/main/blocks/head/header")["level"]
+
+    def block(self, level):
+        block = self.get("/chains/main/blocks/%d" % level)
+        if self.record is not None:
+            self.record.append(block)
+        return block
+
+
+# Local database of the indexed state.
+# @path – SQLite database file (":memory:" for a temporary database)
+#
+class Store:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def checkpoint(self):
+        return self.db.execute("SELECT level, hash, token_big_map FROM checkpoint").fetchone()
+
+    def set_checkpoint(self, level, hash, token_big_map):
+        self.db.execute("INSERT OR REPLACE INTO checkpoint VALUES (0, ?, ?, ?)", (level, hash, token_big_map))
+
+    def commit(self):
+        self.db.commit()
+
+    # Live loan requests of a token (all tokens if token is None), in the order they were added.
+    #
+    def open_loans(self, token = None, limit = 100):
+        if token is None:
+            return self.db.execute("SELECT * FROM loans WHERE status = ? ORDER BY id LIMIT ?", (REQUEST, limit)).fetchall()
+        return self.db.execute("SELECT * FROM loans WHERE status = ? AND token = ? ORDER BY id LIMIT ?", (REQUEST, token, limit)).fetchall()
+
+    # Credit deals expiring before now + hours (including the timed out ones), the earliest first.
+    #
+    def expiring_deals(self, now, hours):
+        return self.db.execute("SELECT * FROM loans WHERE status = ? AND exp <= ? ORDER BY exp", (DEAL, now + hours * 3600)).fetchall()
+
+    # Tezos locked by live loan requests (deposit and fee) and credit deals (deposit) per token ID,
+    # the total is the contract "deposits".
+    #
+    def locked_deposits(self):
+        return dict(self.db.execute("SELECT token, SUM(deposit + CASE status WHEN ? THEN fee ELSE 0 END) FROM loans GROUP BY token",
+            (REQUEST,)).fetchall())
+
+    # Service fees earned per token ID: token ID -> (number of credit deals, fees) of the closed and live credit deals.
+    #
+    def fee_revenue(self):
+        revenue = {token : (deals, fee) for (token, deals, fee) in self.db.execute("SELECT token, deals, fee FROM revenue")}
+        for (token, deals, fee) in self.db.execute("SELECT token, COUNT(*), SUM(fee) FROM loans WHERE status = ? GROUP BY token", (DEAL,)):
+            (closed, closed_fee) = revenue.get(token, (0, 0))
+            revenue[token] = (closed + deals, closed_fee + fee)
+        return revenue
+
+    # Token registry: token ID -> (name, address, FA2 token ID or None for FA1.2 tokens).
+    #
+    def tokens(self):
+        return {id : (name, address, token_id) for (id, name, address, token_id) in self.db.execute("SELECT id, name, address, token_id FROM tokens")}
+
+
+# Indexer of one contract.
+# @rpc – RPC (or MockRPC)
+# @store – Store
+# @contract – contract address
+# @start – first level to index (the origination level) if the database is empty
+# @token_big_map – ID of the "token_info" big map, detected from the origination if not given
+# @confirmations – number of levels behind the head to index
+# @commit_every – number of blocks per database transaction while catching up
+#
+class Indexer:
+    def __init__(self, rpc, store, contract, start = 0, token_big_map = None, confirmations = 2, commit_every = 100):
+        self.rpc = rpc
+        self.store = store
+        self.contract = contract
+        self.confirmations = confirmations
+        self.commit_every = commit_every
+        checkpoint = store.checkpoint()
+        if checkpoint is None:
+            store.set_checkpoint(start - 1, None, token_big_map)
+            store.commit()
+            checkpoint = store.checkpoint()
+        (self.level, self.hash, self.token_big_map) = checkpoint
+
+    # Index the blocks up to the given level (head - confirmations by default).
+    # Returns the last indexed level.
+    #
+    def sync(self, target = None):
+        if target is None:
+            target = self.rpc.head_level() - self.confirmations
+        pending = 0
+        while self.level < target:
+            self.apply_block(self.rpc.block(self.level + 1))
+            pending += 1
+            if pending >= self.commit_every:
+                self.store.commit()
+                pending = 0
+        self.store.commit()
+        return self.level
+
+    # Index new blocks as they come.
+    # @poll – seconds between head requests
+    #
+    def follow(self, poll = 5):
+        while True:
+            self.sync()
+            timer.sleep(poll)
+
+    def apply_block(self, block):
+        header = block["header"]
+        if header["level"] != self.level + 1 or (self.hash is not None and header["predecessor"] != self.hash):
+            raise IndexerError("block %s at level %d doesn't follow the checkpoint %s at level %d" % (block["hash"], header["level"], self.hash, self.level))
+        level = header["level"]
+        ts = micheline.timestamp_from_string(header["timestamp"])
+        for group in block["operations"][3] if len(block["operations"]) > 3 else []:
+            for content in group["contents"]:
+                self.apply_operation(content, level, ts)
+        self.level = level
+        self.hash = block["hash"]
+        self.store.set_checkpoint(self.level, self.hash, self.token_big_map)
+
+    def apply_operation(self, content, level, ts):
+        metadata = content.get("metadata", {})
+        result = metadata.get("operation_result", {})
+        if result.get("status") != "applied":
+            return
+        if content["kind"] == "origination" and self.contract in result.get("originated_contracts", []):
+            self.detect_token_big_map(result.get("lazy_storage_diff", []))
+        if content["kind"] == "transaction" and content.get("destination") == self.contract:
+            self.apply_big_map_diff(result.get("lazy_storage_diff", []))
+        for internal in metadata.get("internal_operation_results", []):
+            if internal["result"].get("status") != "applied":
+                continue
+            if internal["kind"] == "event" and internal["source"] == self.contract:
+                self.apply_event(internal["tag"], micheline.decode(internal["type"], internal["payload"]), level, ts)
+            elif internal["kind"] == "transaction" and internal.get("destination") == self.contract:
+                self.apply_big_map_diff(internal["result"].get("lazy_storage_diff", []))
+
+    def detect_token_big_map(self, diffs):
+        if self.token_big_map is not None:
+            return
+        for diff in diffs:
+            if diff["kind"] != "big_map" or diff["diff"]["action"] != "alloc":
+                continue
+            (key_type, value_type) = (diff["diff"]["key_type"], diff["diff"]["value_type"])
+            # nat -> record(name, address, token_id) is the only big map of this type in the storage
+            if key_type["prim"] == "nat" and value_type["prim"] == "pair" and \
+                    [leaf["prim"] for leaf in micheline.leaves(value_type)] == ["address", "string", "option"]:
+                self.token_big_map = int(diff["id"])
+
+    def apply_big_map_diff(self, diffs):
+        for diff in diffs:
+            if diff["kind"] != "big_map" or int(diff["id"]) != self.token_big_map or diff["diff"]["action"] != "update":
+                continue
+            for update in diff["diff"]["updates"]:
+                # token_info entries are never removed
+                if "value" in update:
+                    token = micheline.decode(TOKEN_INFO_TYPE, update["value"])
+                    self.store.db.execute("INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)", (int(update["key"]["int"]),
+                        token["name"], token["address"], token["token_id"]))
+
+    def apply_event(self, tag, event, level, ts):
+        db = self.store.db
+        if tag == "loan_added":
+            db.execute("INSERT INTO loans VALUES (?, ?, ?, NULL, ?, ?, ?, ?, ?, ?, ?, NULL, ?, ?)", (event["id"], REQUEST, event["borrower"],
+                event["token"], sql_int(event["amount"]), sql_int(event["reward"]), event["deposit"], event["fee"], event["time"],
+                event["validity"], level, ts))
+        elif tag == "deal_made":
+            db.execute("UPDATE loans SET status = ?, creditor = ?, exp = ? WHERE id = ?", (DEAL, event["creditor"], event["exp"], event["id"]))
+        elif tag in ("loan_cancelled", "deal_closed"):
+            db.execute("DELETE FROM loans WHERE id = ?", (event["id"],))
+        if tag == "deal_closed":
+            db.execute("INSERT INTO revenue VALUES (?, 1, ?) ON CONFLICT (token) DO UPDATE SET deals = deals + 1, fee = fee + excluded.fee",
+                (event["token"], event["fee"]))
+
+
+def sql_int(value):
+    return value if value <= MAX_INTEGER else str(value)
+
+
+
+#########################################################################################################
+# Offline testing.                                                                                      #
+# MockRPC serves the blocks of a recorded fixture (see --record), or blocks built from a random trace  #
+# of the reference model: one block per call, with the events and the token_info big map diffs the     #
+# contract produces for it (failed calls are included with the "failed" status).                      #
+# The model blocks are encoded by this file, so they don't test the decoding of the node JSON; this is #
+# what fixtures/indexer_blocks.json (checked with --check) is for: blocks in the node RPC format with  #
+# the origination allocating all the big maps, values in the optimized form (addresses as bytes,       #
+# timestamps as numbers), consensus operations, a backtracked batch, internal token transfers and a    #
+# relayed permit. The blocks are assembled by hand from the contract types, not captured from a node;   #
+# replace them with a --record capture of a testnet run of the contract when one is at hand:            #
+#   python3 indexer.py --rpc URL --contract KT1... --start LEVEL --db /tmp/capture.db                   #
+#     --record fixtures/indexer_blocks.json                                                             #
+# and take the expected state of fixtures/indexer_state.json from the storage of the contract (not from #
+# the database of the indexer, which is what is tested).                                                #
+#########################################################################################################
+
+MOCK_CONTRACT = "KT1PWx2mnDueood7fEmfbBDKx1D9BAnnXitn"
+MOCK_TOKEN_BIG_MAP = 7
+
+OUTCOME = micheline.variant_type([("repaid", t("unit")), ("liquidated", t("unit"))])
+EVENT_TYPES = {
+    "loan_added" : micheline.record_type([("id", t("nat")), ("borrower", t("address")), ("token", t("nat")), ("amount", t("nat")),
+        ("reward", t("nat")), ("deposit", t("mutez")), ("fee", t("mutez")), ("time", t("nat")), ("validity", t("option", t("timestamp")))]),
+    "loan_cancelled" : micheline.record_type([("id", t("nat")), ("borrower", t("address")), ("token", t("nat")), ("refund", t("mutez"))]),
+    "deal_made" : micheline.record_type([("id", t("nat")), ("borrower", t("address")), ("creditor", t("address")), ("token", t("nat")),
+        ("amount", t("nat")), ("reward", t("nat")), ("deposit", t("mutez")), ("fee", t("mutez")), ("exp", t("timestamp"))]),
+    "deal_closed" : micheline.record_type([("id", t("nat")), ("borrower", t("address")), ("creditor", t("address")), ("token", t("nat")),
+        ("repayment", t("nat")), ("deposit", t("mutez")), ("fee", t("mutez")), ("receiver", t("address")), ("outcome", OUTCOME)]),
+}
+TOKEN_INFO_TYPE = micheline.record_type([("name", t("string")), ("address", t("address")), ("token_id", t("option", t("nat")))])
+
+
+class MockRPC:
+    def __init__(self, blocks):
+        self.blocks = {block["header"]["level"] : block for block in blocks}
+        self.head = max(self.blocks)
+
+    def head_level(self):
+        return self.head
+
+    def block(self, level):
+        if level not in self.blocks:
+            raise IndexerError("no block at level %d" % level)
+        return self.blocks[level]
+
+    # Blocks of a recorded fixture file.
+    #
+    @staticmethod
+    def load(path):
+        return MockRPC(json.load(open(path)))
+
+    # Blocks of a model trace (see model.random_trace), the contract is originated at level 1.
+    #
+    @staticmethod
+    def from_trace(trace, contract = MOCK_CONTRACT):
+        m = model.Opus(model.CREATOR, balance = 1000 * 1_000_000)
+        origination = {"kind" : "origination", "metadata" : {"operation_result" : {"status" : "applied", "originated_contracts" : [contract],
+            "lazy_storage_diff" : [{"kind" : "big_map", "id" : str(MOCK_TOKEN_BIG_MAP), "diff" : {"action" : "alloc", "updates" : [],
+                "key_type" : t("nat"), "value_type" : TOKEN_INFO_TYPE}}]}}}
+        blocks = [mock_block(0, model.T0 - 120, []), mock_block(1, model.T0 - 60, [origination])]
+        for call in trace:
+            blocks.append(mock_block(len(blocks), call[3], [mock_operation(m, contract, call)]))
+        return MockRPC(blocks)
+
+
+def mock_block(level, ts, contents):
+    return {"hash" : "B%d" % level, "header" : {"level" : level, "predecessor" : "B%d" % (level - 1), "timestamp" : micheline.timestamp_to_string(ts)},
+        "operations" : [[], [], [], [{"hash" : "o%d" % level, "contents" : contents}]]}
+
+
+# Manager operation of a trace call applied to the model.
+#
+def mock_operation(m, contract, call):
+    (entry_point, params, sender, now, amount) = call
+    before = {id : (loan.status, loan) for (id, loan) in m.loans.items()}
+    ntoken = m.ntoken
+    failed = model.run(m, [call])[0] is not None
+    content = {"kind" : "transaction", "source" : sender, "destination" : contract, "amount" : str(amount),
+        "parameters" : {"entrypoint" : entry_point}, "metadata" : {"operation_result" : {"status" : "failed" if failed else "applied"},
+        "internal_operation_results" : []}}
+    if failed:
+        return content
+    if m.ntoken != ntoken:
+        (name, address, token_id) = m.token_info[m.ntoken]
+        content["metadata"]["operation_result"]["lazy_storage_diff"] = [{"kind" : "big_map", "id" : str(MOCK_TOKEN_BIG_MAP), "diff" : {
+            "action" : "update", "updates" : [{"key" : {"int" : str(m.ntoken)}, "value" : micheline.encode(TOKEN_INFO_TYPE, {"name" : name, "address" : address, "token_id" : token_id})}]}}]
+    events = []
+    for id in sorted(set(before) | set(m.loans)):
+        loan = m.loans.get(id)
+        if id not in before:
+            events.append(("loan_added", {"id" : id, "borrower" : loan.borrower, "token" : loan.token, "amount" : loan.amount,
+                "reward" : loan.reward, "deposit" : loan.deposit, "fee" : loan.fee, "time" : loan.time, "validity" : loan.validity}))
+            continue
+        (status, old) = before[id]
+        if loan is not None and loan.status != status:
+            events.append(("deal_made", {"id" : id, "borrower" : loan.borrower, "creditor" : loan.creditor, "token" : loan.token,
+                "amount" : loan.amount, "reward" : loan.reward, "deposit" : loan.deposit, "fee" : loan.fee, "exp" : loan.exp}))
+        elif loan is None and status == REQUEST:
+            events.append(("loan_cancelled", {"id" : id, "borrower" : old.borrower, "token" : old.token, "refund" : old.deposit + old.fee}))
+        elif loan is None:
+            repaid = sender == old.borrower
+            events.append(("deal_closed", {"id" : id, "borrower" : old.borrower, "creditor" : old.creditor, "token" : old.token,
+                "repayment" : old.amount + old.reward if repaid else 0, "deposit" : old.deposit, "fee" : old.fee,
+                "receiver" : old.borrower if repaid else old.creditor, "outcome" : ("repaid" if repaid else "liquidated", None)}))
+    for (nonce, (tag, event)) in enumerate(events):
+        content["metadata"]["internal_operation_results"].append({"kind" : "event", "source" : contract, "nonce" : nonce,
+            "type" : EVENT_TYPES[tag], "tag" : tag, "payload" : micheline.encode(EVENT_TYPES[tag], event), "result" : {"status" : "applied"}})
+    return content
+
+
+# Index a random trace with a restart in the middle and compare the database with the model.
+# Returns the list of differences.
+#
+def mock_check(calls, seed = 0):
+    trace = model.random_trace(calls, seed)
+    m = model.Opus(model.CREATOR, balance = 1000 * 1_000_000)
+    # service fees of the credit deals made (token ID -> (number of credit deals, fees))
+    revenue = {}
+    for call in trace:
+        deals = {id for (id, loan) in m.loans.items() if loan.status == DEAL}
+        model.run(m, [call])
+        for (id, loan) in m.loans.items():
+            if loan.status == DEAL and id not in deals:
+                (count, fee) = revenue.get(loan.token, (0, 0))
+                revenue[loan.token] = (count + 1, fee + loan.fee)
+    rpc = MockRPC.from_trace(trace)
+    store = Store(":memory:")
+    Indexer(rpc, store, MOCK_CONTRACT, start = 1, confirmations = 0).sync(rpc.head // 2)
+    start = timer.perf_counter()
+    Indexer(rpc, store, MOCK_CONTRACT, confirmations = 0).sync()
+    errors = []
+    rows = {row[0] : row for row in store.db.execute("SELECT id, status, borrower, creditor, token, deposit, fee, exp FROM loans")}
+    expected = {id : (id, loan.status, loan.borrower, loan.creditor, loan.token, loan.deposit, loan.fee, loan.exp) for (id, loan) in m.loans.items()}
+    if rows != expected:
+        errors.append("loans: %d indexed, %d in the model, %d different" % (len(rows), len(expected),
+            len(set(rows.items()) ^ set(expected.items()))))
+    if sum(store.locked_deposits().values()) != m.deposits:
+        errors.append("deposits: %d indexed, %d in the model" % (sum(store.locked_deposits().values()), m.deposits))
+    if store.tokens() != m.token_info:
+        errors.append("tokens: %s indexed, %s in the model" % (store.tokens(), m.token_info))
+    if store.fee_revenue() != revenue:
+        errors.append("fee revenue: %s indexed, %s in the model" % (store.fee_revenue(), revenue))
+    query = timer.perf_counter()
+    store.open_loans(token = 1)
+    store.expiring_deals(trace[-1][3], 24)
+    store.locked_deposits()
+    store.fee_revenue()
+    print("%d blocks indexed, queries in %.1f ms" % (rpc.head, (timer.perf_counter() - query) * 1000))
+    return errors
+
+
+# Index the blocks of a fixture and compare the database with the expected state of the fixture.
+# Returns the list of differences.
+# @blocks – JSON file with the blocks (RPC block JSON, see --record)
+# @state – JSON file with the contract address, its origination level and the state expected after the last block
+#
+def fixture_check(blocks, state):
+    expected = json.load(open(state))
+    rpc = MockRPC.load(blocks)
+    store = Store(":memory:")
+    level = Indexer(rpc, store, expected["contract"], start = expected["start"], confirmations = 0).sync()
+    errors = []
+    if (level, store.checkpoint()) != (expected["level"], (expected["level"], expected["hash"], expected["token_big_map"])):
+        errors.append("checkpoint: %s indexed, %s expected" % (store.checkpoint(), (expected["level"], expected["hash"], expected["token_big_map"])))
+    rows = [list(row) for row in store.db.execute("SELECT id, status, borrower, creditor, token, amount, reward, deposit, fee, time, validity, exp FROM loans ORDER BY id")]
+    if rows != expected["loans"]:
+        errors.append("loans: %s indexed, %s expected" % (rows, expected["loans"]))
+    tokens = {str(id) : list(token) for (id, token) in store.tokens().items()}
+    if tokens != expected["tokens"]:
+        errors.append("tokens: %s indexed, %s expected" % (tokens, expected["tokens"]))
+    revenue = {str(token) : list(totals) for (token, totals) in store.fee_revenue().items()}
+    if revenue != expected["fee_revenue"]:
+        errors.append("fee revenue: %s indexed, %s expected" % (revenue, expected["fee_revenue"]))
+    if sum(store.locked_deposits().values()) != expected["deposits"]:
+        errors.append("deposits: %d indexed, %d expected" % (sum(store.locked_deposits().values()), expected["deposits"]))
+    print("%d blocks indexed" % (level - expected["start"] + 1))
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Opus indexer")
+    parser.add_argument("--rpc", help = "Tezos RPC node URL")
+    parser.add_argument("--fixture", help = "JSON file with recorded blocks to index instead of an RPC node")
+    parser.add_argument("--record", help = "JSON file to save the fetched blocks to (a fixture)")
+    parser.add_argument("--contract", help = "Opus contract address")
+    parser.add_argument("--start", type = int, default = 0, help = "origination level of the contract")
+    parser.add_argument("--token-big-map", type = int, help = "ID of the token_info big map (detected from the origination by default)")
+    parser.add_argument("--db", default = "opus.db", help = "SQLite database file")
+    parser.add_argument("--confirmations", type = int, default = 2)
+    parser.add_argument("--follow", action = "store_true", help = "keep indexing new blocks")
+    parser.add_argument("--mock", type = int, nargs = "?", const = 2000, help = "index a random model trace of the given length and compare")
+    parser.add_argument("--check", nargs = 2, metavar = ("BLOCKS", "STATE"), help = "index a fixture and compare with its expected state")
+    args = parser.parse_args()
+    if args.check is not None:
+        errors = fixture_check(*args.check)
+        print("\n".join(errors) if errors else "the indexed state matches the fixture")
+        return 1 if errors else 0
+    if args.mock is not None:
+        errors = mock_check(args.mock)
+        print("\n".join(errors) if errors else "the indexed state matches the model")
+        return 1 if errors else 0
+    if not args.contract or not (args.rpc or args.fixture):
+        parser.error("--contract and --rpc or --fixture are required")
+    record = [] if args.record else None
+    rpc = MockRPC.load(args.fixture) if args.fixture else RPC(args.rpc, record = record)
+    store = Store(args.db)
+    indexer = Indexer(rpc, store, args.contract, start = args.start, token_big_map = args.token_big_map, confirmations = args.confirmations)
+    try:
+        if args.follow:
+            indexer.follow()
+        else:
+            print("indexed up to level %d" % indexer.sync())
+    finally:
+        store.commit()
+        store.close()
+        if record is not None:
+            json.dump(record, open(args.record, "w"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
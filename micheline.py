@@ -0,0 +1,268 @@
+import calendar
+import hashlib
+import time as timer
+
+
+#########################################################################################################
+# Micheline JSON helpers shared by the off-chain tools (indexer.py, client.py).                         #
+#                                                                                                       #
+# decode(type, value) converts a Micheline value of a Michelson type to Python: numbers, strings,      #
+# addresses and timestamps (seconds) become int/str, unit None, options None or the value, a pair with  #
+# field annotations a dict, other pairs a tuple and an or a (field, value) pair.                        #
+# encode(type, value) is the inverse.                                                                   #
+# forge(value) is the binary form of a Micheline value (as in forged operations, packed data without   #
+# the 0x05 byte).                                                                                       #
+#########################################################################################################
+
+B58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+# base58 prefixes of the 20 byte address hashes
+ADDRESS_PREFIXES = {
+    "tz1" : bytes([6, 161, 159]),
+    "tz2" : bytes([6, 161, 161]),
+    "tz3" : bytes([6, 161, 164]),
+    "tz4" : bytes([6, 161, 166]),
+    "KT1" : bytes([2, 90, 121]),
+}
+IMPLICIT_TAGS = {"tz1" : 0, "tz2" : 1, "tz3" : 2, "tz4" : 3}
+NUMERIC_TYPES = ("nat", "int", "mutez")
+# codes of the data constructors in the binary form
+PRIM_CODES = {"False" : 3, "Elt" : 4, "Left" : 5, "None" : 6, "Pair" : 7, "Right" : 8, "Some" : 9, "True" : 10, "Unit" : 11}
+
+
+def b58check_encode(payload):
+    data = payload + hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
+    n = int.from_bytes(data, "big")
+    result = ""
+    while n > 0:
+        n, r = divmod(n, 58)
+        result = B58_ALPHABET[r] + result
+    return "1" * (len(data) - len(data.lstrip(b"\0"))) + result
+
+
+def b58check_decode(string):
+    n = 0
+    for c in string:
+        n = n * 58 + B58_ALPHABET.index(c)
+    data = n.to_bytes((n.bit_length() + 7) // 8, "big")
+    data = b"\0" * (len(string) - len(string.lstrip("1"))) + data
+    payload, checksum = data[:-4], data[-4:]
+    if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
+        raise ValueError("invalid base58check checksum: " + string)
+    return payload
+
+
+# Address from its binary form (22 bytes, see the Michelson "address" encoding).
+#
+def address_from_bytes(data):
+    if data[0] == 0:
+        prefix = {tag : prefix for (prefix, tag) in IMPLICIT_TAGS.items()}[data[1]]
+        return b58check_encode(ADDRESS_PREFIXES[prefix] + data[2:22])
+    if data[0] == 1:
+        return b58check_encode(ADDRESS_PREFIXES["KT1"] + data[1:21])
+    raise ValueError("unsupported address: " + data.hex())
+
+
+# Binary form of an address (22 bytes).
+#
+def address_to_bytes(address):
+    prefix = address[:3]
+    digest = b58check_decode(address)[len(ADDRESS_PREFIXES[prefix]):]
+    if prefix == "KT1":
+        return b"\1" + digest + b"\0"
+    return bytes([0, IMPLICIT_TAGS[prefix]]) + digest
+
+
+# Natural number in the binary form (7 bits per byte, the least significant first).
+#
+def forge_nat(n):
+    result = bytearray()
+    while True:
+        (n, byte) = (n >> 7, n & 0x7f)
+        result.append(byte | (0x80 if n else 0))
+        if not n:
+            return bytes(result)
+
+
+# Integer in the binary form (the first byte holds the sign and 6 bits).
+#
+def forge_int(n):
+    (m, sign) = (abs(n), 0x40 if n < 0 else 0)
+    rest = m >> 6
+    return bytes([(m & 0x3f) | sign | (0x80 if rest else 0)]) + (forge_nat(rest) if rest else b"")
+
+
+def forge_bytes(data):
+    return len(data).to_bytes(4, "big") + data
+
+
+def forge(value):
+    if isinstance(value, list):
+        return b"\2" + forge_bytes(b"".join(forge(item) for item in value))
+    if "int" in value:
+        return b"\0" + forge_int(int(value["int"]))
+    if "string" in value:
+        return b"\1" + forge_bytes(value["string"].encode())
+    if "bytes" in value:
+        return b"\x0a" + forge_bytes(bytes.fromhex(value["bytes"]))
+    (args, annots) = (value.get("args", []), value.get("annots", []))
+    prim = bytes([PRIM_CODES[value["prim"]]])
+    if len(args) > 2:
+        return b"\x09" + prim + forge_bytes(b"".join(forge(arg) for arg in args)) + forge_bytes(" ".join(annots).encode())
+    return bytes([3 + 2 * len(args) + (1 if annots else 0)]) + prim + b"".join(forge(arg) for arg in args) + \
+        (forge_bytes(" ".join(annots).encode()) if annots else b"")
+
+
+def timestamp_from_string(string):
+    return calendar.timegm(timer.strptime(string[:19], "%Y-%m-%dT%H:%M:%S"))
+
+
+def timestamp_to_string(seconds):
+    return timer.strftime("%Y-%m-%dT%H:%M:%SZ", timer.gmtime(seconds))
+
+
+# Field annotation of a type ("%name" -> "name"), or None.
+#
+def field(type):
+    for annot in type.get("annots", []):
+        if annot.startswith("%"):
+            return annot[1:]
+    return None
+
+
+# Pair as nested binary pairs (Pair a b c == Pair a (Pair b c)).
+#
+def binary(node):
+    args = node["args"]
+    if len(args) <= 2:
+        return args
+    return [args[0], dict(node, args = args[1:])]
+
+
+# Leaf types of a pair type: the pair tree is flattened up to the annotated or non pair nodes.
+#
+def leaves(type):
+    return [leaf for arg in binary(type) for leaf in (leaves(arg) if nested(arg) else [arg])]
+
+
+def nested(type):
+    return type["prim"] == "pair" and field(type) is None
+
+
+def decode(type, value):
+    prim = type["prim"]
+    if prim in NUMERIC_TYPES:
+        return int(value["int"])
+    if prim in ("string", "key_hash", "key", "signature", "chain_id"):
+        return value["string"] if "string" in value else value["bytes"]
+    if prim in ("address", "contract"):
+        return value["string"] if "string" in value else address_from_bytes(bytes.fromhex(value["bytes"]))
+    if prim == "timestamp":
+        return int(value["int"]) if "int" in value else timestamp_from_string(value["string"])
+    if prim == "bytes":
+        return bytes.fromhex(value["bytes"])
+    if prim == "bool":
+        return value["prim"] == "True"
+    if prim == "unit":
+        return None
+    if prim == "option":
+        return None if value["prim"] == "None" else decode(type["args"][0], value["args"][0])
+    if prim == "or":
+        (left, right) = type["args"]
+        arg = value["args"][0]
+        branch = left if value["prim"] == "Left" else right
+        if branch["prim"] == "or" and field(branch) is None:
+            return decode(branch, arg)
+        return (field(branch), decode(branch, arg))
+    if prim in ("list", "set"):
+        return [decode(type["args"][0], item) for item in value]
+    if prim in ("map", "big_map"):
+        return {freeze(decode(type["args"][0], item["args"][0])) : decode(type["args"][1], item["args"][1]) for item in value}
+    if prim == "pair":
+        names = [field(leaf) for leaf in leaves(type)]
+        values = decode_leaves(type, value)
+        return dict(zip(names, values)) if None not in names else tuple(values)
+    raise ValueError("unsupported type: " + prim)
+
+
+# Decoded values of the leaves of a pair (see leaves).
+#
+def decode_leaves(type, value):
+    if isinstance(value, list):
+        value = {"prim" : "Pair", "args" : value}
+    return [leaf for (t, v) in zip(binary(type), binary(value)) for leaf in (decode_leaves(t, v) if nested(t) else [decode(t, v)])]
+
+
+def freeze(value):
+    return tuple(value.items()) if isinstance(value, dict) else value
+
+
+def encode(type, value):
+    prim = type["prim"]
+    if prim in NUMERIC_TYPES:
+        return {"int" : str(value)}
+    if prim in ("string", "key_hash", "key", "signature", "chain_id", "address", "contract"):
+        return {"string" : value}
+    if prim == "timestamp":
+        return {"int" : str(value)}
+    if prim == "bytes":
+        return {"bytes" : value.hex()}
+    if prim == "bool":
+        return {"prim" : "True" if value else "False"}
+    if prim == "unit":
+        return {"prim" : "Unit"}
+    if prim == "option":
+        return {"prim" : "None"} if value is None else {"prim" : "Some", "args" : [encode(type["args"][0], value)]}
+    if prim == "or":
+        (name, arg) = value
+        (left, right) = type["args"]
+        for (side, branch) in (("Left", left), ("Right", right)):
+            if field(branch) == name:
+                return {"prim" : side, "args" : [encode(branch, arg)]}
+            if branch["prim"] == "or" and field(branch) is None and name in variant_fields(branch):
+                return {"prim" : side, "args" : [encode(branch, value)]}
+        raise ValueError("unknown variant: %s" % name)
+    if prim in ("list", "set"):
+        return [encode(type["args"][0], item) for item in value]
+    if prim == "pair":
+        values = iter([value[field(leaf)] for leaf in leaves(type)] if isinstance(value, dict) else value)
+        return encode_leaves(type, values)
+    raise ValueError("unsupported type: " + prim)
+
+
+def encode_leaves(type, values):
+    return {"prim" : "Pair", "args" : [encode_leaves(arg, values) if nested(arg) else encode(arg, next(values)) for arg in binary(type)]}
+
+
+# Names of the branches of an or type.
+#
+def variant_fields(type):
+    if type["prim"] == "or" and field(type) is None:
+        return [name for arg in type["args"] for name in variant_fields(arg)]
+    return [field(type)]
+
+
+# Record type in the SmartPy default layout: the fields sorted by name in a balanced pair tree.
+# @fields – list of (name, type)
+#
+def record_type(fields):
+    fields = sorted(fields)
+    return layout([dict(type, annots = ["%" + name]) for (name, type) in fields])
+
+
+# Variant type in the SmartPy default layout (see record_type).
+#
+def variant_type(fields):
+    fields = sorted(fields)
+    return layout([dict(type, annots = ["%" + name]) for (name, type) in fields], prim = "or")
+
+
+def layout(types, prim = "pair"):
+    if len(types) == 1:
+        return types[0]
+    half = len(types) // 2
+    return {"prim" : prim, "args" : [layout(types[:half], prim), layout(types[half:], prim)]}
+
+
+def t(prim, *args):
+    return {"prim" : prim, "args" : list(args)} if args else {"prim" : prim}
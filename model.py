@@ -0,0 +1,851 @@
+import bisect
+import copy
+import itertools
+import random
+import sys
+import time as timer
+
+from errors import ACCESS_DENIED, ILLEGAL_ARGUMENT, ILLEGAL_TX_AMOUNT, PAUSED, NO_MATCH
+
+
+#########################################################################################################
+# Executable reference model of the Opus contract (contract.py) in plain Python.                        #
+#                                                                                                       #
+# The model keeps the same state and applies the same rules as the contract entry points: access       #
+# checks, the service fee formula, time bounds, validity/expiration and the "deposits" accounting.     #
+# A failing call raises OpusError with the contract error message and leaves the state unchanged,      #
+# batch calls are rejected as a whole. Addresses are plain strings, tezos amounts are mutez integers,  #
+# timestamps are seconds.                                                                               #
+#                                                                                                       #
+# Run "python3 model.py [operations] [seed]" to replay random operations and check the invariants;     #
+# differential.py replays the same traces through the real contract.                                   #
+#########################################################################################################
+
+REQUEST = 0
+DEAL = 1
+
+MAX_SWEEP = 100
+MAX_FILL = 100
+MAX_BOOK_WALK = 100
+MAX_LIST_WALK = 100
+RATE_UNIT = 1_000_000
+MATURITY_BUCKET = 86400
+
+# Denominator of the service fee formula (seconds per year * basis points * percents).
+FEE_DENOMINATOR = 3600 * 24 * 365 * 100 * 100
+
+
+# The error raised by a failing call, message is the contract error.
+#
+class OpusError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+# Service fee of a loan request (see Opus.service_fee).
+# @deposit – deposit in mutez
+# @time – credit deal duration in seconds
+# @fee – service fee (APY) in basis points
+#
+def service_fee(deposit, time, fee):
+    return deposit * time * fee // FEE_DENOMINATOR
+
+
+# Sort key of a loan request in the contract "book" lists: the reward rate (reward / amount), the best first.
+# The rate is scaled by 2**128 and floored, which keeps distinct rates apart for amounts below 2**64.
+#
+def book_key(loan):
+    return -((loan.reward << 128) // loan.amount)
+
+
+# Loan request or credit deal record (see Opus "loans").
+#
+class Loan:
+    __slots__ = ("status", "ts", "borrower", "creditor", "validity", "exp", "amount", "token", "time", "reward", "deposit", "fee")
+
+    def __init__(self, ts, borrower, validity, amount, token, time, reward, deposit, fee):
+        self.status = REQUEST
+        self.ts = ts
+        self.borrower = borrower
+        self.creditor = None
+        self.validity = validity
+        self.exp = None
+        self.amount = amount
+        self.token = token
+        self.time = time
+        self.reward = reward
+        self.deposit = deposit
+        self.fee = fee
+
+
+# Loan request parameters (see Opus.add_loan).
+#
+class LoanSpec:
+    __slots__ = ("token", "token_address", "amount", "reward", "deposit", "time", "validity", "prev")
+
+    def __init__(self, token, token_address, amount, reward, deposit, time, validity = None, prev = None):
+        self.token = token
+        self.token_address = token_address
+        self.amount = amount
+        self.reward = reward
+        self.deposit = deposit
+        self.time = time
+        self.validity = validity
+        self.prev = prev
+
+
+# State of the contract.
+# Every entry point method takes the call parameters and the keyword arguments sender, now (seconds) and
+# amount (mutez), like the SmartPy scenario calls. Outgoing transfers are appended to "operations" as
+# ("send", receiver, mutez), ("transfer", token_address, from, to, amount) for FA1.2 tokens and, after them,
+# ("fa2_transfer", token_address, [(from, [(to, token_id, amount), ...]), ...]) tuples, one per FA2 contract.
+#
+class Opus:
+    __slots__ = ("creator", "pause_", "baker", "admins", "tokens", "token_info", "ntoken", "time", "min_deposit", "fee",
+                 "nloan", "loans", "nseq", "index", "book", "stats", "maturities", "positions", "nonces", "deposits", "balance", "operations")
+
+    def __init__(self, creator, balance = 0):
+        self.creator = creator
+        self.pause_ = False
+        self.baker = None
+        self.admins = {creator}
+        # token name -> (token ID, token address, FA2 token ID or None)
+        self.tokens = {}
+        # token ID -> (token name, token address, FA2 token ID or None)
+        self.token_info = {}
+        self.ntoken = 0
+        # (min, max) time bounds
+        self.time = (7 * 86400, 180 * 86400)
+        self.min_deposit = 1_000_000
+        self.fee = 100
+        self.nloan = 0
+        self.loans = {}
+        # last sequence number of the items added to the lists (index and positions)
+        self.nseq = 0
+        # live loan request / credit deal ID -> sequence number, in the order they were added (dicts keep the order)
+        self.index = ({}, {})
+        # token ID -> live loan requests as sorted (-reward rate, ID) pairs: the best rate first, equal rates by ID
+        self.book = {}
+        # (token ID, status) -> (count, amount, reward, deposit) of the live loan requests / credit deals
+        self.stats = {}
+        # (token ID, expiration // MATURITY_BUCKET) -> (count, amount) of the live credit deals
+        self.maturities = {}
+        # address -> (loan request ID -> sequence number, credit deal ID -> sequence number), in the order they were added
+        self.positions = {}
+        # address -> nonce of the next permit
+        self.nonces = {}
+        self.deposits = 0
+        self.balance = balance
+        self.operations = []
+
+
+    def default(self, sender, now = 0, amount = 0):
+        self.balance += amount
+
+
+    def withdraw(self, address, amount, sender, now = 0, tx_amount = 0):
+        self.check_admin(sender)
+        if amount <= 0 or self.balance + tx_amount - self.deposits < amount:
+            raise OpusError(ILLEGAL_ARGUMENT + ":amount")
+        self.balance += tx_amount - amount
+        self.operations.append(("send", address, amount))
+
+
+    def add_admin(self, address, sender, now = 0, amount = 0):
+        self.check_admin_call(sender, amount)
+        if address in self.admins:
+            raise OpusError(ILLEGAL_ARGUMENT + ":address")
+        self.admins.add(address)
+
+
+    def remove_admin(self, address, sender, now = 0, amount = 0):
+        self.check_admin_call(sender, amount)
+        if address == self.creator or address not in self.admins:
+            raise OpusError(ILLEGAL_ARGUMENT + ":address")
+        self.admins.remove(address)
+
+
+    def pause(self, pause, sender, now = 0, amount = 0):
+        self.check_admin_call(sender, amount)
+        if self.pause_ == pause:
+            raise OpusError(ILLEGAL_ARGUMENT + ":pause")
+        self.pause_ = pause
+
+
+    def delegate(self, baker, sender, now = 0, amount = 0):
+        self.check_admin_call(sender, amount)
+        if self.baker == baker:
+            raise OpusError(ILLEGAL_ARGUMENT + ":baker")
+        self.baker = baker
+
+
+    def add_token(self, name, address, sender, now = 0, amount = 0, token_id = None):
+        self.check_admin_call(sender, amount)
+        token = self.tokens.get(name)
+        if token is None or token[1:] != (address, token_id):
+            self.ntoken += 1
+            self.token_info[self.ntoken] = (name, address, token_id)
+            self.tokens[name] = (self.ntoken, address, token_id)
+
+
+    def remove_token(self, name, sender, now = 0, amount = 0):
+        self.check_admin_call(sender, amount)
+        if name not in self.tokens:
+            raise OpusError(ILLEGAL_ARGUMENT + ":name")
+        del self.tokens[name]
+
+
+    def set_fee(self, fee, sender, now = 0, amount = 0):
+        self.check_admin_call(sender, amount)
+        if self.fee == fee or fee >= 10000:
+            raise OpusError(ILLEGAL_ARGUMENT + ":fee")
+        self.fee = fee
+
+
+    def set_min_deposit(self, min_deposit, sender, now = 0, amount = 0):
+        self.check_admin_call(sender, amount)
+        if self.min_deposit == min_deposit:
+            raise OpusError(ILLEGAL_ARGUMENT + ":min_deposit")
+        self.min_deposit = min_deposit
+
+
+    def set_time(self, min, max, sender, now = 0, amount = 0):
+        self.check_admin_call(sender, amount)
+        if self.time == (min, max):
+            raise OpusError(ILLEGAL_ARGUMENT + ":min,max")
+        if min <= 0 or min > max:
+            raise OpusError(ILLEGAL_ARGUMENT + ":min")
+        self.time = (min, max)
+
+
+    def add_loan(self, loan, sender, now = 0, amount = 0):
+        self.add_loans([loan], sender, now, amount)
+
+
+    # Same as add_loan, the parameter of Opus.add_loan has no prev hint (loan.prev is None).
+    #
+    def add_loan_after(self, loan, sender, now = 0, amount = 0):
+        self.add_loans([loan], sender, now, amount)
+
+
+    def add_loans(self, loans, sender, now = 0, amount = 0):
+        if self.pause_:
+            raise OpusError(PAUSED)
+        # the requests are validated and put into the book lists one by one like the contract does it, the rest of
+        # the state is changed once all of them are valid; the book entries are taken out again if the batch fails
+        records = {}
+        try:
+            for spec in loans:
+                record = self.check_loan(spec, sender, now)
+                id = self.nloan + len(records) + 1
+                self.book_add(id, record, spec.prev, records)
+                records[id] = record
+            if amount != sum(record.deposit + record.fee for record in records.values()):
+                raise OpusError(ILLEGAL_TX_AMOUNT)
+        except OpusError:
+            for (id, record) in reversed(records.items()):
+                self.book_remove(id, record)
+            raise
+        self.balance += amount
+        for record in records.values():
+            self.nloan += 1
+            self.loans[self.nloan] = record
+            self.list_add(self.index[REQUEST], self.nloan)
+            self.stats_update(REQUEST, record, 1)
+            self.list_add(self.position(sender)[REQUEST], self.nloan)
+            self.deposits += record.deposit + record.fee
+
+
+    def cancel_loan(self, id, sender, now = 0, amount = 0):
+        if amount != 0:
+            raise OpusError(ILLEGAL_TX_AMOUNT)
+        self.revoke_loan(id, sender)
+
+
+    def make_deal(self, id, sender, now = 0, amount = 0):
+        self.make_deals([id], sender, now, amount)
+
+
+    def make_deals(self, ids, sender, now = 0, amount = 0):
+        if self.pause_:
+            raise OpusError(PAUSED)
+        if amount != 0:
+            raise OpusError(ILLEGAL_TX_AMOUNT)
+        transfers = {}
+        self.create_deals(ids, sender, now, transfers)
+        self.send_transfers(transfers)
+
+
+    def fill_best(self, token, max_amount, min_reward_rate, sender, now = 0, amount = 0):
+        if self.pause_:
+            raise OpusError(PAUSED)
+        if amount != 0:
+            raise OpusError(ILLEGAL_TX_AMOUNT)
+        if token not in self.tokens:
+            raise OpusError(ILLEGAL_ARGUMENT + ":token")
+        for (_, id) in self.book.get(self.tokens[token][0], [])[:MAX_FILL]:
+            loan = self.loans[id]
+            if loan.reward * RATE_UNIT < min_reward_rate * loan.amount:
+                break
+            if loan.amount <= max_amount and loan.borrower != sender and (loan.validity is None or loan.validity > now):
+                self.make_deals([id], sender, now, amount)
+                return
+        raise OpusError(NO_MATCH)
+
+
+    def close_deal(self, id, sender, now = 0, amount = 0):
+        self.close_deals([id], sender, now, amount)
+
+
+    def close_deals(self, ids, sender, now = 0, amount = 0):
+        if amount != 0:
+            raise OpusError(ILLEGAL_TX_AMOUNT)
+        transfers = {}
+        self.settle_deals(ids, sender, now, transfers)
+        self.send_transfers(transfers)
+
+
+    # Permits are (signer, nonce, expiry, action) tuples, the action is a (name, ID) pair with the name "cancel_loan",
+    # "make_deal" or "close_deal". A permit with another nonce than the signer's current one stands for a permit
+    # with an invalid signature.
+    #
+    def relay(self, permits, sender, now = 0, amount = 0):
+        if amount != 0:
+            raise OpusError(ILLEGAL_TX_AMOUNT)
+        # all the permits are validated in the order the contract applies them before any of them is applied: only the
+        # nonces and the loans of the earlier permits of the call change, they are kept aside (None for a removed loan)
+        nonces = {}
+        loans = {}
+        for (signer, nonce, expiry, (action, id)) in permits:
+            if nonce != nonces.get(signer, self.nonces.get(signer, 0)):
+                raise OpusError(ILLEGAL_ARGUMENT + ":signature")
+            if now >= expiry:
+                raise OpusError(ILLEGAL_ARGUMENT + ":expiry")
+            nonces[signer] = nonce + 1
+            loan = loans[id] if id in loans else self.loans.get(id)
+            if action == "cancel_loan":
+                self.check_revoke(loan, signer)
+                loans[id] = None
+            elif action == "make_deal":
+                if self.pause_:
+                    raise OpusError(PAUSED)
+                self.check_deal(loan, signer, now)
+                loans[id] = copy.copy(loan)
+                (loans[id].status, loans[id].creditor, loans[id].exp) = (DEAL, signer, now + loan.time)
+            else:
+                self.check_settle(loan, signer, now)
+                loans[id] = None
+        transfers = {}
+        for (signer, nonce, _, (action, id)) in permits:
+            self.nonces[signer] = nonce + 1
+            if action == "cancel_loan":
+                self.revoke_loan(id, signer)
+            elif action == "make_deal":
+                self.create_deals([id], signer, now, transfers)
+            else:
+                self.settle_deals([id], signer, now, transfers)
+        self.send_transfers(transfers)
+
+
+    def increment_nonce(self, nonce, sender, now = 0, amount = 0):
+        if amount != 0:
+            raise OpusError(ILLEGAL_TX_AMOUNT)
+        if nonce <= self.nonces.get(sender, 0):
+            raise OpusError(ILLEGAL_ARGUMENT + ":nonce")
+        self.nonces[sender] = nonce
+
+
+    # Opus.sweep, anyone can call it.
+    #
+    def sweep(self, ids, sender, now = 0, amount = 0):
+        if amount != 0:
+            raise OpusError(ILLEGAL_TX_AMOUNT)
+        if len(ids) > MAX_SWEEP:
+            raise OpusError(ILLEGAL_ARGUMENT + ":ids")
+        payouts = {}
+        for id in ids:
+            loan = self.loans.get(id)
+            if loan is None:
+                continue
+            if loan.status == REQUEST:
+                if loan.validity is not None and loan.validity <= now:
+                    payouts[loan.borrower] = payouts.get(loan.borrower, 0) + loan.deposit + loan.fee
+                    self.deposits -= loan.deposit + loan.fee
+                    self.drop_loan(id, loan)
+            elif loan.exp < now:
+                payouts[loan.creditor] = payouts.get(loan.creditor, 0) + loan.deposit
+                self.deposits -= loan.deposit
+                self.drop_deal(id, loan)
+        # payouts are sent in the address order, like the iteration over a Michelson map
+        for receiver in sorted(payouts):
+            if payouts[receiver] > 0:
+                self.send(receiver, payouts[receiver])
+
+
+    # Service fee of a loan request with the current fee (see Opus.quote_fee).
+    #
+    def quote_fee(self, deposit, time):
+        return service_fee(deposit, time, self.fee)
+
+
+    # Place of a new loan request in the book list of a token (see Opus.get_book_prev).
+    # Returns the ID of the loan request to insert it after, 0 for the start of the list.
+    # Fails if the place is more than MAX_BOOK_WALK loan requests from the start of the list.
+    #
+    def get_book_prev(self, token, reward, amount):
+        book = self.book.get(token, [])
+        # the entries with a rate not lower than reward / amount (see book_key)
+        position = bisect.bisect_left(book, (-((reward << 128) // amount) + 1,))
+        if position > MAX_BOOK_WALK:
+            raise OpusError(ILLEGAL_ARGUMENT + ":prev")
+        return book[position - 1][1] if position else 0
+
+
+    # Totals of live loan requests and credit deals of a token (see Opus.get_stats).
+    # Returns the (count, amount, reward, deposit) tuples of the loan requests and of the credit deals.
+    #
+    def get_stats(self, token):
+        return (self.stats.get((token, REQUEST), (0, 0, 0, 0)), self.stats.get((token, DEAL), (0, 0, 0, 0)))
+
+
+    # Maturity histogram of live credit deals of a token (see Opus.get_maturities).
+    # Returns the list of (bucket, count, amount) tuples.
+    #
+    def get_maturities(self, token, from_bucket, count):
+        return [(bucket,) + self.maturities.get((token, bucket), (0, 0)) for bucket in range(from_bucket, from_bucket + count)]
+
+
+    # Page of live loan requests or credit deals (see Opus.list_loans and Opus.list_deals).
+    # Returns the list of (ID, record) pairs and the (ID, sequence number) cursor to continue from ((0, 0) at the end).
+    #
+    def list(self, status, cursor, limit):
+        return self.page(self.index[status], cursor, limit)
+
+
+    # Page of live loan requests or credit deals of an account (see Opus.get_positions), like list.
+    #
+    def list_positions(self, address, status, cursor, limit):
+        return self.page(self.positions.get(address, ({}, {}))[status], cursor, limit)
+
+
+    # Check the invariants of the state, raises AssertionError if any of them is broken.
+    #
+    def check(self):
+        locked = 0
+        for id, loan in self.loans.items():
+            locked += loan.deposit + (loan.fee if loan.status == REQUEST else 0)
+            assert id in self.index[loan.status], id
+            assert id in self.positions[loan.borrower][loan.status], id
+            if loan.status == DEAL:
+                assert id in self.positions[loan.creditor][DEAL], id
+        assert self.deposits == locked, (self.deposits, locked)
+        assert self.balance >= self.deposits, (self.balance, self.deposits)
+        assert len(self.index[REQUEST]) + len(self.index[DEAL]) == len(self.loans)
+        for nodes in self.index + tuple(nodes for position in self.positions.values() for nodes in position):
+            seqs = list(nodes.values())
+            assert seqs == sorted(set(seqs)) and all(0 < seq <= self.nseq for seq in seqs), seqs
+        assert sorted(id for book in self.book.values() for (_, id) in book) == sorted(self.index[REQUEST])
+        assert all(book for book in self.book.values())
+        stats, maturities = {}, {}
+        for loan in self.loans.values():
+            totals = stats.get((loan.token, loan.status), (0, 0, 0, 0))
+            stats[(loan.token, loan.status)] = (totals[0] + 1, totals[1] + loan.amount, totals[2] + loan.reward, totals[3] + loan.deposit)
+            if loan.status == DEAL:
+                totals = maturities.get((loan.token, loan.exp // MATURITY_BUCKET), (0, 0))
+                maturities[(loan.token, loan.exp // MATURITY_BUCKET)] = (totals[0] + 1, totals[1] + loan.amount)
+        assert self.stats == stats
+        assert self.maturities == maturities
+        assert sum(len(p[REQUEST]) + len(p[DEAL]) for p in self.positions.values()) == len(self.loans) + len(self.index[DEAL])
+
+
+    # Helpers.
+
+    def check_admin(self, sender):
+        if sender not in self.admins:
+            raise OpusError(ACCESS_DENIED)
+
+
+    def check_admin_call(self, sender, amount):
+        if amount != 0:
+            raise OpusError(ILLEGAL_TX_AMOUNT)
+        self.check_admin(sender)
+
+
+    def check_loan(self, spec, sender, now):
+        token = self.tokens.get(spec.token)
+        if token is None:
+            raise OpusError(ILLEGAL_ARGUMENT + ":token")
+        if token[1] != spec.token_address:
+            raise OpusError(ILLEGAL_ARGUMENT + ":token_address")
+        if spec.amount <= 0:
+            raise OpusError(ILLEGAL_ARGUMENT + ":amount")
+        if spec.deposit < self.min_deposit:
+            raise OpusError(ILLEGAL_ARGUMENT + ":deposit")
+        if spec.time < self.time[0] or spec.time > self.time[1]:
+            raise OpusError(ILLEGAL_ARGUMENT + ":time")
+        if spec.validity is not None and spec.validity <= now:
+            raise OpusError(ILLEGAL_ARGUMENT + ":validity")
+        return Loan(now, sender, spec.validity, spec.amount, token[0], spec.time, spec.reward, spec.deposit,
+                    service_fee(spec.deposit, spec.time, self.fee))
+
+
+    # Validate and make credit deals, FA2 transfers are collected in transfers (see transfer). Nothing is changed
+    # if any of the deals can't be made.
+    #
+    def create_deals(self, ids, sender, now, transfers):
+        seen = set()
+        for id in ids:
+            self.check_deal(None if id in seen else self.loans.get(id), sender, now)
+            seen.add(id)
+        for id in ids:
+            loan = self.loans[id]
+            self.transfer(transfers, loan.token, sender, loan.borrower, loan.amount)
+            self.deposits -= loan.fee
+            loan.status = DEAL
+            loan.creditor = sender
+            loan.exp = now + loan.time
+            del self.index[REQUEST][id]
+            self.list_add(self.index[DEAL], id)
+            self.book_remove(id, loan)
+            self.stats_update(REQUEST, loan, -1)
+            self.stats_update(DEAL, loan, 1)
+            self.position_remove(loan.borrower, REQUEST, id)
+            self.list_add(self.position(loan.borrower)[DEAL], id)
+            self.list_add(self.position(sender)[DEAL], id)
+
+
+    # Validate and close credit deals (see create_deals).
+    #
+    def settle_deals(self, ids, sender, now, transfers):
+        seen = set()
+        for id in ids:
+            self.check_settle(None if id in seen else self.loans.get(id), sender, now)
+            seen.add(id)
+        for id in ids:
+            deal = self.loans[id]
+            if sender == deal.borrower:
+                self.transfer(transfers, deal.token, deal.borrower, deal.creditor, deal.amount + deal.reward)
+                receiver = deal.borrower
+            else:
+                receiver = deal.creditor
+            if deal.deposit > 0:
+                self.send(receiver, deal.deposit)
+                self.deposits -= deal.deposit
+            self.drop_deal(id, deal)
+
+
+    def revoke_loan(self, id, sender):
+        loan = self.loans.get(id)
+        self.check_revoke(loan, sender)
+        if loan.deposit > 0:
+            self.send(loan.borrower, loan.deposit + loan.fee)
+            self.deposits -= loan.deposit + loan.fee
+        self.drop_loan(id, loan)
+
+
+    # Checks of a loan request to be cancelled, funded or of a credit deal to be closed by the sender, the loan is
+    # None if it doesn't exist.
+    #
+    def check_revoke(self, loan, sender):
+        if loan is None or loan.status != REQUEST:
+            raise OpusError(ILLEGAL_ARGUMENT + ":id")
+        if sender != loan.borrower and sender not in self.admins:
+            raise OpusError(ACCESS_DENIED)
+
+
+    def check_deal(self, loan, sender, now):
+        if loan is None or loan.status != REQUEST:
+            raise OpusError(ILLEGAL_ARGUMENT + ":id")
+        if loan.borrower == sender:
+            raise OpusError(ILLEGAL_ARGUMENT + ":sender")
+        if loan.validity is not None and loan.validity <= now:
+            raise OpusError(ILLEGAL_ARGUMENT + ":now")
+
+
+    def check_settle(self, deal, sender, now):
+        if deal is None or deal.status != DEAL:
+            raise OpusError(ILLEGAL_ARGUMENT + ":id")
+        if sender != deal.borrower and sender != deal.creditor and sender not in self.admins:
+            raise OpusError(ACCESS_DENIED)
+        if sender != deal.borrower and deal.exp >= now:
+            raise OpusError(ACCESS_DENIED)
+
+
+    def list_add(self, nodes, id):
+        self.nseq += 1
+        nodes[id] = self.nseq
+
+
+    # Page of a list of IDs with sequence numbers (see list), a removed cursor item is followed by the first
+    # item added after it, at most MAX_LIST_WALK items from the end of the list.
+    #
+    def page(self, nodes, cursor, limit):
+        (id, seq) = cursor
+        ids = list(nodes)
+        if id == 0:
+            start = 0
+        elif nodes.get(id) == seq:
+            start = ids.index(id)
+        else:
+            start = next((i for (i, item) in enumerate(ids) if nodes[item] > seq), len(ids))
+            if len(ids) - start > MAX_LIST_WALK:
+                raise OpusError(ILLEGAL_ARGUMENT + ":cursor")
+        rest = ids[start + limit : start + limit + 1]
+        return [(id, self.loans[id]) for id in ids[start : start + limit]], ((rest[0], nodes[rest[0]]) if rest else (0, 0))
+
+
+    def position(self, address):
+        position = self.positions.get(address)
+        if position is None:
+            position = self.positions[address] = ({}, {})
+        return position
+
+
+    def position_remove(self, address, status, id):
+        position = self.positions[address]
+        del position[status][id]
+        if not position[REQUEST] and not position[DEAL]:
+            del self.positions[address]
+
+
+    def drop_loan(self, id, loan):
+        del self.index[REQUEST][id]
+        self.book_remove(id, loan)
+        self.stats_update(REQUEST, loan, -1)
+        self.position_remove(loan.borrower, REQUEST, id)
+        del self.loans[id]
+
+
+    # Insert a loan request into the book list of its token (see Opus.book_add), from the prev hint or from the end
+    # of the list.
+    # @records – loan requests of the same batch, they are in the book already but not in loans
+    #
+    def book_add(self, id, record, prev, records):
+        book = self.book.get(record.token, [])
+        entry = (book_key(record), id)
+        position = bisect.bisect(book, entry)
+        if prev is None:
+            steps = len(book) - position
+        elif prev == 0:
+            steps = position
+        else:
+            hint = self.loans.get(prev) or records.get(prev)
+            if hint is None or hint.status != REQUEST or hint.token != record.token or record.reward * hint.amount > hint.reward * record.amount:
+                raise OpusError(ILLEGAL_ARGUMENT + ":prev")
+            steps = position - bisect.bisect(book, (book_key(hint), prev))
+        if steps > MAX_BOOK_WALK:
+            raise OpusError(ILLEGAL_ARGUMENT + ":prev")
+        book.insert(position, entry)
+        self.book[record.token] = book
+
+
+    def book_remove(self, id, loan):
+        book = self.book[loan.token]
+        del book[bisect.bisect_left(book, (book_key(loan), id))]
+        if not book:
+            del self.book[loan.token]
+
+
+    # Add (sign 1) or subtract (sign -1) a loan request or a credit deal to the totals of its token and, for a credit
+    # deal, to the maturity histogram; the entries are deleted when their count drops to 0.
+    #
+    def stats_update(self, status, loan, sign):
+        key = (loan.token, status)
+        totals = self.stats.get(key, (0, 0, 0, 0))
+        totals = (totals[0] + sign, totals[1] + sign * loan.amount, totals[2] + sign * loan.reward, totals[3] + sign * loan.deposit)
+        if totals[0]:
+            self.stats[key] = totals
+        else:
+            del self.stats[key]
+        if status == DEAL:
+            key = (loan.token, loan.exp // MATURITY_BUCKET)
+            totals = self.maturities.get(key, (0, 0))
+            totals = (totals[0] + sign, totals[1] + sign * loan.amount)
+            if totals[0]:
+                self.maturities[key] = totals
+            else:
+                del self.maturities[key]
+
+
+    def drop_deal(self, id, deal):
+        del self.index[DEAL][id]
+        self.stats_update(DEAL, deal, -1)
+        self.position_remove(deal.borrower, DEAL, id)
+        self.position_remove(deal.creditor, DEAL, id)
+        del self.loans[id]
+
+
+    # Token transfer: FA1.2 transfers are appended to the operations, FA2 transfers are collected in
+    # transfers (token address -> from -> list of (to, token_id, amount)) for send_transfers.
+    #
+    def transfer(self, transfers, token, sender, receiver, amount):
+        (_, address, token_id) = self.token_info[token]
+        if token_id is None:
+            self.operations.append(("transfer", address, sender, receiver, amount))
+        else:
+            transfers.setdefault(address, {}).setdefault(sender, []).append((receiver, token_id, amount))
+
+
+    # One FA2 "transfer" call per token contract, ordered like the contract builds them (maps by key,
+    # the sources in the reverse order, the transfers of a source in the reverse order).
+    #
+    def send_transfers(self, transfers):
+        for address in sorted(transfers):
+            items = [(sender, txs[::-1]) for (sender, txs) in sorted(transfers[address].items())]
+            self.operations.append(("fa2_transfer", address, items[::-1]))
+
+
+    def send(self, receiver, amount):
+        self.balance -= amount
+        self.operations.append(("send", receiver, amount))
+
+
+
+#########################################################################################################
+# Random traces.                                                                                        #
+# A trace is a list of (entry point, params, sender, now, amount) tuples, params is a dict of the      #
+# entry point method arguments. The same traces are replayed by differential.py.                       #
+#########################################################################################################
+
+DAY = 86400
+T0 = 1651363200  # 2022-05-01T00:00:00Z
+CREATOR = "creator"
+USERS = ["user%d" % i for i in range(8)]
+TOKENS = [("sBTC", "token0"), ("sETH", "token1"), ("sXRP", "token2")]
+# FA2 tokens (name, address, FA2 token ID), two tokens of the same contract
+FA2_TOKENS = [("sUSDT", "token3", 0), ("sEURT", "token3", 1)]
+
+
+# Generate a random trace starting with the token setup.
+# The calls are applied to a shadow model while the trace is generated, so the IDs and senders are mostly
+# taken from its live loan requests and credit deals; about one call in ten gets an invalid argument.
+# @n – number of random operations
+# @seed – random seed
+#
+def random_trace(n, seed = 0):
+    rnd = random.Random(seed)
+    trace = [("add_token", {"name" : name, "address" : address}, CREATOR, T0, 0) for (name, address) in TOKENS]
+    trace += [("add_token", {"name" : name, "address" : address, "token_id" : token_id}, CREATOR, T0, 0) for (name, address, token_id) in FA2_TOKENS]
+    names = [(name, address) for (name, address) in TOKENS] + [(name, address) for (name, address, _) in FA2_TOKENS]
+    model = Opus(CREATOR)
+    run(model, trace)
+    now = T0
+    bad = lambda: rnd.random() < 0.1
+    for _ in range(n):
+        now += rnd.randrange(0, 12 * 3600)
+        user = rnd.choice(USERS)
+        kind = rnd.random()
+        if kind < 0.35:
+            name, address = rnd.choice(names)
+            deposit = rnd.choice([1_000_000, 5_000_000, 150_000_000])
+            time = rnd.choice([7 * DAY, 30 * DAY, 180 * DAY])
+            spec = {"token" : name, "token_address" : address, "amount" : rnd.choice([10, 10_000]), "reward" : rnd.randrange(1000),
+                    "deposit" : deposit, "time" : time, "validity" : rnd.choice([None, now + rnd.randrange(1, 20 * DAY)])}
+            # mostly with the hint of get_book_prev, without a hint only the requests near the end of a list can be added
+            try:
+                hint = model.get_book_prev(model.tokens[name][0], spec["reward"], spec["amount"])
+            except OpusError:
+                hint = None
+            spec["prev"] = rnd.choice([None, hint] * 2 + [0])
+            amount = deposit + model.quote_fee(deposit, time)
+            if bad():
+                spec[rnd.choice(["amount", "deposit", "time", "validity", "prev"])] = 0
+            if bad():
+                spec["prev"] = pick(rnd, model, REQUEST)
+            # add_loan has no prev hint
+            entry_point = "add_loan_after" if spec["prev"] is not None else "add_loan"
+            if spec["prev"] is None:
+                del spec["prev"]
+            call = (entry_point, {"loan" : spec}, user, now, amount + (1 if bad() else 0))
+        elif kind < 0.55:
+            id = pick(rnd, model, REQUEST)
+            call = ("make_deal", {"id" : id}, user, now, 0)
+        elif kind < 0.58:
+            call = ("make_deals", {"ids" : [pick(rnd, model, REQUEST) for _ in range(3)]}, user, now, 0)
+        elif kind < 0.6:
+            name = rnd.choice(names)[0] if not bad() else "sXXX"
+            call = ("fill_best", {"token" : name, "max_amount" : rnd.choice([10, 10_000]), "min_reward_rate" : rnd.choice([0, 10_000, 100_000])},
+                user, now, 0)
+        elif kind < 0.8:
+            id = pick(rnd, model, DEAL)
+            deal = model.loans.get(id)
+            sender = user if deal is None or bad() else rnd.choice([deal.borrower, deal.borrower, deal.creditor])
+            call = ("close_deal", {"id" : id}, sender, now, 0)
+        elif kind < 0.87:
+            id = pick(rnd, model, REQUEST)
+            loan = model.loans.get(id)
+            call = ("cancel_loan", {"id" : id}, user if loan is None or bad() else loan.borrower, now, 0)
+        elif kind < 0.96:
+            ids = [pick(rnd, model, rnd.choice([REQUEST, DEAL])) for _ in range(5)]
+            call = ("sweep", {"ids" : ids}, user, now, 1 if bad() else 0)
+        elif kind < 0.975:
+            call = ("relay", {"permits" : random_permits(rnd, model, now, bad)}, user, now, 0)
+        elif kind < 0.98:
+            call = ("increment_nonce", {"nonce" : model.nonces.get(user, 0) + (0 if bad() else rnd.randrange(1, 3))}, user, now, 0)
+        else:
+            call = ("set_fee", {"fee" : rnd.choice([50, 100, 200, 10000])}, user if bad() else CREATOR, now, 0)
+        run(model, [call])
+        trace.append(call)
+    return trace
+
+
+# Help function to generate 1-3 permits (see Opus.relay) signed by the borrowers and creditors of live loan
+# requests and credit deals, or by random users.
+#
+def random_permits(rnd, model, now, bad):
+    permits = []
+    nonces = {}
+    for _ in range(rnd.randrange(1, 4)):
+        action = rnd.choice(["cancel_loan", "make_deal", "close_deal"])
+        id = pick(rnd, model, DEAL if action == "close_deal" else REQUEST)
+        loan = model.loans.get(id)
+        signer = rnd.choice(USERS)
+        if loan is not None and action == "cancel_loan":
+            signer = loan.borrower
+        if loan is not None and action == "close_deal" and loan.status == DEAL:
+            signer = rnd.choice([loan.borrower, loan.creditor])
+        nonce = nonces.get(signer, model.nonces.get(signer, 0))
+        nonces[signer] = nonce + 1
+        permits.append((signer, nonce + 1 if bad() else nonce, now if bad() else now + rnd.randrange(1, DAY), (action, id)))
+    return permits
+
+
+# Help function to pick one of the last live loan request or credit deal IDs, or a random ID.
+#
+def pick(rnd, model, status):
+    ids = model.index[status]
+    if ids and rnd.random() < 0.9:
+        return next(itertools.islice(reversed(ids), rnd.randrange(min(len(ids), 10)), None))
+    return rnd.randrange(1, model.nloan + 2)
+
+
+# Apply a trace to a model.
+# Returns the list of outcomes: None for a successful call or the contract error message.
+#
+def run(model, trace):
+    outcomes = []
+    for (entry_point, params, sender, now, amount) in trace:
+        if entry_point in ("add_loan", "add_loan_after"):
+            params = {"loan" : LoanSpec(**params["loan"])}
+        try:
+            getattr(model, entry_point)(sender = sender, now = now, amount = amount, **params)
+            outcomes.append(None)
+        except OpusError as e:
+            outcomes.append(e.message)
+    return outcomes
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    trace = random_trace(n, seed)
+    model = Opus(CREATOR, balance = 1000 * 1_000_000)
+    start = timer.perf_counter()
+    outcomes = run(model, trace)
+    elapsed = timer.perf_counter() - start
+    model.check()
+    print("%d operations in %.2fs (%.0f operations per minute), %d failed" % (len(trace), elapsed, len(trace) * 60 / elapsed,
+        sum(1 for outcome in outcomes if outcome is not None)))
+    print("live loan requests: %d, live credit deals: %d, deposits: %d mutez, balance: %d mutez" % (
+        len(model.index[REQUEST]), len(model.index[DEAL]), model.deposits, model.balance))
@@ -0,0 +1,527 @@
+import argparse
+import json
+import os
+import re
+import sys
+
+import micheline
+
+
+#########################################################################################################
+# Size and cost profiler of compiled Opus builds (Michelson .tz or Micheline .json files).              #
+#                                                                                                       #
+# The code is split by the parameter dispatch (the IF_LEFT tree over the entry point "or" type) and     #
+# each entry point and view gets:                                                                       #
+#   instrs – number of Michelson instructions,                                                          #
+#   bytes  – size of its code in the binary Micheline encoding (what origination and parsing pay for),  #
+#   gas    – static step gas of the most expensive non failing path (loops once, see STEP_GAS), an      #
+#            estimate for comparing code versions: storage I/O and parsing aren't included, the real    #
+#            consumption is returned by the run_operation RPC (see client.py),                          #
+#   errors – bytes of the values pushed for FAILWITH (what the compact_errors build saves).             #
+# SmartPy writes the source statement as a comment before its instructions (unless the erase-comments   #
+# flag is set); with the comments the entry points are broken down by statement as well. The report     #
+# ends with the error messages, the repeated instruction blocks and the storage path depth of every     #
+# field (the number of CAR/CDR steps from the storage root).                                            #
+# The initial storage SmartPy writes next to the code (step_000_cont_0_storage.tz) is read if it is     #
+# there: the lazy entry points of the lazy_admin build, which are kept in a big map of the storage, are #
+# profiled as "<entry point> (lazy)" and the origination size (script and initial storage) is reported; #
+# the comparison of several builds shows the size and the gas of each call (the stub and the lazy code #
+# of a lazy entry point), so the opus and opus_lazy builds can be compared call by call.                #
+#                                                                                                       #
+# Run: SmartPy.sh compile contract.py out                                                               #
+#      python3 profiler.py out/opus/step_000_cont_0_contract.tz [out/opus_compact/...] [--statements N] #
+#########################################################################################################
+
+# Approximate interpreter step costs in milligas (the protocol cost model, rounded), DEFAULT_GAS for the rest.
+STEP_GAS = {
+    "COMPARE" : 35, "ADD" : 35, "SUB" : 35, "SUB_MUTEZ" : 35, "MUL" : 60, "EDIV" : 80, "CONCAT" : 45, "SLICE" : 25,
+    "ITER" : 20, "MAP" : 20, "GET" : 80, "MEM" : 80, "UPDATE" : 100, "GET_AND_UPDATE" : 120, "APPLY" : 140,
+    "CONTRACT" : 150, "TRANSFER_TOKENS" : 60, "SET_DELEGATE" : 30, "EMIT" : 30, "VIEW" : 1460,
+    "PACK" : 250, "UNPACK" : 250, "HASH_KEY" : 3200, "BLAKE2B" : 430, "SHA256" : 600, "CHECK_SIGNATURE" : 66000,
+}
+DEFAULT_GAS = 10
+
+# Branching instructions (every argument is a branch) and loops (the body runs once in the estimate).
+BRANCHES = ("IF", "IF_LEFT", "IF_NONE", "IF_CONS")
+LOOPS = ("LOOP", "LOOP_LEFT", "ITER", "MAP")
+
+# Instructions taking code blocks.
+CODE_BLOCKS = BRANCHES + LOOPS + ("DIP", "LAMBDA", "LAMBDA_REC")
+
+# Statement of the instructions without a source comment before them.
+NO_SOURCE = "(no comment)"
+
+# Repeated instruction blocks smaller than this (in bytes) aren't reported.
+MIN_BLOCK = 24
+
+TOKEN = re.compile(r'\s+|#[^\n]*|/\*.*?\*/|"(?:[^"\\]|\\.)*"|0x[0-9a-fA-F]*|-?\d+|[%@:][\w.%@:]*|[A-Za-z_][\w.]*|[{}();]', re.S)
+
+
+#########################################################################################################
+# Michelson parser                                                                                      #
+#########################################################################################################
+
+# Parse Michelson text into Micheline JSON (see micheline.py). Instructions are tagged with the last
+# source comment before them in their sequence or the sequences around it ("source" key, ignored by size).
+#
+def parse(text):
+    tokens = []
+    position = 0
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None:
+            raise ValueError("unexpected character at %d: %r" % (position, text[position : position + 20]))
+        token = match.group(0)
+        position = match.end()
+        if token.startswith("#"):
+            # SmartPy writes the statements on their own lines and the stack types after the instructions
+            line = text[text.rfind("\n", 0, match.start()) + 1 : match.start()]
+            comment = token[1:].split(" # ")[0].strip()
+            if comment and not line.strip():
+                tokens.append(("comment", comment))
+        elif token.strip() and not token.startswith("/*"):
+            tokens.append(("token", token))
+    return Parser(tokens).sequence(None, top = True)
+
+
+class Parser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        while self.position < len(self.tokens) and self.tokens[self.position][0] == "comment":
+            self.position += 1
+        return self.tokens[self.position][1] if self.position < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    # Items of a sequence up to "}" (or the end of the text for the top level).
+    #
+    def sequence(self, source, top = False):
+        items = []
+        while True:
+            while self.position < len(self.tokens) and self.tokens[self.position][0] == "comment":
+                source = self.tokens[self.position][1]
+                self.position += 1
+            token = self.peek()
+            if token is None or token == "}":
+                if not top:
+                    self.expect("}")
+                return items
+            if token == ";":
+                self.next()
+                continue
+            items.append(self.expression(source))
+
+    def expect(self, token):
+        if self.next() != token:
+            raise ValueError("expected %r at token %d" % (token, self.position))
+
+    # Primitive application (prim arguments annotations) or a single argument.
+    #
+    def expression(self, source):
+        token = self.peek()
+        if not is_word(token):
+            return self.argument(source)
+        node = {"prim" : self.next()}
+        if source is not None and node["prim"].isupper():
+            node["source"] = source
+        args = []
+        annots = []
+        while self.peek() not in (None, ";", "}", ")"):
+            if self.peek()[0] in "%@:":
+                annots.append(self.next())
+            else:
+                args.append(self.argument(source))
+        if args:
+            node["args"] = args
+        if annots:
+            node["annots"] = annots
+        return node
+
+    def argument(self, source):
+        token = self.next()
+        if token == "{":
+            return self.sequence(source)
+        if token == "(":
+            node = self.expression(source)
+            self.expect(")")
+            return node
+        if token.startswith('"'):
+            return {"string" : json.loads(token)}
+        if token.startswith("0x"):
+            return {"bytes" : token[2:]}
+        if re.fullmatch(r"-?\d+", token):
+            return {"int" : token}
+        if is_word(token):
+            return {"prim" : token}
+        raise ValueError("unexpected token %r" % token)
+
+
+def is_word(token):
+    return token is not None and (token[0].isalpha() or token[0] == "_")
+
+
+def load(path):
+    with open(path) as f:
+        text = f.read()
+    script = json.loads(text) if path.endswith(".json") else parse(text)
+    # a script in braces
+    if len(script) == 1 and isinstance(script[0], list):
+        script = script[0]
+    return script
+
+
+# Initial storage of a compiled contract from the storage file SmartPy writes next to it
+# (step_000_cont_0_storage.tz or .json), None if there is no such file.
+#
+def load_storage(path):
+    storage = path.replace("_contract.", "_storage.")
+    if storage == path or not os.path.exists(storage):
+        return None
+    value = load(storage)
+    return value[0] if isinstance(value, list) and len(value) == 1 else value
+
+
+# Top level sections of a script: parameter and storage types, code and views (name -> view node).
+#
+def sections(script):
+    result = {"views" : {}}
+    for node in script:
+        if node["prim"] == "view":
+            result["views"][node["args"][0]["string"]] = node
+        else:
+            result[node["prim"]] = node["args"][0]
+    return result
+
+
+
+#########################################################################################################
+# Measures                                                                                              #
+#########################################################################################################
+
+# Size of a node in the binary Micheline encoding.
+#
+def size(node):
+    if isinstance(node, list):
+        return 5 + sum(size(item) for item in node)
+    if "int" in node:
+        return 1 + zarith_size(int(node["int"]))
+    if "string" in node:
+        return 5 + len(node["string"].encode())
+    if "bytes" in node:
+        return 5 + len(node["bytes"]) // 2
+    args = node.get("args", [])
+    annots = node.get("annots", [])
+    annots_size = 4 + len(" ".join(annots).encode()) if annots else 0
+    if len(args) <= 2:
+        return 2 + sum(size(arg) for arg in args) + annots_size
+    return 2 + 4 + sum(size(arg) for arg in args) + 4 + len(" ".join(annots).encode())
+
+
+def zarith_size(n):
+    bits = abs(n).bit_length()
+    return 1 if bits <= 6 else 1 + (bits - 6 + 6) // 7
+
+
+def instructions(node):
+    if isinstance(node, list):
+        return sum(instructions(item) for item in node)
+    if "prim" not in node:
+        return 0
+    return (node["prim"].isupper()) + sum(instructions(arg) for arg in node.get("args", []))
+
+
+# Static step gas of the most expensive path that doesn't fail.
+# Returns (gas, fails): fails is True if every path through the node fails.
+#
+def step_gas(node):
+    if isinstance(node, list):
+        total = 0
+        for item in node:
+            (gas, fails) = step_gas(item)
+            total += gas
+            if fails:
+                return (total, True)
+        return (total, False)
+    prim = node.get("prim", "")
+    if not prim.isupper():
+        return (0, False)
+    own = STEP_GAS.get(prim, DEFAULT_GAS)
+    if prim == "FAILWITH":
+        return (own, True)
+    if prim in BRANCHES:
+        branches = [step_gas(arg) for arg in node["args"]]
+        live = [gas for (gas, fails) in branches if not fails]
+        return (own + max(live or [gas for (gas, _) in branches], default = 0), bool(branches) and not live)
+    if prim in LOOPS or prim == "DIP":
+        return (own + step_gas(node["args"][-1])[0], False)
+    return (own, False)
+
+
+# Values pushed right before FAILWITH: list of (value, bytes of the PUSH).
+#
+def error_pushes(node):
+    if not isinstance(node, list):
+        return [push for arg in node.get("args", []) for push in error_pushes(arg)]
+    result = []
+    for (previous, item) in zip([{}] + node, node):
+        if isinstance(item, dict) and item.get("prim") == "FAILWITH" and isinstance(previous, dict) and previous.get("prim") == "PUSH":
+            (type, value) = previous["args"]
+            result.append((value["string"] if "string" in value else "%s %s" % (type.get("prim"), value.get("int")), size(previous)))
+        result += error_pushes(item)
+    return result
+
+
+# Instructions and bytes of the code of each source statement (see parse): source -> (instrs, bytes).
+# The bytes of an instruction don't include the code blocks it takes (branches, loop bodies...).
+#
+def statements(node, result = None):
+    result = {} if result is None else result
+    for item in (node if isinstance(node, list) else [node]):
+        if isinstance(item, list):
+            statements(item, result)
+            continue
+        if not item.get("prim", "").isupper():
+            continue
+        blocks = [arg for arg in item.get("args", []) if isinstance(arg, list)] if item["prim"] in CODE_BLOCKS else []
+        source = item.get("source", NO_SOURCE)
+        (count, total) = result.get(source, (0, 0))
+        result[source] = (count + 1, total + size(item) - sum(size(block) for block in blocks))
+        for block in blocks:
+            statements(block, result)
+    return result
+
+
+# Instruction blocks (sequences) which are repeated in the code: list of (count, bytes, first instructions).
+#
+def repeated_blocks(code):
+    blocks = {}
+    def visit(node):
+        if isinstance(node, list):
+            if size(node) >= MIN_BLOCK:
+                key = json.dumps(strip(node), sort_keys = True)
+                blocks[key] = blocks.get(key, 0) + 1
+            for item in node:
+                visit(item)
+        elif "args" in node:
+            for arg in node["args"]:
+                visit(arg)
+    visit(code)
+    result = []
+    for (key, count) in blocks.items():
+        if count > 1:
+            block = json.loads(key)
+            result.append((count, size(block), "; ".join(render(item) for item in block[:4]) + ("; ..." if len(block) > 4 else "")))
+    return sorted(result, key = lambda item: -(item[0] - 1) * item[1])
+
+
+def strip(node):
+    if isinstance(node, list):
+        return [strip(item) for item in node]
+    return {key : [strip(arg) for arg in value] if key == "args" else value for (key, value) in node.items() if key != "source"}
+
+
+def render(node):
+    if isinstance(node, list):
+        return "{...}"
+    if "prim" not in node:
+        return json.dumps(node.get("string", node.get("int", node.get("bytes"))))
+    return " ".join([node["prim"]] + node.get("annots", []) + [render(arg) for arg in node.get("args", [])])
+
+
+
+#########################################################################################################
+# Entry points and storage                                                                              #
+#########################################################################################################
+
+# Split the code by the parameter dispatch.
+# Returns the code of each entry point (name -> sequence) and the dispatch code around them.
+#
+def entry_points(code, parameter):
+    result = {}
+    dispatch = []
+    split(code, parameter, result, dispatch)
+    return (result, dispatch)
+
+
+def split(code, type, result, dispatch):
+    name = micheline.field(type)
+    if type["prim"] != "or" or name is not None:
+        result[name or "default"] = code
+        return
+    for (i, item) in enumerate(code):
+        if isinstance(item, dict) and item.get("prim") == "IF_LEFT":
+            dispatch += code[:i] + code[i + 1:] + [dict(item, args = [])]
+            for (branch, arg) in zip(item["args"], type["args"]):
+                split(branch, arg, result, dispatch)
+            return
+    # no dispatch (e.g. a single entry point with an "or" parameter)
+    result["default"] = code
+
+
+# Lazy entry points of a storage value: the code of the lambdas the lazy-entry-points builds keep in a big map
+# (entry point number -> code).
+#
+def lazy_entry_points(value):
+    result = {}
+    if isinstance(value, list):
+        for item in value:
+            if isinstance(item, dict) and item.get("prim") == "Elt" and "int" in item["args"][0] and isinstance(item["args"][1], list):
+                result[int(item["args"][0]["int"])] = item["args"][1]
+            else:
+                result.update(lazy_entry_points(item))
+    elif isinstance(value, dict):
+        for arg in value.get("args", []):
+            result.update(lazy_entry_points(arg))
+    return result
+
+
+# Key of the lazy entry point the code of an entry point loads (PUSH nat/int key; GET), or None.
+#
+def lazy_key(node):
+    if isinstance(node, dict):
+        return next((key for key in (lazy_key(arg) for arg in node.get("args", [])) if key is not None), None)
+    for (item, following) in zip(node, node[1:]):
+        if item.get("prim") == "PUSH" and item["args"][0].get("prim") in ("nat", "int") and following.get("prim") == "GET" \
+                and not following.get("args"):
+            return int(item["args"][1]["int"])
+    return next((key for key in (lazy_key(item) for item in node) if key is not None), None)
+
+
+# Storage fields with their CAR/CDR path from the storage root: list of (name, path).
+#
+def storage_paths(type, path = ()):
+    name = micheline.field(type)
+    if type["prim"] != "pair" or (name is not None and path):
+        return [(name or "(unnamed)", path)]
+    result = []
+    for (arg, step) in zip(micheline.binary(type), ("CAR", "CDR")):
+        result += storage_paths(arg, path + (step,))
+    return result
+
+
+
+#########################################################################################################
+# Report                                                                                                #
+#########################################################################################################
+
+# Profile of a script: rows (name, instrs, bytes, gas, error bytes) of the entry points and views,
+# the statements of each entry point, the error values, the repeated blocks and the storage paths.
+# With the initial storage, the lazy entry points kept in it are profiled as well and the origination
+# size (script and initial storage) is added.
+#
+def profile(script, storage = None):
+    parts = sections(script)
+    (codes, dispatch) = entry_points(parts["code"], parts["parameter"])
+    codes = dict(codes, **{"(dispatch)" : dispatch})
+    codes.update({"view " + name : view["args"][3] for (name, view) in parts["views"].items()})
+    if storage is not None:
+        # the lazy code of an entry point is named after it, the code of a key no entry point loads after the key
+        # (if several codes load the same key, the smallest one, the stub, is the loader)
+        loaders = {lazy_key(code) : name for (name, code) in sorted(codes.items(), key = lambda item: -size(item[1]))}
+        codes.update({("%s (lazy)" % loaders[key]) if key in loaders else ("lazy #%d" % key) : code
+            for (key, code) in sorted(lazy_entry_points(storage).items())})
+    rows = []
+    errors = {}
+    for (name, code) in codes.items():
+        pushes = error_pushes(code)
+        for (value, bytes) in pushes:
+            (count, total) = errors.get(value, (0, 0))
+            errors[value] = (count + 1, total + bytes)
+        rows.append((name, instructions(code), size(code), step_gas(code)[0], sum(bytes for (_, bytes) in pushes)))
+    return {
+        "total" : sum(size(node) for node in script),
+        "code" : size(parts["code"]),
+        "storage_type" : size(parts["storage"]),
+        "storage" : None if storage is None else size(storage),
+        "rows" : rows,
+        "statements" : {name : statements(code) for (name, code) in codes.items()},
+        "errors" : errors,
+        "blocks" : repeated_blocks(parts["code"]),
+        "paths" : storage_paths(parts["storage"]),
+    }
+
+
+def print_profile(path, result, top):
+    print("%s: %d bytes (code %d, storage type %d)" % (path, result["total"], result["code"], result["storage_type"]))
+    if result["storage"] is not None:
+        print("initial storage %d bytes, origination %d bytes" % (result["storage"], result["total"] + result["storage"]))
+    print()
+    print("%-24s %8s %8s %8s %8s" % ("entry point", "instrs", "bytes", "gas", "errors"))
+    for (name, instrs, bytes, gas, error_bytes) in sorted(result["rows"], key = lambda row: -row[2]):
+        print("%-24s %8d %8d %8.1f %8d" % (name, instrs, bytes, gas / 1000, error_bytes))
+    commented = any(source != NO_SOURCE for statements in result["statements"].values() for source in statements)
+    print()
+    if not commented:
+        print("no source comments in the code (compiled with erase-comments?), statements aren't profiled")
+    else:
+        print("statements (the %d largest of each entry point):" % top)
+        for (name, items) in result["statements"].items():
+            print("  %s" % name)
+            for (source, (count, bytes)) in sorted(items.items(), key = lambda item: -item[1][1])[:top]:
+                print("    %6d bytes %5d instrs  %s" % (bytes, count, source[:90]))
+    print()
+    print("%-40s %6s %8s" % ("error", "count", "bytes"))
+    for (value, (count, bytes)) in sorted(result["errors"].items(), key = lambda item: -item[1][1]):
+        print("%-40s %6d %8d" % (value, count, bytes))
+    print("%-40s %6d %8d" % ("(total)", sum(count for (count, _) in result["errors"].values()),
+        sum(bytes for (_, bytes) in result["errors"].values())))
+    print()
+    print("repeated blocks (at least %d bytes):" % MIN_BLOCK)
+    for (count, bytes, text) in result["blocks"][:top]:
+        print("  %3d x %5d bytes  %s" % (count, bytes, text[:90]))
+    print()
+    print("%-24s %6s  %s" % ("storage field", "depth", "path"))
+    for (name, steps) in result["paths"]:
+        print("%-24s %6d  %s" % (name, len(steps), " ".join(steps)))
+
+
+# Compare the entry point sizes and gas estimates of several builds (e.g. the default, the lazy_admin and the
+# compact_errors ones). The gas of a call of a lazy entry point is the gas of its stub and of its lazy code.
+#
+def print_comparison(paths, results):
+    names = [os.path.basename(os.path.dirname(path)) for path in paths]
+    if len(set(names)) < len(names):
+        names = [os.path.basename(path) for path in paths]
+    print("%-24s" % "bytes" + "".join(" %14s" % name[-14:] for name in names))
+    rows = [{row[0] : row[2] for row in result["rows"]} for result in results]
+    for name in dict.fromkeys(name for row in rows for name in row):
+        print("%-24s" % name + "".join(" %14s" % row.get(name, "-") for row in rows))
+    print("%-24s" % "(total)" + "".join(" %14d" % result["total"] for result in results))
+    if all(result["storage"] is not None for result in results):
+        print("%-24s" % "(origination)" + "".join(" %14d" % (result["total"] + result["storage"]) for result in results))
+    print()
+    print("%-24s" % "gas" + "".join(" %14s" % name[-14:] for name in names))
+    gas = [{row[0] : row[3] for row in result["rows"]} for result in results]
+    for name in dict.fromkeys(name for row in gas for name in row if not name.endswith(" (lazy)") and not name.startswith("lazy #")):
+        print("%-24s" % name + "".join(" %14s" % ("%.1f" % ((row[name] + row.get(name + " (lazy)", 0)) / 1000) if name in row else "-")
+            for row in gas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Opus build profiler")
+    parser.add_argument("paths", nargs = "+", help = "compiled contract (.tz or Micheline .json)")
+    parser.add_argument("--statements", type = int, default = 10, help = "number of statements and blocks to show")
+    parser.add_argument("--json", action = "store_true", help = "print the profiles as JSON")
+    args = parser.parse_args()
+    results = [profile(load(path), load_storage(path)) for path in args.paths]
+    if args.json:
+        print(json.dumps({path : dict(result, statements = {name : {source : list(value) for (source, value) in items.items()}
+            for (name, items) in result["statements"].items()}, errors = {str(value) : list(item) for (value, item) in result["errors"].items()})
+            for (path, result) in zip(args.paths, results)}, indent = 2))
+        return 0
+    for (path, result) in zip(args.paths, results):
+        print_profile(path, result, args.statements)
+        print()
+    if len(results) > 1:
+        print_comparison(args.paths, results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
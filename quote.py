@@ -0,0 +1,145 @@
+import sys
+import time as timer
+
+import numpy as np
+
+import model
+
+
+#########################################################################################################
+# Batched fee quotes for Opus loan requests.                                                            #
+#                                                                                                       #
+# The service fee is computed exactly like add_loan does it on mutez:                                   #
+#   fee = deposit * time * fee_bp // (3600 * 24 * 365 * 100 * 100)                                     #
+# The product doesn't fit into 64 bits, so the quotient is estimated in floating point and corrected   #
+# with the exact remainder, which is computed in wrapping 64 bit integer arithmetic: the remainder is  #
+# small, so its wrapped value is the true one.                                                          #
+#                                                                                                       #
+# All the functions take numpy arrays (or scalars) and broadcast them, e.g. a grid of deposits x       #
+# durations x fees is quoted with deposit[:, None, None], time[None, :, None], fee[None, None, :].    #
+#                                                                                                       #
+# Run "python3 quote.py [samples] [seed]" to check the quotes against model.service_fee, the Python    #
+# copy of the contract formula. model.service_fee is checked against the contract quote_fee view by     #
+# the "Opus fee quotes" scenario of differential.py (SmartPy.sh test differential.py <output-dir>).     #
+#########################################################################################################
+
+FEE_DENOMINATOR = model.FEE_DENOMINATOR
+YEAR = 3600 * 24 * 365
+
+# Largest mutez amount (Michelson mutez is a signed 64 bit integer).
+MAX_MUTEZ = 2**63 - 1
+
+# The float estimate of the quotient is used up to this bound, the remainder correction stays exact below it.
+MAX_QUOTIENT = 2**62
+
+
+# Exact service fees in mutez.
+# Raises OverflowError if a fee doesn't fit into MAX_QUOTIENT (the contract would fail on such requests).
+# @deposit – deposits in mutez
+# @time – credit deal durations in seconds
+# @fee – service fees (APY) in basis points
+#
+def service_fee(deposit, time, fee):
+    deposit, time, fee = np.broadcast_arrays(np.asarray(deposit, dtype = np.int64), np.asarray(time, dtype = np.int64),
+        np.asarray(fee, dtype = np.int64))
+    if (deposit < 0).any() or (time < 0).any() or (fee < 0).any():
+        raise ValueError("deposit, time and fee have to be non-negative")
+    rate = time.astype(np.float64) * fee
+    estimate = np.floor(deposit.astype(np.float64) * rate / FEE_DENOMINATOR)
+    if (rate >= MAX_QUOTIENT).any() or (estimate >= MAX_QUOTIENT).any():
+        raise OverflowError("service fee out of range")
+    q = estimate.astype(np.int64)
+    # remainder deposit * time * fee - q * FEE_DENOMINATOR modulo 2**64, it's the true (signed) remainder
+    # because the float estimate is off by a few units at most
+    with np.errstate(over = "ignore"):
+        u = deposit.astype(np.uint64) * (time.astype(np.uint64) * fee.astype(np.uint64)) - q.astype(np.uint64) * np.uint64(FEE_DENOMINATOR)
+    r = u.view(np.int64)
+    return q + r // FEE_DENOMINATOR
+
+
+# Quotes of loan requests.
+# Fields:
+#   fee – service fee in mutez,
+#   send – tezos amount (deposit and service fee) add_loan has to be called with,
+#   valid – True if add_loan accepts the deposit and the time with the given contract parameters,
+#   reward_apr – annual reward rate of the creditor (reward / amount, annualised),
+#   fee_apr – annual rate of the service fee to the deposit,
+#   net_yield – annual yield of the creditor in the worst case: the reward if the deal is repaid or the
+#               deposit minus the lent tokens if it's liquidated (needs the token price), NaN without a price.
+#
+class Quote:
+    __slots__ = ("fee", "send", "valid", "reward_apr", "fee_apr", "net_yield")
+
+    def __init__(self, fee, send, valid, reward_apr, fee_apr, net_yield):
+        self.fee = fee
+        self.send = send
+        self.valid = valid
+        self.reward_apr = reward_apr
+        self.fee_apr = fee_apr
+        self.net_yield = net_yield
+
+
+# Quote loan requests.
+# @deposit – deposits in mutez
+# @time – credit deal durations in seconds
+# @amount – loan amounts in token units
+# @reward – rewards in token units
+# @fee – service fee (APY) in basis points, the contract default if not given
+# @price – token price in mutez per token unit, optional
+# @min_deposit – minimal deposit in mutez (see Opus.set_min_deposit)
+# @min_time, max_time – credit deal duration bounds in seconds (see Opus.set_time)
+#
+def quote(deposit, time, amount, reward, fee = 100, price = None, min_deposit = 1_000_000, min_time = 7 * 86400, max_time = 180 * 86400):
+    deposit, time, amount, reward, fee = np.broadcast_arrays(np.asarray(deposit, dtype = np.int64), np.asarray(time, dtype = np.int64),
+        np.asarray(amount, dtype = np.int64), np.asarray(reward, dtype = np.int64), np.asarray(fee, dtype = np.int64))
+    f = service_fee(deposit, time, fee)
+    valid = (amount > 0) & (deposit >= min_deposit) & (time >= min_time) & (time <= max_time) & (f <= MAX_MUTEZ - deposit)
+    send = np.where(valid, deposit + f, 0)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        years = time / YEAR
+        reward_apr = reward / amount / years
+        fee_apr = f / deposit / years
+        if price is None:
+            net_yield = np.full(deposit.shape, np.nan)
+        else:
+            lent = amount * np.asarray(price, dtype = np.float64)
+            net_yield = np.minimum(reward / amount, (deposit - lent) / lent) / years
+    return Quote(f, send, valid, reward_apr, fee_apr, net_yield)
+
+
+# Compare service_fee with the contract formula on random and edge case inputs.
+# Returns the number of mismatches.
+# @n – number of random samples
+# @seed – random seed
+#
+def check(n, seed = 0):
+    rnd = np.random.default_rng(seed)
+    deposit = np.concatenate([
+        rnd.integers(0, 10**9, n // 2),
+        rnd.integers(0, 2**62, n - n // 2),
+        [0, 1, FEE_DENOMINATOR - 1, FEE_DENOMINATOR, FEE_DENOMINATOR + 1, 2**53 - 1, 2**53, 2**53 + 1, 2**62, 2**63 - 1]
+    ]).astype(np.int64)
+    time = rnd.integers(0, 400 * 86400, deposit.shape)
+    fee = rnd.integers(0, 10000, deposit.shape)
+    # keep the samples the contract can quote (the fee has to fit into mutez)
+    keep = deposit.astype(np.float64) * time * fee / FEE_DENOMINATOR < MAX_QUOTIENT / 2
+    deposit, time, fee = deposit[keep], time[keep], fee[keep]
+    # the model formula on python integers (object arrays) is exact
+    expected = model.service_fee(deposit.astype(object), time.astype(object), fee.astype(object))
+    return int((service_fee(deposit, time, fee).astype(object) != expected).sum())
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    mismatches = check(n, seed)
+    print("%d samples checked against the contract formula, %d mismatches" % (n, mismatches))
+    # deposits x durations x fees grid
+    deposit = np.arange(1, 201, dtype = np.int64) * 1_000_000
+    time = np.arange(7, 181, dtype = np.int64) * 86400
+    fee = np.arange(0, 1000, 10, dtype = np.int64)
+    start = timer.perf_counter()
+    q = quote(deposit[:, None, None], time[None, :, None], 10_000, 100, fee = fee[None, None, :], price = 1000)
+    elapsed = timer.perf_counter() - start
+    print("%d quotes in %.3fs, %d of them valid" % (q.fee.size, elapsed, q.valid.sum()))
+    sys.exit(1 if mismatches else 0)